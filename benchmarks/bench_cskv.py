@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018, Julen Larrucea <julen@larrucea.eu>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GPLv2, the GNU General Public License version 2, as
+# published by the Free Software Foundation. http://gnu.org/licenses/gpl.html
+
+
+# Benchmarks of cskv on synthetic config files (see generate.py) of several
+# sizes: time and peak memory of insert, delete, merge (extra config),
+# compare and a whole command line call.
+# Every measure runs in a new process, so that the peak memory of one does
+# not hide the others. The results can be written as JSON and compared with
+# the results of another commit (--baseline).
+
+# To call sys.exit
+import sys
+
+# For the files and processes
+import os
+import shutil
+import tempfile
+import subprocess
+
+# For the timings and the results
+import time
+import json
+import platform
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+cskv_dir = os.path.abspath(os.path.join(bench_dir, os.pardir))
+sys.path.insert(0, cskv_dir)
+sys.path.insert(0, bench_dir)
+
+import cskv
+import generate
+
+OPERATIONS = ['insert', 'delete', 'merge', 'compare', 'cli']
+FTYPES = ['ini', 'rawe', 'rawc', 'raws']
+
+
+def target(ftype, sections, keys):
+    # Section and keys changed by the benchmarks: an existing key in the
+    # middle of the file and a new key, in the last section
+    # Usage: section, old_key, new_key = target('ini', 10, 100)
+    sec = sections - 1
+    section = generate.section_name(sec) if ftype == 'ini' else None
+    return section, generate.key_name(sec, keys // 2), \
+        generate.key_name(sec, keys + 1)
+
+
+def run_operation(op, ftype, sections, keys, files):
+    # Run one operation on the config file (in this process) and return
+    # the time spent reading the file and in total
+    # Usage: run_operation('insert', 'ini', 10, 100, [CONFIG, COMPARE, EXTRA])
+    config_file, compare_file, extra_file = files
+    section, old_key, new_key = target(ftype, sections, keys)
+
+    opts = {'config_file': config_file}
+    if op == 'compare':
+        opts['compare'] = compare_file
+    elif op == 'merge':
+        opts['extra_conf'] = open(extra_file).read().splitlines()
+
+    start = time.time()
+    cfile = cskv.cskv(**opts)
+    loaded = time.time()
+    if op == 'insert':
+        cfile.insert_doc(cfile.doc, section, old_key, 'bench_value')
+        cfile.insert_doc(cfile.doc, section, new_key, 'bench_value')
+        cfile.doc.lines()
+    elif op == 'delete':
+        cfile.delete(section, old_key)
+    elif op == 'merge':
+        cfile.merge(cfile.doc, cfile.extra2skv())
+        cfile.doc.lines()
+    elif op == 'compare':
+        cfile.compare_confs()
+    return {'load': loaded - start, 'seconds': time.time() - start}
+
+
+def measure(cmd):
+    # Run a command and return its output, wall time and peak memory (KB)
+    # Usage: output, wall, max_rss = measure(COMMAND)
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+    proc.returncode = status
+    if status:
+        sys.exit('ERROR: the following command failed:\n' + ' '.join(cmd))
+    return output, wall, usage.ru_maxrss
+
+
+def bench(op, ftype, sections, keys, files, repeat):
+    # Measure one operation "repeat" times, each one in a new process
+    # Usage: bench('insert', 'ini', 10, 100, [CONFIG, COMPARE, EXTRA], 3)
+    runs = []
+    for i in range(repeat):
+        if op == 'cli':
+            # A copy, because the command line tool changes the file
+            config_file = files[0] + '.cli'
+            shutil.copy(files[0], config_file)
+            section, old_key, new_key = target(ftype, sections, keys)
+            cmd = [sys.executable, os.path.join(cskv_dir, 'bin', 'cskv'),
+                   config_file, '-k', old_key, '-v', 'bench_value']
+            if section:
+                cmd.extend(['-s', section])
+            output, wall, max_rss = measure(cmd)
+            runs.append({'load': None, 'seconds': wall, 'wall': wall,
+                         'max_rss_kb': max_rss})
+        else:
+            cmd = [sys.executable, os.path.abspath(__file__), '--child', op,
+                   ftype, str(sections), str(keys)] + files
+            output, wall, max_rss = measure(cmd)
+            run = json.loads(output)
+            run.update({'wall': wall, 'max_rss_kb': max_rss})
+            runs.append(run)
+
+    runs.sort(key=lambda run: run['seconds'])
+    best = runs[0]
+    nlines = sum(1 for line in open(files[0]))
+    return {'op': op, 'ftype': ftype, 'sections': sections,
+            'keys': sections * keys, 'lines': nlines,
+            'bytes': os.path.getsize(files[0]),
+            'seconds': best['seconds'],
+            'median': runs[len(runs) // 2]['seconds'],
+            'load': best['load'], 'wall': best['wall'],
+            'lines_per_second': nlines / max(best['seconds'], 1e-9),
+            'max_rss_kb': min(run['max_rss_kb'] for run in runs)}
+
+
+def write_files(work_dir, ftype, sections, keys, args):
+    # Generate the config file, the file to compare with and the extra
+    # config of a benchmark
+    # Usage: files = write_files(DIRECTORY, 'ini', 10, 100, ARGS)
+    name = os.path.join(work_dir, '%s_%d' % (ftype, sections * keys))
+    files = [name + '.conf', name + '.compare', name + '.extra']
+    gen_opts = {'comments': args.comments, 'indent': args.indent,
+                'duplicates': args.duplicates}
+    generate.write_lines(files[0], generate.config_lines(
+        ftype, sections, keys, seed=args.seed, **gen_opts))
+    generate.write_lines(files[1], generate.config_lines(
+        ftype, sections, keys, seed=args.seed + 1, **gen_opts))
+    generate.write_lines(files[2], generate.extra_lines(
+        ftype, sections, keys, args.extra, seed=args.seed))
+    return files
+
+
+def environment():
+    # Description of the machine and the code being measured
+    # Usage: environment()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=cskv_dir,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'cskv_version': cskv.__version__, 'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def report(results, baseline=None):
+    # Table of the results, with the ratio to the baseline results
+    # Usage: for line in report(RESULTS, BASELINE_RESULTS)
+    old = {}
+    for result in baseline or []:
+        old[(result['ftype'], result['keys'], result['op'])] = result
+    row = '{:6} {:>8} {:>8} {:7} {:>9} {:>12} {:>9} {:>8}'
+    yield row.format('ftype', 'keys', 'lines', 'op', 'seconds', 'lines/s',
+                     'RSS MB', 'ratio')
+    for result in results:
+        ratio = ''
+        prev = old.get((result['ftype'], result['keys'], result['op']))
+        if prev:
+            ratio = '%.2f' % (result['seconds'] / max(prev['seconds'], 1e-9))
+        yield row.format(result['ftype'], result['keys'], result['lines'],
+                         result['op'], '%.4f' % result['seconds'],
+                         '%.0f' % result['lines_per_second'],
+                         '%.1f' % (result['max_rss_kb'] / 1024.0), ratio)
+
+
+def cli_parser():
+    # Parser of the command line arguments
+    # Usage: cli_parser().parse_args(LIST_OF_ARGUMENTS)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of cskv on synthetic config files')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='Numbers of keys of the files')
+    parser.add_argument('--keys-per-section', type=int, default=100,
+                        help='Keys in each section (or group of RAW keys)')
+    parser.add_argument('--ftypes', nargs='+', default=FTYPES,
+                        choices=FTYPES, help='File types')
+    parser.add_argument('--ops', nargs='+', default=OPERATIONS,
+                        choices=OPERATIONS, help='Operations')
+    parser.add_argument('--comments', type=float, default=0.1,
+                        help='Fraction of commented out keys')
+    parser.add_argument('--indent', type=str, default='',
+                        help='Indentation of the keys')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='Fraction of keys defined twice')
+    parser.add_argument('--extra', type=int, default=1000,
+                        help='Key/values of the extra config (merge)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each benchmark (the best is kept)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the generated files')
+    parser.add_argument('--output', type=str,
+                        help='Write the results as JSON into this file')
+    parser.add_argument('--baseline', type=str,
+                        help='JSON results to compare with (e.g. of '
+                        'another commit)')
+    parser.add_argument('--work-dir', type=str,
+                        help='Directory for the generated files (a '
+                        'temporary one by default)')
+    return parser
+
+
+def main(argv):
+    # Run the benchmarks
+    # Usage: sys.exit(main(sys.argv[1:]))
+    if argv and argv[0] == '--child':
+        op, ftype, sections, keys = argv[1:5]
+        print json.dumps(run_operation(op, ftype, int(sections), int(keys),
+                                       argv[5:8]))
+        return 0
+
+    args = cli_parser().parse_args(argv)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cskv_bench_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    try:
+        for size in args.sizes:
+            keys = min(args.keys_per_section, size)
+            sections = max(1, size // keys)
+            for ftype in args.ftypes:
+                files = write_files(work_dir, ftype, sections, keys, args)
+                for op in args.ops:
+                    results.append(bench(op, ftype, sections, keys, files,
+                                         args.repeat))
+                    print >> sys.stderr, list(report(results[-1:]))[-1]
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    baseline = None
+    if args.baseline:
+        baseline = json.load(open(args.baseline))['results']
+    for line in report(results, baseline):
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': environment(), 'results': results},
+                      output, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
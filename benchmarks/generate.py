@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018, Julen Larrucea <julen@larrucea.eu>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GPLv2, the GNU General Public License version 2, as
+# published by the Free Software Foundation. http://gnu.org/licenses/gpl.html
+
+
+# Generators of synthetic config files for the benchmarks (bench_cskv.py)
+# The same arguments (and seed) always give the same file.
+
+# For the random comments, duplicates and values
+import random
+
+# To call sys.exit
+import sys
+
+
+# Key/value separators written for each file type (with the usual padding)
+WRITE_SEPARATORS = {'ini': ' = ', 'rawe': '=', 'rawc': ': ', 'raws': ' '}
+
+
+def section_name(sec):
+    # Name of the section number sec
+    # Usage: section_name(NUMBER)
+    return 'section_%05d' % sec
+
+
+def key_name(sec, key):
+    # Name of the key number key of the section number sec
+    # All the names have the same length, so that no key is the prefix of
+    # another one (cskv matches the keys by prefix)
+    # Usage: key_name(SECTION_NUMBER, KEY_NUMBER)
+    return 'key_%05d_%06d' % (sec, key)
+
+
+def config_lines(ftype, sections=10, keys=100, comments=0.1, indent='',
+                 duplicates=0.0, seed=0):
+    # Lines of a config file: "sections" groups of "keys" key/values each
+    # (INI sections, or groups separated by a blank line in RAW files)
+    # comments: fraction of commented out key/values (and of comment
+    #           lines between them)
+    # indent: indentation of the key/values
+    # duplicates: fraction of keys defined again later in the same group
+    # Usage: for line in config_lines('ini', 10, 100, 0.1, '  ', 0.01, 0)
+    rand = random.Random(seed)
+    sep = WRITE_SEPARATORS[ftype]
+    for sec in range(sections):
+        if ftype == 'ini':
+            yield '[' + section_name(sec) + ']'
+        else:
+            yield '# ' + section_name(sec)
+        defined = []
+        for key in range(keys):
+            value = 'value_%d' % rand.randint(0, 10 ** 6)
+            line = key_name(sec, key) + sep + value
+            if rand.random() < comments:
+                yield '# Comment about the next key, number %d' % key
+                line = '#' + line
+            else:
+                defined.append(key)
+            yield indent + line
+            if defined and rand.random() < duplicates:
+                dup = rand.choice(defined)
+                yield indent + key_name(sec, dup) + sep + 'duplicate'
+        yield ''
+
+
+def extra_lines(ftype, sections=10, keys=100, count=100, seed=0):
+    # Lines of extra config (-e) for a file of config_lines(): "count"
+    # key/values, half of them already in the file, half of them new
+    # Usage: for line in extra_lines('ini', 10, 100, 100, 0)
+    rand = random.Random(seed)
+    sep = WRITE_SEPARATORS[ftype]
+    skvs = []
+    for idx in range(count):
+        sec = rand.randrange(sections)
+        if idx % 2:
+            key = rand.randrange(keys)
+        else:
+            key = keys + idx
+        skvs.append([sec, key, 'extra_%d' % idx])
+    if ftype == 'ini':
+        skvs.sort()
+    current = None
+    for sec, key, value in skvs:
+        if ftype == 'ini' and sec != current:
+            yield '[' + section_name(sec) + ']'
+            current = sec
+        yield key_name(sec, key) + sep + value
+
+
+def write_lines(file_name, lines):
+    # Write lines into a file
+    # Usage: write_lines(FILE_NAME, LINES)
+    with open(file_name, 'w') as output:
+        for line in lines:
+            output.write(line + '\n')
+
+
+if __name__ == "__main__":
+    # Write a file: generate.py FTYPE SECTIONS KEYS [FILE_NAME]
+    if len(sys.argv) < 4:
+        sys.exit('Usage: generate.py ini|rawe|rawc|raws SECTIONS KEYS '
+                 '[FILE_NAME]')
+    lines = config_lines(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    if len(sys.argv) > 4:
+        write_lines(sys.argv[4], lines)
+    else:
+        for line in lines:
+            print line
@@ -18,15 +18,1098 @@
 # To call sys.exit
 import sys
 
-# For guessing the file type and searching for section/key/value
-import re
-
 # For checking if the file exists
 import os
 
+# For writing files atomically
+import stat
+import errno
+
+# For the sorted index of keys
+import bisect
+
+# For the timings of the phases (--stats)
+import time
+
+# For the persistent cache of file analyses (--cache-dir)
+import marshal
+
+# The rest of the modules (collections, json, hashlib, mmap, glob, ...) are
+# imported only by the functions using them, to keep the start up fast
+
 __version__ = '0.2'
 
 
+# Kinds of lines found in a config file
+SECTION, KEYVAL, COMMENT, BLANK = 'section', 'keyval', 'comment', 'blank'
+
+# Supported file formats and their key/value separators
+SEPARATORS = {'ini': '=', 'rawe': '=', 'rawc': ':', 'raws': ' '}
+
+# Streaming mode: bytes read at once, and lines used to guess the format
+CHUNK_SIZE = 1 << 16
+SAMPLE_LINES = 1000
+
+# The format is guessed on the first SAMPLE_LINES lines with keys, unless
+# the margin of the guess over the second best is lower than this (as a
+# fraction of the lines looked at): then the whole file is looked at
+SNIFF_CONFIDENCE = 0.25
+
+# Cache directory: format of the entries and default size limit (bytes)
+CACHE_VERSION = 4
+CACHE_SIZE = 64 << 20
+# Fraction of the size limit left by each eviction, so that the next one
+# only comes after many other entries
+CACHE_EVICT = 0.9
+
+# Defaults of the command line options (see cli_parser), and the options
+# understood without it (see quick_args)
+CLI_DEFAULTS = {'config_file': None, 'section': None, 'key': None,
+                'value': None, 'indent': 'a', 'compare': None,
+                'drift': None, 'apply': None, 'format': 'text',
+                'sep': None,
+                'delete': False,
+                'delete_keys': None, 'delete_glob': None,
+                'delete_regex': None, 'all_sections': False,
+                'test': False, 'diff': False, 'extra': '-', 'recursive': False,
+                'glob': '*', 'jobs': 1, 'serve': None, 'client': None,
+                'cache_dir': None, 'cache_size': 64, 'mmap': False,
+                'stream': False, 'batch': None, 'get': None,
+                'where': None, 'includes': False,
+                'stats': False,
+                'profile': False,
+                'verbosity': 0, 'ftype': None}
+CLI_VALUES = {'-s': 'section', '--section': 'section', '-k': 'key',
+              '--key': 'key', '-v': 'value', '--value': 'value',
+              '-i': 'indent', '--indent': 'indent', '--sep': 'sep'}
+CLI_FLAGS = {'-d': 'delete', '--delete': 'delete', '-t': 'test',
+             '--test': 'test', '--diff': 'diff', '--includes': 'includes'}
+CLI_LISTS = {'--get': 'get', '--where': 'where'}
+
+# Include directives (see include_directives), and the number of
+# snapshots of included files kept in memory (see cskv.include_snapshot)
+INCLUDE_DIRECTIVES = ['include', '!include', '!includedir']
+INCLUDE_CACHE = 1024
+# Value which wins, with the include directives, for a key defined many
+# times (see cskv.find_keys): the first one for space separated files
+# (sshd_config, ssh_config), the last one for the rest (samba, MySQL, ..)
+INCLUDE_PRECEDENCE = {'ini': 'last', 'rawe': 'last', 'rawc': 'last',
+                      'raws': 'first'}
+
+# Fields needed by each request of the daemon (see cserver)
+SERVER_FIELDS = {'set': ['file', 'key', 'value'],
+                 'delete': ['file', 'key'], 'get': ['file', 'key'],
+                 'merge': ['file'], 'compare': ['file', 'compare'],
+                 'cli': ['argv']}
+
+# Exit code of --get when a key is missing
+EXIT_MISSING = 3
+# Exit code of --diff when the file would change
+EXIT_CHANGED = 4
+
+
+class cstats(object):
+    # Wall time and number of calls of each phase of a run (--stats):
+    # read, detect (file type), guess (separator and indent), lookup
+    # (section and key candidates), edit, render and write.
+    # The time of a phase does not include the phases run inside of it.
+    # Usage: stats = cstats(); with stats.phase('read'): ...
+
+    def __init__(self):
+        self.start = time.time()
+        self.seconds = {}
+        self.calls = {}
+        self.order = []
+        self.running = []
+
+    def phase(self, name):
+        # Context manager measuring one phase
+        return cphase(self, name)
+
+    def add(self, name, seconds, calls=1):
+        # Add time and calls to a phase
+        if name not in self.seconds:
+            self.order.append(name)
+            self.seconds[name] = 0.0
+            self.calls[name] = 0
+        self.seconds[name] += seconds
+        self.calls[name] += calls
+
+    def dump(self):
+        # Plain list of [phase, seconds, calls], e.g. to send it to another
+        # process, and to add it to other stats with update()
+        return [[name, self.seconds[name], self.calls[name]]
+                for name in self.order]
+
+    def update(self, phases):
+        # Add the phases of dump()
+        for name, seconds, calls in phases:
+            self.add(name, seconds, calls)
+
+    def report(self):
+        # Lines of a table with the phases and the total time
+        total = time.time() - self.start
+        lines = ['{:10} {:>8} {:>10} {:>6}'.format('phase', 'calls',
+                                                   'seconds', '%')]
+        for name, seconds, calls in self.dump():
+            lines.append('{:10} {:>8} {:>10.4f} {:>6.1f}'.format(
+                name, calls, seconds, 100 * seconds / max(total, 1e-9)))
+        lines.append('{:10} {:>8} {:>10.4f}'.format('total', '', total))
+        return lines
+
+
+class cphase(object):
+    # One running phase of cstats (see cstats.phase)
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.stats.running.append(self)
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.begin
+        self.stats.running.pop()
+        if self.stats.running:
+            self.stats.running[-1].nested += elapsed
+        self.stats.add(self.name, elapsed - self.nested)
+
+
+class cnophase(object):
+    # Phase that measures nothing, when there are no stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_PHASE = cnophase()
+
+
+def timed(name):
+    # Decorator of the cskv methods that are a phase of cstats
+    # Usage: @timed('guess')
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            if self.__dict__.get('stats') is None:
+                return method(self, *args, **kwargs)
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+    return decorator
+
+
+class cline(object):
+    # One line of a config file, classified only once when it is read
+    # Usage: cline(LINE_TEXT, SEPARATOR)
+    # The separator is optional, key/value are only split when it is known
+    __slots__ = ('text', 'kind', 'body', 'indent', 'key', 'value',
+                 'lpad', 'rpad')
+
+    def __init__(self, text, isep=None):
+        # The original line is kept untouched, so the file can be rendered
+        # back exactly as it was read
+        self.text = text
+        self.body = text.strip()
+        self.indent = len(text) - len(text.lstrip())
+        self.key, self.value = None, None
+        self.lpad, self.rpad = 0, 0
+
+        if text.startswith('[') and text.find(']', 1) > 0:
+            self.kind = SECTION
+            self.key = text[1:text.find(']', 1)]
+        elif not self.body:
+            self.kind = BLANK
+        elif self.body.startswith(('#', ';')):
+            self.kind = COMMENT
+        else:
+            self.kind = KEYVAL
+
+        if isep:
+            self.split(isep)
+
+    def split(self, isep):
+        # Split the line into key, separator padding and value
+        # Usage: split(SEPARATOR)
+        if self.kind == SECTION:
+            return
+
+        left, found, right = self.text.partition(isep)
+        self.lpad = len(left) - len(left.rstrip())
+        self.rpad = len(right) - len(right.lstrip())
+
+        body = self.body
+        if self.kind == COMMENT:
+            # Commented out keys are also parsed: "# key = value"
+            body = body.strip('#').strip()
+        key, found, value = body.partition(isep)
+        self.key = key.strip()
+        if found:
+            self.value = value.strip()
+        else:
+            self.value = None
+
+    def commented(self):
+        # Text of the line without the leading comment characters
+        return self.body.strip('#').strip()
+
+    def counted(self):
+        # Is this line used to guess the indentation and the separator?
+        return self.kind != SECTION and len(self.text) > 3
+
+
+class canalysis(object):
+    # Format of a document: file type, separator padding and indentation
+    # It is computed once for each version of the document, and thrown
+    # away as soon as the document changes (see cskv.analyze)
+    # Only the first SAMPLE_LINES lines are looked at, unless the guess is
+    # not clear enough (see SNIFF_CONFIDENCE and confidence())
+    __slots__ = ('doc', 'version', 'detect', 'conf_type', 'type_margin',
+                 'isep', 'hists', 'margins', 'sampled')
+
+    def __init__(self, doc, detect):
+        # The file type is guessed with "detect(doc)" only when needed, and
+        # it returns [FILE_TYPE, CONFIDENCE]
+        self.doc = doc
+        self.version = doc.version
+        self.detect = detect
+        self.conf_type = None
+        self.type_margin = None
+        self.isep = None
+        self.hists = None
+        self.margins = None
+        self.sampled = False
+
+    @property
+    def ftype(self):
+        if self.conf_type is None:
+            self.conf_type, self.type_margin = self.detect(self.doc)
+        return self.conf_type
+
+    def histograms(self, isep=None):
+        # Count of lines for each indentation and separator padding
+        # Returns {'indent': {BLANKS: COUNT}, 'lpad': {..}, 'rpad': {..}}
+        # (self.sampled tells if they are only for the first lines)
+        if not isep:
+            isep = SEPARATORS[self.ftype]
+        if self.hists is None or isep != self.isep:
+            if self.doc.isep is None:
+                # Only the lines looked at are split (the same way)
+                records = split_records(self.doc.records, isep)
+            else:
+                records = self.doc.split(isep).records
+            hists, complete = pad_histograms(records, SAMPLE_LINES)
+            margins = dict((attr, margin(hists[attr])) for attr in hists)
+            if not complete and min(margins.values()) < SNIFF_CONFIDENCE:
+                hists, complete = pad_histograms(self.doc.records)
+                margins = dict((attr, margin(hists[attr])) for attr in hists)
+            self.hists, self.isep, self.margins = hists, isep, margins
+            self.sampled = not complete
+        return self.hists
+
+    def mode(self, attr, isep=None):
+        # Most common value of "indent", "lpad" or "rpad"
+        # (0 if there is no key/value line at all)
+        hist = self.histograms(isep)[attr]
+        if not hist:
+            return 0
+        return max(sorted(hist), key=hist.get)
+
+    def confidence(self, attr='ftype'):
+        # How clear the guess of the file type, "indent", "lpad" or "rpad"
+        # is, from 0 to 1 (margin over the second best guess)
+        # Usage: analysis.confidence('indent')
+        if attr == 'ftype':
+            return self.ftype and self.type_margin
+        self.histograms()
+        return self.margins[attr]
+
+    @property
+    def indent(self):
+        return self.mode('indent')*' '
+
+    @property
+    def sep(self):
+        return ' '*self.mode('lpad') + SEPARATORS[self.ftype] + \
+            ' '*self.mode('rpad')
+
+
+def pad_histograms(records, limit=None):
+    # Histograms of canalysis.histograms for the lines used for guessing
+    # (see cline.counted), the first "limit" of them if it is given
+    # Returns [HISTOGRAMS, COMPLETE], where COMPLETE is False if it stopped
+    # before the end of the records
+    hists = {'indent': {}, 'lpad': {}, 'rpad': {}}
+    indents, lpads, rpads = hists['indent'], hists['lpad'], hists['rpad']
+    counted = 0
+    for rec in records:
+        if rec.counted():
+            if counted == limit:
+                return hists, False
+            counted += 1
+            indents[rec.indent] = indents.get(rec.indent, 0) + 1
+            lpads[rec.lpad] = lpads.get(rec.lpad, 0) + 1
+            rpads[rec.rpad] = rpads.get(rec.rpad, 0) + 1
+    return hists, True
+
+
+def sample_edges(records, limit, following):
+    # The first "limit" lines used for guessing (see pad_histograms), and
+    # what comes after them, to find out which changes move lines in and
+    # out of them
+    # Returns [INSIDE, USED, NEXT]: the set of records up to the last line
+    # used, the lines used, and the next "following" lines to be used
+    inside, used, ahead = set(), [], []
+    for rec in records:
+        if len(used) < limit:
+            inside.add(rec)
+            if rec.counted():
+                used.append(rec)
+        elif len(ahead) >= following:
+            break
+        elif rec.counted():
+            ahead.append(rec)
+    return inside, used, ahead
+
+
+def guess_bounds(hist, attr, value, olds, news):
+    # Fewest lines with "value" of "attr" in a histogram of pad_histograms,
+    # and most lines with each other value, after removing the "olds" and
+    # adding the "news" lines in any order
+    # Returns [LOWEST, {VALUE: HIGHEST}]
+    hist = dict(hist)
+    lowest = hist.get(value, 0) - \
+        len([1 for rec in olds
+             if rec.counted() and getattr(rec, attr) == value])
+    for rec in news:
+        if rec.counted():
+            val = getattr(rec, attr)
+            hist[val] = hist.get(val, 0) + 1
+    hist.pop(value, None)
+    return lowest, hist
+
+
+def split_records(records, isep):
+    # Split records with a separator while iterating over them
+    for rec in records:
+        rec.split(isep)
+        yield rec
+
+
+def conf_type_votes(records, limit=None):
+    # Lines voting for each file type (see cskv.detect_conf_type): "ini"
+    # counts the lines from the first section on, and "rawe", "rawc" and
+    # "raws" the lines with "=", ":" or " ". With a limit, it stops after
+    # that many lines with keys or sections
+    # Returns [VOTES, COMPLETE], like pad_histograms
+    votes = {'ini': 0, 'rawe': 0, 'rawc': 0, 'raws': 0}
+    seen = 0
+    for rec in records:
+        if rec.kind in (SECTION, KEYVAL):
+            if seen == limit:
+                return votes, False
+            seen += 1
+        if rec.kind == SECTION or votes['ini'] > 0:
+            votes['ini'] += 1
+        if '=' in rec.text:
+            votes['rawe'] += 1
+        elif ':' in rec.text:
+            votes['rawc'] += 1
+        elif ' ' in rec.text:
+            votes['raws'] += 1
+    return votes, True
+
+
+def margin(hist):
+    # Margin of the most common value of a histogram over the second one,
+    # as a fraction of the total (1 for a single value, 0 for none)
+    counts = sorted(hist.values(), reverse=True)
+    if not counts or not counts[0]:
+        return 0.0
+    if len(counts) == 1:
+        return 1.0
+    return float(counts[0] - counts[1]) / sum(counts)
+
+
+class csection(object):
+    # A section of a tokenized document: its header and the lines under it
+    # The lines before the first header (or a whole RAW file) are kept in a
+    # section without header.
+    # Keys are indexed (commented out ones too) so that they can be found
+    # without walking through all the lines of the section.
+    __slots__ = ('name', 'header', 'lines', 'keys', 'sorted_keys')
+
+    def __init__(self, header=None):
+        self.header = header
+        self.name = None
+        if header:
+            self.name = header.key
+        self.lines = []
+        self.keys = {}
+        self.sorted_keys = []
+
+    def indexed(self, rec):
+        # Is the line in the key index? (keys and commented out keys)
+        return rec.kind == KEYVAL or \
+            (rec.kind == COMMENT and rec.body.startswith('#'))
+
+    def index_key(self, rec):
+        # Add a line to the key index
+        self.index_keys([rec])
+
+    def index_keys(self, recs):
+        # Add several lines to the key index at once
+        added = []
+        for rec in recs:
+            if self.indexed(rec):
+                found = self.keys.get(rec.key)
+                if found is None:
+                    self.keys[rec.key] = [rec]
+                    added.append(rec.key)
+                else:
+                    found.append(rec)
+
+        if len(added) > 16:
+            # Two sorted runs: sorting them is only merging them
+            added.sort()
+            self.sorted_keys.extend(added)
+            self.sorted_keys.sort()
+        else:
+            for key in added:
+                bisect.insort(self.sorted_keys, key)
+
+    def unindex_key(self, rec):
+        # Remove a line from the key index
+        recs = self.keys.get(rec.key)
+        if recs and rec in recs:
+            recs.remove(rec)
+            if not recs:
+                del self.keys[rec.key]
+                idx = bisect.bisect_left(self.sorted_keys, rec.key)
+                del self.sorted_keys[idx]
+
+    def unindex_keys(self, recs):
+        # Remove several lines from the key index at once
+        gone = set(recs)
+        emptied = []
+        for key in set(rec.key for rec in recs):
+            recs = self.keys.get(key)
+            if not recs:
+                continue
+            left = [rec for rec in recs if rec not in gone]
+            if left:
+                self.keys[key] = left
+            else:
+                del self.keys[key]
+                emptied.append(key)
+
+        if len(emptied) > 16:
+            self.sorted_keys = [key for key in self.sorted_keys
+                                if key in self.keys]
+        else:
+            for key in emptied:
+                idx = bisect.bisect_left(self.sorted_keys, key)
+                del self.sorted_keys[idx]
+
+    def records(self, start=0, end=None):
+        # The header (if any) and the lines of the section, from "start" to
+        # "end" (all of them by default)
+        if end is None:
+            end = len(self.lines) + bool(self.header)
+        if not self.header:
+            return self.lines[start:end]
+        if end <= start:
+            return []
+        if start:
+            return self.lines[start-1:end-1]
+        return [self.header] + self.lines[:end-1]
+
+    def reindex(self):
+        # Build the key index from scratch, sorting the keys only once
+        keys = self.keys = {}
+        for rec in self.lines:
+            if self.indexed(rec):
+                keys.setdefault(rec.key, []).append(rec)
+        self.sorted_keys = sorted(keys)
+
+    def candidates(self, kstr):
+        # Lines that could start with the key "kstr", in the file order
+        # A line starts with kstr if its key starts with kstr (found in the
+        # sorted keys) or if its key is a prefix of kstr (direct lookups)
+        keys = self.keys
+        found = []
+        for i in xrange(len(kstr)):
+            found.extend(keys.get(kstr[:i], ()))
+
+        sorted_keys = self.sorted_keys
+        idx = bisect.bisect_left(sorted_keys, kstr)
+        while idx < len(sorted_keys) and sorted_keys[idx].startswith(kstr):
+            found.extend(keys[sorted_keys[idx]])
+            idx += 1
+
+        return self.in_order(found)
+
+    def in_order(self, recs):
+        # Sort some lines of the section in the file order
+        # Looking up each line is quadratic, so many of them are sorted
+        # with the positions of all the lines instead
+        if len(recs) < 2:
+            return list(recs)
+        if len(recs) > 16:
+            return sorted(recs, key=line_positions(self.lines).get)
+        return sorted(recs, key=self.lines.index)
+
+
+def line_positions(lines):
+    # {RECORD: INDEX} of a list of lines
+    import itertools
+    return dict(itertools.izip(lines, itertools.count()))
+
+
+class cdoc(object):
+    # Tokenized model of a config file: a list of sections of cline records
+    # Usage: cdoc(LIST_OF_CONFIG_LINES)
+    # Rendering it back with lines() returns exactly the same lines
+
+    def __init__(self, lines):
+        body = csection()
+        body.lines = [cline(line) for line in lines]
+        self.sections = [body]
+        # Section name => list of csection (more than one is an error)
+        self.index = {}
+        self.isep = None
+        self.ini = False
+        # Changes on every edit, see cskv.analyze
+        self.version = 0
+        self.analysis = None
+        # Changed section => its lines before the first change (see diff)
+        self.touched = {}
+
+    def __len__(self):
+        return sum(len(sec.lines) + bool(sec.header) for sec in self.sections)
+
+    @property
+    def records(self):
+        # Iterate over all the lines of the document
+        for sec in self.sections:
+            if sec.header:
+                yield sec.header
+            for rec in sec.lines:
+                yield rec
+
+    def structure(self, ini):
+        # Split the lines in sections (only for INI files)
+        if ini and not self.ini:
+            records = list(self.records)
+            self.sections = [csection()]
+            self.index = {}
+            for rec in records:
+                if rec.kind == SECTION:
+                    self.add_section(rec)
+                else:
+                    self.sections[-1].lines.append(rec)
+            self.ini = True
+            self.touched = {}
+            if self.isep:
+                for sec in self.sections:
+                    sec.reindex()
+        return self
+
+    def split(self, isep):
+        # Split all key/values with the given separator (only once)
+        if isep != self.isep:
+            for rec in self.records:
+                rec.split(isep)
+            self.isep = isep
+            for sec in self.sections:
+                sec.reindex()
+        return self
+
+    def new_line(self, text):
+        # Create a record which is already split like the rest
+        return cline(text, self.isep)
+
+    def add_section(self, header):
+        # Append a new section at the end of the document
+        # Usage: add_section(SECTION_NAME or HEADER_RECORD)
+        if not isinstance(header, cline):
+            header = self.new_line('[' + header + ']')
+        sec = csection(header)
+        self.sections.append(sec)
+        self.touched[sec] = []
+        self.version += 1
+        self.index.setdefault(sec.name, []).append(sec)
+        return sec
+
+    def get_sections(self, name):
+        # List of sections with a given name
+        return self.index.get(name, [])
+
+    def offset(self, sec):
+        # Index of the first line of a section in the whole document
+        idx = 0
+        for isec in self.sections:
+            if isec is sec:
+                break
+            idx += len(isec.lines) + bool(isec.header)
+        return idx
+
+    def touch(self, sec):
+        # Keep the lines of a section before its first change (see diff)
+        if sec not in self.touched:
+            self.touched[sec] = sec.records()
+
+    def mark(self):
+        # Take the current lines as the original ones (see diff)
+        self.touched = {}
+
+    def replace(self, sec, old, new):
+        # Replace a line of a section, keeping the index up to date
+        self.touch(sec)
+        sec.lines[sec.lines.index(old)] = new
+        sec.unindex_key(old)
+        sec.index_key(new)
+        self.version += 1
+
+    def replace_many(self, sec, pairs):
+        # Same as replace() for a list of [old, new] lines, but finding
+        # all of them in one pass
+        if not pairs:
+            return
+        self.touch(sec)
+        position = line_positions(sec.lines)
+        for old, new in pairs:
+            sec.lines[position[old]] = new
+        sec.unindex_keys([old for old, new in pairs])
+        sec.index_keys([new for old, new in pairs])
+        self.version += 1
+
+    def insert(self, sec, idx, new):
+        # Insert a line in a section, keeping the index up to date
+        self.touch(sec)
+        sec.lines.insert(idx, new)
+        sec.index_key(new)
+        self.version += 1
+
+    def splice(self, sec, idx, news):
+        # Insert several lines at once in a section
+        self.touch(sec)
+        sec.lines[idx:idx] = news
+        sec.index_keys(news)
+        self.version += 1
+
+    def remove(self, sec, old):
+        # Remove a line from a section, keeping the index up to date
+        self.touch(sec)
+        del sec.lines[sec.lines.index(old)]
+        sec.unindex_key(old)
+        self.version += 1
+
+    def remove_many(self, sec, olds):
+        # Same as remove() for a list of lines, in one pass
+        if not olds:
+            return
+        self.touch(sec)
+        gone = set(olds)
+        sec.lines[:] = [rec for rec in sec.lines if rec not in gone]
+        sec.unindex_keys(olds)
+        self.version += 1
+
+    def find(self, section, key):
+        # Lines defining a key (exact match), commented out ones included
+        # Usage: find(SECTION, KEY)
+        if self.ini:
+            secs = self.get_sections(section)
+        else:
+            secs = self.sections[:1]
+        found = []
+        for sec in secs:
+            recs = sec.keys.get(key.strip(), [])
+            found.extend(sec.in_order(recs))
+        return found
+
+    def lines(self):
+        # Render the document back into a list of lines
+        return [rec.text for rec in self.records]
+
+    def diff(self, name, offset=0, context=3, before=None, after=None):
+        # Unified diff of the changes since the document was read (or since
+        # mark), as a list of lines. Only the changed sections are compared,
+        # and the lines which were not changed are the same records in
+        # both, so it takes one pass over them (no diff algorithm). The
+        # context lines are also taken from the next and previous sections.
+        # offset: number of lines of the file before the document
+        # before, after: lines of the file just before and after the
+        # document, for the context
+        # Usage: diff(FILE_NAME)
+        # Pieces of the document: changes (see edit_ops) and runs of lines
+        # which did not change (see context_ops)
+        before, after = before or [], after or []
+        pieces = [[len(before), offset - len(before), offset - len(before),
+                   lambda start, end: before[start:end]]]
+        old_idx = new_idx = offset
+        for sec in self.sections:
+            old = self.touched.get(sec)
+            if old is None:
+                size = len(sec.lines) + bool(sec.header)
+                pieces.append([size, old_idx, new_idx,
+                               lambda start, end, sec=sec:
+                               [rec.text for rec in sec.records(start, end)]])
+                old_idx += size
+                new_idx += size
+                continue
+
+            # Only the lines from the first to the last change are compared
+            new = sec.records()
+            first, old_end, new_end = 0, len(old), len(new)
+            while first < min(old_end, new_end) and old[first] is new[first]:
+                first += 1
+            while old_end > first and new_end > first and \
+                    old[old_end-1] is new[new_end-1]:
+                old_end -= 1
+                new_end -= 1
+            pieces.append([first, old_idx, new_idx,
+                           lambda start, end, new=new:
+                           [rec.text for rec in new[start:end]]])
+            pieces.append(edit_ops(old[first:old_end], new[first:new_end],
+                                   old_idx + first, new_idx + first))
+            pieces.append([len(new) - new_end, old_idx + old_end,
+                           new_idx + new_end,
+                           lambda start, end, new=new, skip=new_end:
+                           [rec.text for rec in new[skip+start:skip+end]]])
+            old_idx += len(old)
+            new_idx += len(new)
+        pieces.append([len(after), old_idx, new_idx,
+                       lambda start, end: after[start:end]])
+
+        out = []
+        for hunk in diff_hunks(context_ops(pieces, context), context):
+            if not out:
+                out = ['--- ' + name, '+++ ' + name]
+            out.extend(hunk)
+        return out
+
+
+def context_ops(pieces, context=3):
+    # Operations of edit_ops for a whole document, from its pieces: lists
+    # of operations, and runs of unchanged lines [NUMBER, OLD_LINE,
+    # NEW_LINE, FUNCTION], where FUNCTION(START, END) returns the text of
+    # the lines of the run from START to END. Only "context" unchanged
+    # lines are kept around the changes, with None where lines are left
+    # out (so that diff_hunks does not join the changes around them).
+    # Usage: diff_hunks(context_ops(PIECES, 3), 3)
+    ops = []
+    runs = []
+    for piece in pieces + [None]:
+        if piece and not isinstance(piece[-1], list):
+            if piece[0]:
+                runs.append(piece)
+            continue
+        if piece is not None and not [1 for op in piece if op[0] != ' ']:
+            # Compared, but not changed
+            if piece:
+                runs.append([len(piece), piece[0][2], piece[0][3],
+                             lambda start, end, piece=piece:
+                             [op[1] for op in piece[start:end]]])
+            continue
+
+        # Unchanged lines between two changes (or the start or end)
+        total = sum(run[0] for run in runs)
+        keep = [[0, 0], [total, total]]
+        if ops:
+            keep[0][1] = min(context, total)
+        if piece is not None:
+            keep[1][0] = max(total - context, keep[0][1])
+        if keep[0][1] < keep[1][0] and ops and piece is not None:
+            keep.insert(1, None)
+        for span in keep:
+            if span is None:
+                ops.append(None)
+                continue
+            lo, hi = span
+            pos = 0
+            for size, old_idx, new_idx, texts in runs:
+                start, end = max(lo - pos, 0), min(hi - pos, size)
+                if start < end:
+                    for idx, text in enumerate(texts(start, end), start):
+                        ops.append([' ', text, old_idx + idx,
+                                    new_idx + idx])
+                pos += size
+        runs = []
+        if piece is not None:
+            ops.extend(piece)
+    return ops
+
+
+def edit_ops(old, new, old_idx=0, new_idx=0):
+    # Line by line changes from a list of records to another one, where the
+    # records which were not changed are the same objects (in the same
+    # order): [[' '|'-'|'+', TEXT, OLD_LINE, NEW_LINE], ..]
+    # A line replaced by the same text is not a change.
+    # Usage: edit_ops(OLD_RECORDS, NEW_RECORDS)
+    old_ids = set(id(rec) for rec in old)
+    new_ids = set(id(rec) for rec in new)
+    ops = []
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if i < len(old) and j < len(new) and (old[i] is new[j] or (
+                id(old[i]) not in new_ids and id(new[j]) not in old_ids and
+                old[i].text == new[j].text)):
+            ops.append([' ', new[j].text, old_idx + i, new_idx + j])
+            i += 1
+            j += 1
+        elif i < len(old) and id(old[i]) not in new_ids:
+            ops.append(['-', old[i].text, old_idx + i, new_idx + j])
+            i += 1
+        else:
+            ops.append(['+', new[j].text, old_idx + i, new_idx + j])
+            j += 1
+    return ops
+
+
+def diff_hunks(ops, context=3):
+    # Hunks of a unified diff (lists of lines) from edit_ops, with
+    # "context" unchanged lines around the changes (None in the operations
+    # stands for left out unchanged lines, see context_ops)
+    # Usage: for hunk in diff_hunks(OPERATIONS, 3)
+    changes = [idx for idx, op in enumerate(ops) if op and op[0] != ' ']
+    groups = []
+    for idx in changes:
+        if groups and idx - groups[-1][1] <= 2 * context:
+            groups[-1][1] = idx
+        else:
+            groups.append([idx, idx])
+
+    for first, last in groups:
+        hunk = ops[max(0, first - context):last + context + 1]
+        old_len = sum(1 for op in hunk if op[0] != '+')
+        new_len = sum(1 for op in hunk if op[0] != '-')
+        lines = ['@@ -' + diff_range(hunk[0][2], old_len) + ' +' +
+                 diff_range(hunk[0][3], new_len) + ' @@']
+        lines.extend(op[0] + op[1] for op in hunk)
+        yield lines
+
+
+def diff_range(start, length):
+    # Line range of a hunk of a unified diff (start counted from 0)
+    # Usage: diff_range(START, LENGTH)
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        return str(start) + ',0'
+    return str(start + 1) + ',' + str(length)
+
+
+class csnapshot(object):
+    # What read-only operations need to know about a file, without its
+    # lines: type, indentation and separator padding (None if unknown),
+    # sections (name and line index), key/values (see keyval_map), the
+    # content hash of each section (see section_hash) and the paths of its
+    # include directives (see include_directives)
+    # Usage: csnapshot(FTYPE, INDENT, LPAD, RPAD, SECTIONS, KEYVALS, HASH)
+    __slots__ = ('ftype', 'indent', 'lpad', 'rpad', 'sections', 'keyvals',
+                 'hash', 'hashes', 'includes')
+
+    def __init__(self, ftype, indent, lpad, rpad, sections, keyvals,
+                 hash=None, hashes=None, includes=None):
+        from collections import OrderedDict
+        self.ftype = ftype
+        self.indent = indent
+        self.lpad = lpad
+        self.rpad = rpad
+        self.sections = sections
+        self.keyvals = OrderedDict(keyvals)
+        self.hash = hash
+        if hashes is None:
+            hashes = [[name, section_hash(keyvals)]
+                      for name, keyvals in self.keyvals.items()]
+        self.hashes = dict(hashes)
+        self.includes = includes or []
+
+    def dump(self):
+        # Plain types only, so that it can be stored with marshal
+        return {'ftype': self.ftype, 'indent': self.indent,
+                'lpad': self.lpad, 'rpad': self.rpad,
+                'sections': self.sections, 'hash': self.hash,
+                'keyvals': self.keyvals.items(),
+                'hashes': self.hashes.items(), 'includes': self.includes}
+
+
+def include_files(file_name, includes):
+    # Files included by a file, given the paths of its include directives
+    # (see include_directives): relative paths are relative to the
+    # directory of the file, glob patterns are expanded and directories
+    # give all their files (sorted, without hidden or backup files)
+    # Usage: include_files(FILE_NAME, LIST_OF_PATHS)
+    import glob
+    directory = os.path.dirname(os.path.abspath(file_name))
+    paths = []
+    for path in includes:
+        path = os.path.join(directory, os.path.expanduser(path))
+        paths.extend(sorted(glob.glob(path)))
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if not name.startswith('.') and not name.endswith('~') and \
+                        os.path.isfile(os.path.join(path, name)):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+
+def include_directives(doc):
+    # Paths (or glob patterns) of the include directives of a document, in
+    # file order (see include_paths)
+    # Usage: include_directives(CDOC)
+    includes = []
+    for rec in doc.records:
+        includes.extend(include_paths(rec) or [])
+    return includes
+
+
+def include_paths(rec):
+    # Paths (or glob patterns) of a line with an include directive:
+    # "Include PATH.." (sshd_config), "include = PATH" (samba), "!include
+    # PATH" and "!includedir DIRECTORY" (MySQL); None for other lines
+    # Usage: include_paths(CLINE)
+    body = rec.body
+    if rec.kind == SECTION or body[:1] not in ('i', 'I', '!'):
+        return None
+    for directive in INCLUDE_DIRECTIVES:
+        size = len(directive)
+        if body[:size].lower() == directive and \
+                body[size:size+1] in (' ', '\t', '='):
+            return body[size:].strip().lstrip('=').split()
+    return None
+
+
+def section_hash(keyvals):
+    # Content hash of the key/values of a section ({KEY: VALUE}, see
+    # keyval_map): the same for sections which only differ in comments,
+    # blanks or the order of the keys
+    # Usage: section_hash({KEY: VALUE})
+    import hashlib
+    return hashlib.sha1(repr(sorted(keyvals.items()))).hexdigest()
+
+
+# Size of the entries of each cache directory used by this process: the
+# size after the last look at the directory, plus the entries written
+# since then (see ccache.evict)
+cache_totals = {}
+
+
+class ccache(object):
+    # Directory with a snapshot (csnapshot) of each analyzed file
+    # Entries are found by the identity of the file (path, inode, size and
+    # modification time in ns) and verified with the hash of its content.
+    # The least recently used entries are removed above max_size bytes.
+    # Usage: ccache(DIRECTORY, MAX_SIZE)
+
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        if max_size is None:
+            self.max_size = CACHE_SIZE
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def identity(self, file_name):
+        # See file_identity
+        return file_identity(file_name)
+
+    def entry(self, identity):
+        # File of the cache entry for a file identity
+        import hashlib
+        name = hashlib.sha1(repr(identity)).hexdigest()
+        return os.path.join(self.directory, name + '.cache')
+
+    def get(self, file_name):
+        # Snapshot of a file, or None if it is missing or out of date
+        # Usage: get(FILE_NAME)
+        identity = self.identity(file_name)
+        entry = self.entry(identity)
+        try:
+            with open(entry, 'rb') as infile:
+                data = marshal.load(infile)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        # Truncated or foreign entries are missing ones too
+        fields = data.get('snapshot') if isinstance(data, dict) else None
+        if not isinstance(fields, dict) or \
+                data.get('version') != CACHE_VERSION or \
+                data.get('identity') != identity or \
+                fields.get('hash') != file_hash(file_name):
+            return None
+        try:
+            snap = csnapshot(**fields)
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+        # Used now: the last one to be evicted
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return snap
+
+    def put(self, file_name, snapshot, identity=None):
+        # Store the snapshot of a file (the identity of the file is taken
+        # before reading it, if given)
+        # Usage: put(FILE_NAME, CSNAPSHOT)
+        if identity is None:
+            identity = self.identity(file_name)
+        data = {'version': CACHE_VERSION, 'identity': identity,
+                'snapshot': snapshot.dump()}
+        dump = marshal.dumps(data)
+        write_atomic(self.entry(identity), dump)
+
+        # The directory is only looked at again when the entries written
+        # since the last time could be over the limit
+        total = cache_totals.get(self.directory)
+        if total is None or total + len(dump) > self.max_size:
+            self.evict()
+        else:
+            cache_totals[self.directory] = total + len(dump)
+
+    def evict(self):
+        # Remove the least recently used entries above the size limit,
+        # down to CACHE_EVICT times the limit
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                entry = os.path.join(self.directory, name)
+                try:
+                    estat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append([estat.st_mtime, estat.st_size, entry])
+
+        total = sum(size for mtime, size, entry in entries)
+        target = self.max_size
+        if total > self.max_size:
+            target = int(self.max_size * CACHE_EVICT)
+        for mtime, size, entry in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+        cache_totals[self.directory] = total
+
+
 class cskv(object):
     # Functions to handle the config file
     # Usage: cskv(OPTIONS_DICTIONARY)
@@ -46,20 +1129,23 @@ class cskv(object):
 
         self.kwargs = kwargs
 
+        # Time of each phase, with the stats option (see cstats)
+        self.stats = None
+        if kwargs.get('stats'):
+            self.stats = cstats()
+
         # Running as a module does not have default verbosity
         if 'verbosity' not in self.kwargs:
             self.kwargs['verbosity'] = 0
 
-        # If we have a file to compare with
-        try:
-            abs_path = os.path.abspath(kwargs['compare'])
-            self.icompare = self.content(abs_path)
-        except Exception as e:
-            self.icompare = None
-            pass
+        # If we have a file to compare with (with a cache directory, or
+        # lazy, it is only read when needed)
+        if not kwargs.get('cache_dir') and not kwargs.get('lazy'):
+            self.load_compare()
 
         # Clear these option/variables
-        none_opts = ['section', 'key', 'value', 'indent', 'sep', 'test']
+        none_opts = ['section', 'key', 'value', 'indent', 'sep', 'test',
+                     'diff']
         for opt in none_opts:
             if opt not in self.kwargs:
                 self.kwargs[opt] = None
@@ -68,7 +1154,7 @@ class cskv(object):
             self.kwargs['extra_conf'] = []
 
         # Supported file formats and their key/value separators
-        self.separators = {'ini': '=', 'rawe': '=', 'rawc': ':', 'raws': ' '}
+        self.separators = SEPARATORS
 
         self.vprt(3, '')
         self.vprt(3, '   Running cskv with the following arguments')
@@ -78,9 +1164,57 @@ class cskv(object):
         self.vprt(3, '   ------------------------------------')
         self.vprt(3, '')
 
-        # File content as a list of lines
-        self.icontent = self.content(kwargs['config_file'])
-        self.iftype = self.guess_conf_type(self.icontent)
+        # The streaming modes never read the whole file (see process_stream,
+        # process_section and process_get)
+        # or when asked to (lazy)
+        if not self.kwargs.get('stream') and not self.kwargs.get('mmap') \
+                and not self.kwargs.get('cache_dir') and \
+                not self.kwargs.get('lazy') and \
+                self.kwargs.get('get') is None and \
+                self.kwargs.get('where') is None:
+            self.load()
+
+    @timed('read')
+    def load(self, lines=None, doc=None):
+        # File content as a list of lines, and its tokenized document
+        # Both can be given if they are already known (see cserver)
+        # Usage: load()
+        if lines is None:
+            lines = self.content(self.config_file)
+        self.icontent = lines
+        if doc is None:
+            doc = cdoc(lines)
+        self.doc = doc
+        self.iftype = self.guess_conf_type(self.doc)
+        self.doc.split(self.separators[self.iftype])
+
+    def load_compare(self):
+        # Content of the file to compare with, or None
+        # Usage: load_compare()
+        try:
+            abs_path = os.path.abspath(self.kwargs['compare'])
+            self.icompare = self.content(abs_path)
+        except Exception as e:
+            self.icompare = None
+            pass
+
+    def __getattr__(self, name):
+        # The files are read the first time their content is needed
+        if name in ('icontent', 'doc', 'iftype') and \
+                'config_file' in self.__dict__:
+            self.load()
+            return self.__dict__[name]
+        elif name == 'icompare' and 'kwargs' in self.__dict__:
+            self.load_compare()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def phase(self, name):
+        # Context manager measuring a phase with the stats option
+        # Usage: with self.phase('render'): ...
+        if self.__dict__.get('stats') is None:
+            return NO_PHASE
+        return self.stats.phase(name)
 
     def vprt(self, iverb, string):
         # Control the verbosity of the output:
@@ -102,31 +1236,85 @@ class cskv(object):
             config_content.append(line.rstrip())
         return config_content
 
+    def read_lines(self, file_name):
+        # Same as content(), but a generator reading the file in chunks
+        # Usage: for line in read_lines(FILE_NAME)
+        print_me = self.vprt(3, "   Streaming content of file " + file_name)
+        if print_me:
+            print print_me
+
+        with open(file_name, 'r') as infile:
+            rest = ''
+            for chunk in iter(lambda: infile.read(CHUNK_SIZE), ''):
+                lines = (rest + chunk).split('\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line.rstrip()
+            if rest:
+                yield rest.rstrip()
+
+    def tokens(self, config):
+        # Return the tokenized document (cdoc) of a list of lines
+        # Usage: tokens(LIST_OF_CONFIG_LINES)
+        if isinstance(config, cdoc):
+            return config
+        elif config is self.__dict__.get('icontent') and \
+                'doc' in self.__dict__:
+            return self.doc
+        return cdoc(config)
+
+    def analyze(self, config=None):
+        # Format of the file (canalysis): type, separator and indentation
+        # It is only guessed again if the content changed in the meantime
+        # Usage: analyze(LIST_OF_CONFIG_LINES), analyze() for config_file
+        if config is None:
+            doc = self.doc
+        else:
+            doc = self.tokens(config)
+
+        analysis = doc.analysis
+        if analysis is None or analysis.version != doc.version:
+            analysis = canalysis(doc, self.detect_conf_type)
+            doc.analysis = analysis
+        return analysis
+
+    @property
+    def analysis(self):
+        # Format of the config file (see analyze)
+        return self.analyze()
+
+    @timed('detect')
     def guess_conf_type(self, config):
         # Guess the config file type ini/raw/rawc/raws
         # Usage: guess_conf_type(LIST_OF_CONFIG_LINES)
-        guess_ini, guess_rawe, guess_rawc, guess_raws = 0, 0, 0, 0
+        return self.analyze(config).ftype
+
+    def detect_conf_type(self, doc):
+        # Guess the file type going through the lines (see guess_conf_type)
+        # Only the first SAMPLE_LINES lines with keys or sections are looked
+        # at, unless that is not clear enough (see SNIFF_CONFIDENCE)
+        # Returns [FILE_TYPE, CONFIDENCE]
         guess_ini_file = False
         ftype = None
 
         if self.config_file.endswith(('.ini', '.INI')):
             guess_ini_file = True
 
-        for line in config:
-            if re.match('\[.*\]', line):
-                guess_ini += 1
-            if guess_ini > 0:
-                if not re.match('\[.*\]', line):
-                    guess_ini += 1
-
-        if guess_ini > 1:
-            if guess_ini_file:
-                ftype = 'ini'
-            else:
-                # The configuration has "INI" format but no .ini file
-                # This happens always with the pipeline lines
-                # because they are not read from a file
-                ftype = 'ini'
+        votes, complete = conf_type_votes(doc.records, SAMPLE_LINES)
+        raws = {'rawe': votes['rawe'], 'rawc': votes['rawc'],
+                'raws': votes['raws']}
+        if not complete and votes['ini'] <= 1 and \
+                (guess_ini_file or margin(raws) < SNIFF_CONFIDENCE):
+            votes, complete = conf_type_votes(doc.records)
+            raws = {'rawe': votes['rawe'], 'rawc': votes['rawc'],
+                    'raws': votes['raws']}
+
+        if votes['ini'] > 1:
+            # The configuration has "INI" format, also without .ini file
+            # This happens always with the pipeline lines
+            # because they are not read from a file
+            ftype = 'ini'
+            confidence = 1.0
         else:
             if guess_ini_file:
                 msg = 'ERROR: the file name ' + self.config_file + \
@@ -137,46 +1325,25 @@ class cskv(object):
                     print print_me
                 sys.exit()
 
-            for line in config:
-                if re.match('.*=.*', line):
-                    guess_rawe += 1
-                elif re.match('.*:.*', line):
-                    guess_rawc += 1
-                elif re.match('.* .*', line):
-                    guess_raws += 1
-
-            raws = {'rawe': guess_rawe, 'rawc': guess_rawc, 'raws': guess_raws}
             ftype = max(raws, key=raws.get)
+            confidence = margin(raws)
 
         msg = '   The file "' + self.config_file + '" seems to have "' + \
-            ftype + '" syntax.'
+            ftype + '" syntax (confidence ' + '%.2f' % confidence + ').'
 
         print_me = self.vprt(3, msg)
         if print_me:
             print print_me
 
-        return ftype
+        return ftype, confidence
 
+    @timed('guess')
     def guess_separator(self, config):
         # Guess key/value separator with spaces (the most common one)
         # Usage: guess_separator(LIST_OF_CONFIG_LINES)
 
         isep = self.separators[self.iftype]
-
-        tmplst_left = []
-        tmplst_right = []
-        for line in config:
-            if not re.match('^\[.*\]', line) and len(line) > 3:
-                left = line.split(isep)[0]
-                right = isep.join(line.split(isep)[1:])
-                l_spaces = len(left) - len(left.rstrip())
-                r_spaces = len(right) - len(right.lstrip())
-
-                tmplst_left.append(l_spaces)
-                tmplst_right.append(r_spaces)
-
-        l_pad = max(set(tmplst_left), key=tmplst_left.count)
-        r_pad = max(set(tmplst_right), key=tmplst_right.count)
+        l_pad, r_pad = self.separator_pads(config)
         sep = ' '*l_pad + isep + ' '*r_pad
 
         msg = '   The separator is |KEY"' + sep + '"VALUE|'
@@ -185,16 +1352,19 @@ class cskv(object):
             print print_me
         return sep
 
+    def separator_pads(self, config):
+        # Most common number of blanks at both sides of the separator
+        # Usage: separator_pads(LIST_OF_CONFIG_LINES)
+        isep = self.separators[self.iftype]
+        analysis = self.analyze(config)
+        return analysis.mode('lpad', isep), analysis.mode('rpad', isep)
+
+    @timed('guess')
     def guess_indent(self, config):
         # Guess the most common indentation for non section lines
         # Usage: guess_indent(LIST_OF_CONFIG_LINES)
-        tmplst = []
-        for line in config:
-            if not re.match('^\[.*\]', line) and len(line) > 3:
-                l_spaces = len(line) - len(line.lstrip())
-                tmplst.append(l_spaces)
-
-        indent = max(set(tmplst), key=tmplst.count)
+        isep = self.separators[self.iftype]
+        indent = self.analyze(config).mode('indent', isep)
 
         msg = '   The autoindentation detected ' + str(indent) + ' blanks'
         print_me = self.vprt(3, msg)
@@ -203,56 +1373,46 @@ class cskv(object):
 
         return indent*' '
 
-    def section_range(self, config, section):
-        # Find the range of indexes in a list of lines where an entry
-        # could be added (beginning and end of section in a INI)
-        # Usage: section_range(LIST_OF_CONFIG_LINES,SECTION)
-
-        # Find the list index of the line matching our [section]
+    def find_section(self, config, section):
+        # Find the section (csection) where an entry could be added
+        # Returns None if the section is missing or the file is not INI
+        # Usage: find_section(LIST_OF_CONFIG_LINES,SECTION)
         if not section:
             section = ''
-        section_regex = re.compile('^\[' + section + '\]')
-        section_idx = [i for i, item in enumerate(config)
-                       if re.match(section_regex, item)]
+        doc = self.tokens(config).structure(self.iftype == 'ini')
+        sections = doc.get_sections(section)
 
-        ftype = self.iftype
-        if len(section_idx) == 0 or ftype != "ini":
+        if len(sections) == 0 or self.iftype != "ini":
             # Section not in file or not "INI" type ==> we'll append later
             msg = '  Waring: Section "' + section + '" missing in file, ' +\
                 'creating it.'
             print_me = self.vprt(2, msg)
             if print_me:
                 print print_me
-            start_idx, end_idx = None, None
+            return None
 
-        elif len(section_idx) > 1:
+        elif len(sections) > 1:
             # The section was found multiple times (Potential error!!)
-            duplicate_sections = [item for i, item in enumerate(content)
-                                  if re.match(section_regex, item)]
-            msg = 'ERROR: more than one ' + section + ' sections found:' +\
-                  '      ', duplicate_sections, ' on indexes ', section_idx
+            msg = 'ERROR: more than one [' + section + '] sections found' +\
+                  ' on indexes ' + str([doc.offset(sec) for sec in sections])
             print_me = self.vprt(1, msg)
             if print_me:
                 print print_me
-            sys.exit()
+            sys.exit(1)
 
-        else:
-            start_idx = section_idx[0] + 1
-
-        if start_idx:
-            # Also find the index of the last line in the section
-            section_idx = [i for i, item in enumerate(config)
-                           if re.match(section_regex, item)][0]
-            for i, line in enumerate(config):
-                if i > section_idx:
-                    if re.match('^\[.*\]', line):
-                        end_idx = i-1
-                        break
+        return sections[0]
 
-            try:
-                end_idx
-            except Exception as e:
-                end_idx = len(config)-1
+    def section_range(self, config, section):
+        # Find the range of indexes in a list of lines where an entry
+        # could be added (beginning and end of section in a INI)
+        # Usage: section_range(LIST_OF_CONFIG_LINES,SECTION)
+        doc = self.tokens(config)
+        sec = self.find_section(doc, section)
+
+        start_idx, end_idx = None, None
+        if sec:
+            start_idx = doc.offset(sec) + 1
+            end_idx = start_idx + len(sec.lines) - 1
 
         if start_idx and end_idx:
             msg = '   The entry will be parsed between lines ' + \
@@ -265,126 +1425,391 @@ class cskv(object):
             print print_me
         return [start_idx, end_idx]
 
+    @timed('lookup')
+    def target_section(self, doc, section, create=True):
+        # Section object where the key will be looked for. For RAW files
+        # this is the whole file. Missing INI sections are appended.
+        # Usage: target_section(CDOC,SECTION)
+        ftype = self.iftype
+        doc.structure(ftype == 'ini').split(self.separators[ftype])
+
+        if ftype == 'ini' and not section:
+            print 'ERROR: parsing INI files requires to specify a section'
+            print '       use the "-s" flag'
+            sys.exit(1)
+
+        sec = self.find_section(doc, section)
+        if not sec and ftype != 'ini':
+            sec = doc.sections[0]
+        elif not sec and create:
+            sec = doc.add_section(section)
+
+        if ftype != "ini" and section:
+            msg = '  Warning: [' + section + '] given, but our file "' + \
+                  self.config_file + '" does not have INI format'
+            self.vprt(2, msg)
+
+        return sec
+
+    @timed('lookup')
+    def key_candidates(self, sec, kstr):
+        # Lines of a section that could start with the key, in file order
+        # Keys that cannot be found in the index are matched line by line
+        if kstr and not kstr.startswith(('#', ';', '[')):
+            return sec.candidates(kstr)
+        return list(sec.lines)
+
     def insert(self, section, key, value=''):
         # Insert a key/value on the right place on config file
         # Returns a new "content" list of lines
         # Usage: insert(SECTION,KEY,VALUE)
+        self.insert_doc(self.doc, section, key, value)
+        return self.doc.lines()
 
-        content = self.icontent
-        ftype = self.iftype
+    @timed('edit')
+    def insert_doc(self, doc, section, key, value='', indent=None,
+                   sep=None):
+        # Same as insert(), but it works directly on a tokenized document
+        # and it does not render it back into lines
+        # The indent and separator can be given when the document is only a
+        # part of the file (otherwise they are guessed on the document)
+        # Usage: insert_doc(CDOC,SECTION,KEY,VALUE,INDENT,SEPARATOR)
+
+        sec = self.target_section(doc, section)
 
         # Was the indent provided on command line?
         if self.kwargs['indent'] and self.kwargs['indent'] != 'a':
             indent = self.kwargs['indent']
-        else:
-            indent = self.guess_indent(content)
+        elif indent is None:
+            indent = self.guess_indent(doc)
 
         if self.kwargs['sep']:
             sep = self.kwargs['sep']
-        else:
-            sep = self.guess_separator(content)
+        elif sep is None:
+            sep = self.guess_separator(doc)
 
-        idxs = self.section_range(content, section)
+        new_line = doc.new_line(indent + key + sep + value)
+        kstr = key.strip()
         matched = False
-        if not idxs[0] and ftype != 'ini':
-            idxs = [0, len(content)-1]
-        elif not idxs[0] and ftype == 'ini' and section:
-            content.append('['+section+']')
-            idxs = [len(content)-2, len(content)-1]
+        replaces = []
 
-        if ftype != "ini" and section:
-            msg = '  Warning: [' + section + '] given, but our file "' + \
-                  self.config_file + '" does not have INI format'
-            self.vprt(2, msg)
+        # Here comes the actual parsing part
+        # We will only work on the lines of the section with a similar key
+        for rec in self.key_candidates(sec, kstr):
+            lstr = rec.body
+            # The key is uncommented => set it
+            if lstr.startswith(kstr):
+                if not matched:
+                    replaces.append([rec, new_line])
+                    matched = True
+                else:
+                    replaces.append([rec, doc.new_line('# ' + rec.text)])
+            # The key is commented out => set it
+            elif lstr.startswith('#') and not matched:
+                # The line starts with KEY+space or KEY+SEPARATOR
+                if rec.commented().startswith((kstr+' ', kstr+sep)):
+                    replaces.append([rec, new_line])
+                    matched = True
+        doc.replace_many(sec, replaces)
 
-        start_idx, end_idx = idxs
+        if not matched:
+            # Append it after the last non blank line of the section
+            idx = len(sec.lines)
+            while idx > 0 and sec.lines[idx-1].body == "":
+                idx = idx - 1
+            doc.insert(sec, idx, new_line)
+
+        return doc
+
+    def append_idx(self, sec):
+        # Index after the last non blank line of a section
+        idx = len(sec.lines)
+        while idx > 0 and sec.lines[idx-1].body == "":
+            idx = idx - 1
+        return idx
+
+    @timed('edit')
+    def merge(self, doc, skvs):
+        # Insert a list of [section, key, value] in one batch
+        # The result is the same as calling insert_doc() for each of them,
+        # but the changes are grouped by section, the indentation and the
+        # separator are guessed only once, and the missing keys are added
+        # at once at the end of each section.
+        # Usage: merge(CDOC, LIST_OF_SKV)
+        ftype = self.iftype
+        doc.structure(ftype == 'ini').split(self.separators[ftype])
+        if not skvs:
+            return doc
+
+        # Group by section and key (the last value wins), keeping the order
+        from collections import OrderedDict
+        groups = OrderedDict()
+        for section, key, value in skvs:
+            if ftype != 'ini':
+                section = None
+            if section not in groups:
+                groups[section] = OrderedDict()
+            groups[section][key.strip()] = [key, value]
+
+        plan = self.merge_plan(doc, groups)
+        if plan is None:
+            # Some keys can not be handled in batch, go one by one
+            for section, key, value in skvs:
+                self.insert_doc(doc, section, key, value)
+            return doc
+
+        for section, replaces, news in plan:
+            sec = self.target_section(doc, section)
+            doc.replace_many(sec, replaces)
+            if news:
+                doc.splice(sec, self.append_idx(sec), news)
+
+        return doc
+
+    def merge_batches(self, doc, skvs, size):
+        # Same as merge(), but for an iterable of [section, key, value]
+        # (see extra_stream), merged in batches of "size", so that only one
+        # batch is in memory. The progress is printed (to stderr) after
+        # each batch when running from the command line.
+        # Usage: merge_batches(CDOC, ITERABLE_OF_SKV, 10000)
+        import itertools
+        skvs = iter(skvs)
+        batches, merged = 0, 0
+        batch = list(itertools.islice(skvs, size))
+        # Also without extra config, like merge()
+        self.merge(doc, batch)
+        while batch:
+            batches += 1
+            merged += len(batch)
+            if self.kwargs.get('interactive'):
+                print >> sys.stderr, 'Batch ' + str(batches) + ': ' + \
+                    str(merged) + ' key/values merged into ' + \
+                    self.config_file
+            batch = list(itertools.islice(skvs, size))
+            if batch:
+                self.merge(doc, batch)
+        return doc
+
+    def merge_plan(self, doc, groups):
+        # Find out what merge() has to change, without changing anything
+        # Returns a list of [section, [[old, new], ..], [new_lines]]
+        # or None if the batch would not give the same result as inserting
+        # the keys one by one
+        for section in groups:
+            kstrs = sorted(groups[section])
+            for i, kstr in enumerate(kstrs):
+                if not kstr or kstr.startswith(('#', ';', '[')):
+                    return None
+                # A key which is a prefix of another one could match the
+                # line of the latter
+                if i + 1 < len(kstrs) and kstrs[i+1].startswith(kstr):
+                    return None
 
-        new_line = indent + key + sep + value
+        if self.kwargs['indent'] and self.kwargs['indent'] != 'a':
+            indent = self.kwargs['indent']
+        else:
+            indent = self.guess_indent(doc)
 
-        # Here comes the actual parsing part
-        for i, line in enumerate(content):
-            # Strip spaces from line and key
-            lstr = line.strip()
-            kstr = key.strip()
-            # Also strip comments and extra spaces from line
-            lstrcs = lstr.strip('#').strip()
-
-            # We will only work on a given slice (because of the INIs)
-            if i >= start_idx and i <= end_idx:
-                # The key is uncommented => set it
-                if lstr.startswith(kstr):
-                    if not matched:
-                        content[i] = new_line
-                        matched = True
-                    else:
-                        content[i] = '# ' + content[i]
-                # The key is commented out => set it
-                elif lstr.startswith('#'):
-                    # The line starts with KEY+space or KEY+SEPARATOR
-                    if lstrcs.startswith((kstr+' ', kstr+sep)):
+        if self.kwargs['sep']:
+            sep = self.kwargs['sep']
+            pads = [None, None]
+        else:
+            sep = self.guess_separator(doc)
+            pads = self.separator_pads(doc)
+
+        plan = []
+        # Lines removed/added by the batch, to check the guessing later
+        olds, news, appends = [], [], []
+        for section, keys in groups.items():
+            sec = None
+            if self.iftype != 'ini' or section:
+                sec = self.find_section(doc, section)
+                if not sec and self.iftype != 'ini':
+                    sec = doc.sections[0]
+
+            replaces, missing = [], []
+            for kstr, (key, value) in keys.items():
+                new_line = doc.new_line(indent + key + sep + value)
+                matched = False
+                if sec:
+                    cands = sec.candidates(kstr)
+                else:
+                    cands = []
+                for rec in cands:
+                    if rec.body.startswith(kstr):
                         if not matched:
-                            content[i] = new_line
+                            replaces.append([rec, new_line])
                             matched = True
-
-        if not matched:
-            while content[end_idx].strip() == "":
-                end_idx = end_idx - 1
-            content.insert(end_idx+1, new_line)
-
-        return content
+                        else:
+                            replaces.append([rec,
+                                             doc.new_line('# ' + rec.text)])
+                    elif rec.body.startswith('#') and not matched:
+                        if rec.commented().startswith((kstr+' ', kstr+sep)):
+                            replaces.append([rec, new_line])
+                            matched = True
+                if not matched:
+                    missing.append(new_line)
+
+            olds.extend(old for old, new in replaces)
+            news.extend(new for old, new in replaces)
+            news.extend(missing)
+            plan.append([section, replaces, missing])
+            # Where the missing keys go: after this line (None for the
+            # start of the file), or at the end of the file in a new section
+            if sec:
+                idx = self.append_idx(sec)
+                after = sec.lines[idx-1] if idx else sec.header
+                appends.append([after, missing])
+
+        # One by one, indentation and separator are guessed again after
+        # each change. Ensure that they can not change in any order.
+        attrs = [['indent', len(indent), 'indent'],
+                 ['lpad', pads[0], 'sep'], ['rpad', pads[1], 'sep']]
+        attrs = [[attr, value] for attr, value, kwarg in attrs
+                 if not self.kwargs[kwarg] or self.kwargs[kwarg] == 'a']
+        if not attrs:
+            return plan
+        isep = self.separators[self.iftype]
+        analysis = self.analyze(doc)
+        hists = analysis.histograms(isep)
+        clear = SNIFF_CONFIDENCE * SAMPLE_LINES
+
+        if not analysis.sampled:
+            # The whole file is looked at
+            for attr, value in attrs:
+                lowest, highest = guess_bounds(hists[attr], attr, value,
+                                               olds, news)
+                if [1 for val in highest if highest[val] >= lowest]:
+                    return None
+            grown = sum(hists['indent'].values()) + \
+                len([1 for rec in news if rec.counted()])
+            if grown <= SAMPLE_LINES:
+                return plan
+
+        # Only the first SAMPLE_LINES lines are looked at when the guess on
+        # them is clear (see canalysis.histograms). Only the changes among
+        # them count, plus the lines they push out or pull in.
+        olds, news, gone, come = self.sample_changes(doc, plan, appends)
+        if analysis.sampled:
+            # Every guess has to stay clear, not to look at the whole file
+            whists = hists
+            attrs = [[attr, analysis.mode(attr, isep)]
+                     for attr in ['indent', 'lpad', 'rpad']]
+        else:
+            # The first lines must not be clear for another value
+            whists = pad_histograms(doc.records, SAMPLE_LINES)[0]
+        for attr, value in attrs:
+            lowest, highest = guess_bounds(whists[attr], attr, value,
+                                           olds + gone, news + come)
+            for val in highest:
+                if analysis.sampled and highest[val] + clear >= lowest or \
+                        highest[val] - lowest >= clear:
+                    return None
+
+        return plan
+
+    def sample_changes(self, doc, plan, appends):
+        # Changes of a merge plan among the first SAMPLE_LINES lines used
+        # for guessing (see merge_plan), and the lines which they can push
+        # out of them or pull in
+        # Returns [OLD_LINES, NEW_LINES, PUSHED_OUT, PULLED_IN]
+        following = sum(len(replaces) for section, replaces, news in plan)
+        inside, used, ahead = sample_edges(doc.records, SAMPLE_LINES,
+                                           following)
+        olds, news = [], []
+        pushes, pulls = 0, 0
+        for section, replaces, missing in plan:
+            for old, new in replaces:
+                if old in inside:
+                    olds.append(old)
+                    news.append(new)
+                    pushes += new.counted() and not old.counted()
+                    pulls += old.counted() and not new.counted()
+        for after, missing in appends:
+            if after is None or after in inside:
+                news.extend(missing)
+                pushes += len([1 for rec in missing if rec.counted()])
+        pushes = max(0, len(used) + pushes - SAMPLE_LINES)
+        return olds, news, used[len(used) - pushes:], ahead[:pulls]
 
     def delete(self, section=None, key=None):
         # Delete a line containing a key on config file
         # Returns a new "content" list of lines (without the line)
         # Usage: delete(SECTION,KEY)
+        self.delete_doc(self.doc, section, key)
+        return self.doc.lines()
+
+    @timed('edit')
+    def delete_doc(self, doc, section=None, key=None):
+        # Same as delete(), but working directly on a tokenized document
+        # Usage: delete_doc(CDOC,SECTION,KEY)
 
         if not key:
             key = self.kwargs['key']
         if not section:
             section = self.kwargs['section']
 
-        content = self.icontent
-        ftype = self.iftype
+        sec = self.target_section(doc, section)
+        kstr = key.strip()
 
-        if ftype == 'ini' and not section:
-            print 'ERROR: parsing INI files requires to specify a section'
-            print '       use the "-s" flag'
-            sys.exit(1)
+        # key found => delete it
+        doc.remove_many(sec, [rec for rec in self.key_candidates(sec, kstr)
+                              if rec.body.startswith(kstr)])
 
-        idxs = self.section_range(content, section)
-        matched = False
-        if not idxs[0] and ftype != 'ini':
-            idxs = [0, len(content)-1]
-        elif not idxs[0] and ftype == 'ini' and section:
-            content.append('['+section+']')
-            idxs = [len(content)-2, len(content)-1]
+        return doc
 
-        if ftype != "ini" and section:
-            msg = '  Warning: [' + section + '] given, but our file "' + \
-                  self.config_file + '" does not have INI format'
-            self.vprt(2, msg)
-
-        start_idx, end_idx = idxs
-
-        for i, line in enumerate(content):
-            # Strip spaces from line and key
-            lstr = line.strip()
-            kstr = key.strip()
-            # Also strip comments and extra spaces from line
-            lstrcs = lstr.strip('#').strip()
-
-            if i >= start_idx and i <= end_idx:
-                # key found => delete it
-                if lstr.startswith(kstr):
-                    del content[i]
-
-        return content
+    @timed('edit')
+    def delete_many(self, doc, section=None, keys=None, globs=None,
+                    regexes=None, all_sections=False):
+        # Delete in one pass the lines (not commented out) of a section, or
+        # of all the sections, whose key starts with one of the keys (like
+        # delete_doc), matches one of the glob patterns or contains one of
+        # the regular expressions
+        # Returns the number of deleted lines
+        # Usage: delete_many(CDOC, SECTION, KEYS, GLOBS, REGEXES, False)
+        ftype = self.iftype
+        doc.structure(ftype == 'ini').split(self.separators[ftype])
+        if ftype != 'ini':
+            secs = doc.sections[:1]
+        elif all_sections:
+            secs = [sec for sec in doc.sections if sec.header]
+        else:
+            sec = self.target_section(doc, section, create=False)
+            secs = [sec] if sec else []
+
+        prefixes = tuple(key.strip() for key in keys or [])
+        match = None
+        if globs or regexes:
+            import re
+            import fnmatch
+            patterns = [fnmatch.translate(glob) for glob in globs or []]
+            patterns += ['.*(?:' + regex + ')' for regex in regexes or []]
+            match = re.compile('|'.join(patterns)).match
+
+        deleted = 0
+        for sec in secs:
+            gone = [rec for rec in sec.lines if rec.kind == KEYVAL and
+                    (prefixes and rec.body.startswith(prefixes) or
+                     match and match(rec.key))]
+            doc.remove_many(sec, gone)
+            deleted += len(gone)
+        return deleted
+
+    def bulk_delete(self):
+        # Are there keys or patterns to delete with delete_many?
+        kwargs = self.kwargs
+        return bool(kwargs.get('delete_keys') or kwargs.get('delete_glob') or
+                    kwargs.get('delete_regex'))
 
+    @timed('edit')
     def extra2skv(self):
         # Convert the "extra" (pipelined) arguments into a list of [s,k,v]
         extra_skvs = []
         if self.kwargs['extra_conf']:
-            extra = self.kwargs['extra_conf'].splitlines()
+            extra = self.kwargs['extra_conf']
+            if isinstance(extra, basestring):
+                extra = extra.splitlines()
+            extra = cdoc(extra)
             eftype = self.guess_conf_type(extra)
             if eftype != self.iftype:
                 msg = 'ERROR: config file and extra data format are different'
@@ -393,91 +1818,221 @@ class cskv(object):
                     print print_me
                 sys.exit()
 
-            isep = self.separators[eftype]
-
-            if eftype == 'ini':
-                for line in extra:
-                    sline = line.strip()
-                    if re.match('\[.*\]', line):
-                        isec = sline.strip('[]')
-                    elif len(sline) > 0 and not sline.startswith('#'):
-                        ikey = sline.split(isep)[0].strip()
-                        ival = isep.join(sline.split(isep)[1:]).strip()
-                        extra_skvs.append([isec, ikey, ival])
-            else:
-                for line in extra:
-                    sline = line.strip()
-                    isec = None
-                    if len(sline) > 0 and not sline.startswith('#'):
-                        ikey = sline.split(isep)[0].strip()
-                        ival = isep.join(sline.split(isep)[1:]).strip()
-                        extra_skvs.append([isec, ikey, ival])
+            extra.split(self.separators[eftype])
+            extra_skvs = list(self.record_skvs(extra.records, eftype))
 
         return extra_skvs
 
+    def extra_stream(self, lines):
+        # Same as extra2skv, but for an iterable of extra config lines
+        # (e.g. a file or a pipe), which are read and converted one by one
+        # The type is guessed on the first SAMPLE_LINES lines.
+        # Usage: for section, key, value in extra_stream(LINES)
+        import itertools
+        if lines is None:
+            return
+        if isinstance(lines, basestring):
+            lines = lines.splitlines()
+        lines = iter(lines)
+        sample = list(itertools.islice(lines, SAMPLE_LINES))
+        if not sample:
+            return
+        eftype = self.guess_conf_type(cdoc(sample))
+        if eftype != self.iftype:
+            msg = 'ERROR: config file and extra data format are different'
+            print_me = self.vprt(1, msg)
+            if print_me:
+                print print_me
+            sys.exit()
+
+        isep = self.separators[eftype]
+        records = (cline(line, isep)
+                   for line in itertools.chain(sample, lines))
+        for skv in self.record_skvs(records, eftype):
+            yield skv
+
+    def record_skvs(self, records, eftype):
+        # [section, key, value] of the key/values of the (split) records
+        # of extra config of type eftype
+        # Usage: for section, key, value in record_skvs(RECORDS, 'ini')
+        isep = self.separators[eftype]
+        isec = None
+        for rec in records:
+            if rec.kind == SECTION and eftype == 'ini':
+                isec = rec.body.strip('[]')
+            elif rec.kind == SECTION:
+                # Lines like "[something]" are just keys in RAW files
+                ikey, found, ival = rec.body.partition(isep)
+                yield [isec, ikey.strip(), ival.strip()]
+            elif rec.body and not rec.body.startswith('#'):
+                ival = rec.value
+                if ival is None:
+                    ival = ''
+                yield [isec, rec.key, ival]
+
     def get_ini_sections(self, content):
         # Get the list of sections on an ini file
+        if isinstance(content, csnapshot):
+            return [name for name, idx in content.sections]
         sections = []
-        for line in content:
-            if re.match('\[.*\]', line):
-                section = line.strip('[]')
-                sections.append(section)
+        for rec in self.tokens(content).records:
+            if rec.kind == SECTION:
+                sections.append(rec.key)
         return sections
 
     def get_keyvals(self, content, section):
         # Get a dict of key/values present on a section
-        keyvals = {}
-
-        ftype = self.guess_conf_type(content)
-        sep = self.separators[ftype]
-
-        if self.guess_conf_type(content) == 'ini':
-            parse = False
-        else:
-            parse = True
+        ftype, keyvals = self.parsed(content)
+        if ftype != 'ini':
+            section = ''
+        return dict(keyvals.get(section, {}))
+
+    def parsed(self, content):
+        # File type and key/values (see keyval_map) of a list of lines, a
+        # tokenized document or a snapshot
+        # Usage: parsed(LIST_OF_CONFIG_LINES)
+        if isinstance(content, csnapshot):
+            return content.ftype, content.keyvals
+        doc = self.tokens(content)
+        return self.guess_conf_type(doc), self.keyval_map(doc)
+
+    def snapshot(self, file_name=None):
+        # Snapshot (csnapshot) of a file, config_file by default
+        # With kwargs['cache_dir'] it is stored there and only taken again
+        # when the file changed
+        # Usage: snapshot(FILE_NAME)
+        if file_name is None:
+            file_name = self.config_file
+        cache = None
+        if self.kwargs.get('cache_dir'):
+            cache = ccache(self.kwargs['cache_dir'],
+                           self.kwargs.get('cache_size'))
+            snap = cache.get(file_name)
+            if snap:
+                print_me = self.vprt(3, "   Cached analysis of " + file_name)
+                if print_me:
+                    print print_me
+                return snap
+            identity = cache.identity(file_name)
 
-        for line in content:
-            if re.match('\[.*\]', line):
-                if section in line:
-                    parse = True
-                else:
-                    parse = False
-
-            elif parse is True:
-                if not line.startswith(('#', ';')) and len(line.strip()) > 0:
-                    lines = line.split(sep)
-                    key = lines[0].strip()
-                    if len(lines) > 1:
-                        value = lines[1].strip()
-                    else:
-                        value = None
-                    keyvals[key] = value
-                    key, value = None, None
+        print_me = self.vprt(3, "   Analyzing file " + file_name)
+        if print_me:
+            print print_me
+        with open(file_name, 'r') as infile:
+            data = infile.read()
+        lines = data.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        doc = cdoc([line.rstrip() for line in lines])
+
+        import hashlib
+        analysis = self.analyze(doc)
+        # Unknown (None) without any key/value line
+        isep = SEPARATORS[analysis.ftype]
+        hists = analysis.histograms(isep)
+        pads = [analysis.mode(attr, isep) if hists[attr] else None
+                for attr in ['indent', 'lpad', 'rpad']]
+        sections = [[rec.key, idx] for idx, rec in enumerate(doc.records)
+                    if rec.kind == SECTION]
+        snap = csnapshot(analysis.ftype, pads[0], pads[1], pads[2], sections,
+                         self.keyval_map(doc), hashlib.sha1(data).hexdigest(),
+                         includes=include_directives(doc))
+
+        if cache:
+            cache.put(file_name, snap, identity)
+        return snap
+
+    def section_hashes(self, content=None):
+        # Content hash of each section (see section_hash) of a list of
+        # lines, a tokenized document or a snapshot (the config file by
+        # default), with section '' for RAW files
+        # Usage: section_hashes(LIST_OF_CONFIG_LINES)
+        if content is None:
+            content = self.icontent
+        if isinstance(content, csnapshot):
+            return dict(content.hashes)
+        ftype, keyvals = self.parsed(content)
+        return dict((name, section_hash(secvals))
+                    for name, secvals in keyvals.items())
+
+    def keyval_map(self, content):
+        # Get all the key/values of a file in a single pass
+        # Returns {SECTION: {KEY: VALUE}}, with section '' for RAW files
+        # Usage: keyval_map(LIST_OF_CONFIG_LINES)
+        doc = self.tokens(content)
+        ftype = self.guess_conf_type(doc)
+        doc.split(self.separators[ftype])
+
+        from collections import OrderedDict
+        keyvals = OrderedDict()
+        keyvals_sec = None
+        if ftype != 'ini':
+            keyvals_sec = keyvals[''] = {}
+
+        for rec in doc.records:
+            if rec.kind == SECTION:
+                if ftype == 'ini':
+                    keyvals_sec = keyvals.setdefault(rec.key, {})
+            elif rec.kind == KEYVAL and keyvals_sec is not None:
+                keyvals_sec[rec.key] = rec.value
         return keyvals
 
-    def compare_confs(self, contenta=None, contentb=None):
-        # Compare both configuration files
-        # We can provide two lists of lines explicitly
-        # or it will take the content of "config_file" and "compare" in opts
+    def diff_confs(self, contenta=None, contentb=None, same=False):
+        # Compare both configuration files, returning a generator of dicts:
+        #   {'section': S, 'key': K, 'a': VALUE_A, 'b': VALUE_B, 'change': C}
+        # where the change is "added" (only in b), "removed" (only in a),
+        # "changed" or, if same=True, also "same".
+        # Each file is parsed only once.
+        # Usage: diff_confs(LIST_OF_LINES_A, LIST_OF_LINES_B)
         if not contenta:
             contenta = self.icontent
         if not contentb:
             contentb = self.icompare
 
-        cta = self.guess_conf_type(contenta)
-        ctb = self.guess_conf_type(contentb)
+        # Tokenize both files only once (or not at all for snapshots)
+        cta, keyvalsa = self.parsed(contenta)
+        ctb, keyvalsb = self.parsed(contentb)
         if cta != ctb:
-            msg = "ERROR: the config files " + self.kwargs['config']
+            msg = "ERROR: the config files " + self.kwargs['config_file']
             msg += " and " + self.kwargs['compare'] + " seem to have different"
             msg += " formats: (" + cta + " and " + ctb + ")"
+            print_me = self.vprt(1, msg)
+            if print_me:
+                print print_me
             sys.exit()
 
-        if cta == "ini":
-            secs_a = self.get_ini_sections(contenta)
-            secs_b = self.get_ini_sections(contentb)
-            sections = sorted(set(secs_a + secs_b))
-        else:
-            sections = ['']
+        # Sections with the same content hash (of snapshots) are the same
+        hashesa, hashesb = {}, {}
+        if isinstance(contenta, csnapshot) and \
+                isinstance(contentb, csnapshot) and not same:
+            hashesa, hashesb = contenta.hashes, contentb.hashes
+
+        for sec in sorted(set(keyvalsa.keys() + keyvalsb.keys())):
+            if sec in hashesa and hashesa[sec] == hashesb.get(sec):
+                continue
+            seca = keyvalsa.get(sec, {})
+            secb = keyvalsb.get(sec, {})
+            for key in sorted(set(seca.keys() + secb.keys())):
+                if key not in secb:
+                    change = 'removed'
+                elif key not in seca:
+                    change = 'added'
+                elif seca[key] != secb[key]:
+                    change = 'changed'
+                elif same:
+                    change = 'same'
+                else:
+                    continue
+
+                yield {'section': sec, 'key': key, 'change': change,
+                       'a': seca.get(key), 'b': secb.get(key)}
+
+    @timed('compare')
+    def compare_confs(self, contenta=None, contentb=None):
+        # Compare both configuration files
+        # We can provide two lists of lines explicitly
+        # or it will take the content of "config_file" and "compare" in opts
+        # Returns a list of lines (as text), see diff_confs for the data
 
         # List containing output lines
         out_content = []
@@ -498,51 +2053,69 @@ class cskv(object):
             msg = "-"*70
             out_content.append(msg)
 
-        for sec in sections:
-            # Do not print section names without differences
-            print_section = False
-
-            keyvalsa = self.get_keyvals(contenta, sec)
-            keyvalsb = self.get_keyvals(contentb, sec)
-
-            for key in sorted(set(keyvalsa.keys() + keyvalsb.keys())):
-                if key in keyvalsa:
-                    val_a = keyvalsa[key]
-                else:
-                    val_a = ''
-                if key in keyvalsb:
-                    val_b = keyvalsb[key]
-                else:
-                    val_b = ''
-
-                if val_a != val_b:
-                    # Print section header only after 1st difference found
-                    if not print_section:
-                        print_section = True
-                        if sections != ['']:
-                            out_content.append("##### " + sec + "####")
-
-                    msg = '  {:20} {:25}  {}'.format(key, val_a, val_b)
-                    out_content.append(msg)
-
-                # If verbosity is > 1, print also the values that are identic
-                elif self.kwargs['verbosity'] > 1:
-                    msg = '  {:20} {:25}  {}'.format(key, val_a, val_b)
-                    out_content.append(msg)
+        # If verbosity is > 1, print also the values that are identic
+        same = self.kwargs['verbosity'] > 1
+        last_sec = None
+        for diff in self.diff_confs(contenta, contentb, same=same):
+            # Print section header only after 1st difference found
+            if diff['section'] and diff['section'] != last_sec and \
+                    diff['change'] != 'same':
+                last_sec = diff['section']
+                out_content.append("##### " + last_sec + "####")
+
+            val_a, val_b = diff['a'], diff['b']
+            if diff['change'] == 'added':
+                val_a = ''
+            elif diff['change'] == 'removed':
+                val_b = ''
+            msg = '  {:20} {:25}  {}'.format(diff['key'], val_a, val_b)
+            out_content.append(msg)
 
         return out_content
 
+    @timed('compare')
+    def compare_json(self, contenta=None, contentb=None):
+        # Same as compare_confs, but one JSON object per line
+        # (see diff_confs for the keys of each object)
+        import json
+        same = self.kwargs['verbosity'] > 1
+        return [json.dumps(diff, sort_keys=True)
+                for diff in self.diff_confs(contenta, contentb, same=same)]
+
     def process(self):
         # Run all the functions above, also for pipeline or file options
         # Variables are defined in the opts dictionary and in the class init
         # Usage: process()
 
-        content = self.icontent
         kwargs = self.kwargs
+        # Did the config file change? (see also write_atomic)
+        self.changed = False
+
+        cached = (kwargs.get('cache_dir') or kwargs.get('includes')) and \
+            kwargs.get('compare') and os.path.isfile(kwargs['compare'])
+        if kwargs.get('get') is not None or kwargs.get('where') is not None:
+            out_content = self.process_get()
+
+        elif cached or self.icompare:
+            if cached and kwargs.get('includes'):
+                content = self.effective_snapshot(self.config_file)
+                compare = self.effective_snapshot(
+                    os.path.abspath(kwargs['compare']))
+            elif cached:
+                content = self.snapshot()
+                compare = self.snapshot(os.path.abspath(kwargs['compare']))
+            else:
+                content, compare = self.icontent, self.icompare
+            if kwargs.get('format') == 'json':
+                out_content = self.compare_json(content, compare)
+            else:
+                out_content = self.compare_confs(content, compare)
+
+        elif kwargs.get('stream'):
+            out_content = self.process_stream()
 
-        if self.icompare:
-            compare = self.icompare
-            out_content = self.compare_confs(content, self.icompare)
+        elif kwargs.get('mmap'):
+            out_content = self.process_section()
 
         else:
             # Parse Key/Values (for section)
@@ -551,38 +2124,1786 @@ class cskv(object):
             section = kwargs['section']
             key = kwargs['key']
             value = kwargs['value']
+            doc = self.doc
             if key:
                 # Delete option requested, deleting line(s)
                 if 'delete' in kwargs and kwargs['delete']:
-                    content = self.delete(section, key)
+                    self.delete_doc(doc, section, key)
                 else:
                     # Parsing s/k/v from opts dictionary or as cmd arguments
-                    content = self.insert(section, key, value)
-
-            # Process the extra_conf (file/piped) values
-            for section, key, value in self.extra2skv():
-                content = self.insert(section, key, value)
-
-            # Print output to stdout or file
-            if not kwargs['test']:
-                self.vprt(3, '   Printing output to file ' + self.config_file)
-                output = open(self.config_file, 'w')
-                for line in content:
-                    print>>output, line
-                output.close()
+                    self.insert_doc(doc, section, key, value)
+
+            # Many keys and patterns to delete, in one pass
+            if self.bulk_delete():
+                self.deleted = self.delete_many(
+                    doc, section, kwargs.get('delete_keys'),
+                    kwargs.get('delete_glob'), kwargs.get('delete_regex'),
+                    kwargs.get('all_sections'))
+                if kwargs.get('interactive'):
+                    print >> sys.stderr, 'Deleted ' + str(self.deleted) + \
+                        ' line(s) from ' + self.config_file
+
+            # Process the extra_conf (file/piped) values, in batches if
+            # they are streamed
+            if kwargs.get('batch'):
+                self.merge_batches(doc, self.extra_stream(
+                    kwargs['extra_conf']), kwargs['batch'])
             else:
+                self.merge(doc, self.extra2skv())
+
+            # Render the document back only once (or only the diff of the
+            # changed sections)
+            with self.phase('render'):
+                if kwargs['diff']:
+                    content = doc.diff(self.config_file)
+                    self.changed = bool(content)
+                else:
+                    content = doc.lines()
+                    self.changed = content != self.icontent
+
+            # Print output to stdout or file (the diff is only returned)
+            if not kwargs['test'] and not kwargs['diff']:
+                if self.changed:
+                    print_me = self.vprt(3, '   Printing output to file ' +
+                                         self.config_file)
+                    with self.phase('write'):
+                        write_atomic(self.config_file,
+                                     ''.join(line + '\n' for line in content))
+                else:
+                    print_me = self.vprt(3, '   Nothing changed in file ' +
+                                         self.config_file)
+                if print_me:
+                    print print_me
+            elif not kwargs['diff']:
                 self.vprt(2, " ")
                 for line in content:
                     print line
 
+            doc.mark()
             out_content = content
 
         return out_content
 
+    def process_get(self):
+        # Values of the keys of kwargs['get'] (or of kwargs['key']), see
+        # get_values, or where they are defined for kwargs['where'] (see
+        # find_keys). The keys not found are kept in self.missing
+        # Returns the lines to print: the value (or FILE:LINE) of a single
+        # key, or KEY<tab>VALUE (or KEY<tab>FILE:LINE) for many keys
+        # Usage: process_get()
+        kwargs = self.kwargs
+        where = kwargs.get('where') is not None
+        keys = list(kwargs['where'] if where else kwargs['get'] or [])
+        if not keys and kwargs['key']:
+            keys = [kwargs['key']]
+        if not keys:
+            option = '--where' if where else '--get'
+            sys.exit('ERROR: ' + option + ' needs a key (-k KEY or ' +
+                     option + ' KEY ...)')
+
+        if where:
+            values = dict((kstr, found[0] + ':' + str(found[1]))
+                          for kstr, found in self.find_keys(
+                              kwargs['section'], keys).items())
+        else:
+            values = self.get_values(kwargs['section'], keys)
+        self.missing = [key for key in keys if key.strip() not in values]
+        if len(keys) == 1:
+            return [values[key.strip()] or '' for key in keys
+                    if key.strip() in values]
+        return [key.strip() + '\t' + (values[key.strip()] or '')
+                for key in keys if key.strip() in values]
+
+    @timed('get')
+    def get_values(self, section, keys):
+        # Values of some keys of a section (of the whole file for RAW
+        # files), like get_keyvals, but reading the file line by line and
+        # only until the end of the (first) section. The file type is
+        # guessed on the first SAMPLE_LINES lines, unless it is in
+        # kwargs['ftype']. With kwargs['includes'], the keys not found are
+        # looked for in the included files (see find_keys)
+        # Returns {KEY: VALUE} for the keys found (the last value wins)
+        # Usage: get_values(SECTION, LIST_OF_KEYS)
+        return dict((kstr, found[2]) for kstr, found in
+                    self.find_keys(section, keys).items())
+
+    def find_keys(self, section, keys):
+        # Where some keys of a section are defined, and their values (see
+        # get_values). With kwargs['includes'], the include directives are
+        # followed where they are (see include_defs), and the value which
+        # wins depends on the file type (see INCLUDE_PRECEDENCE): with the
+        # first one, the files after it are not read at all.
+        # Returns {KEY: [FILE, LINE, VALUE]} for the keys found
+        # Usage: find_keys(SECTION, LIST_OF_KEYS)
+        ftype = self.kwargs.get('ftype')
+        if not self.kwargs.get('includes'):
+            return self.locate(self.config_file, section, keys, ftype)
+
+        kstrs = set(key.strip() for key in keys)
+        if not ftype:
+            ftype = self.guess_conf_type(cdoc(self.sample_lines()))
+        if ftype == 'ini' and not section:
+            print 'ERROR: parsing INI files requires to specify a section'
+            print '       use the "-s" flag'
+            sys.exit(1)
 
-if __name__ == "__main__":
-    # The program is being called from command line
-    # Parse Command line arguments
+        first = INCLUDE_PRECEDENCE[ftype] == 'first'
+        found = {}
+        for sec, key, file_name, num, value in self.include_defs(
+                self.config_file, ftype, kstrs):
+            if ftype == 'ini' and sec != section or first and key in found:
+                continue
+            found[key] = [file_name, num, value]
+            if first and len(found) == len(kstrs):
+                break
+        return found
+
+    def locate(self, file_name, section, keys, ftype=None):
+        # Same as find_keys, but only in one file, which is read line by line
+        # until the end of the section. The file type is guessed on its
+        # first SAMPLE_LINES lines if it is not given
+        # Usage: locate(FILE_NAME, SECTION, LIST_OF_KEYS, FTYPE)
+        kstrs = set(key.strip() for key in keys)
+        if not ftype:
+            ftype = self.guess_conf_type(cdoc(self.sample_lines(file_name)))
+        isep = self.separators[ftype]
+
+        if ftype == 'ini' and not section:
+            print 'ERROR: parsing INI files requires to specify a section'
+            print '       use the "-s" flag'
+            sys.exit(1)
+
+        found = {}
+        inside = ftype != 'ini'
+        prefixes = tuple(kstrs)
+        for num, line in enumerate(self.read_lines(file_name), 1):
+            if ftype == 'ini' and line.startswith('['):
+                rec = cline(line)
+                if rec.kind == SECTION:
+                    if inside:
+                        break
+                    inside = rec.key == section
+                    continue
+            if inside and line.lstrip().startswith(prefixes):
+                rec = cline(line, isep)
+                if rec.kind == KEYVAL and rec.key in kstrs:
+                    found[rec.key] = [file_name, num, rec.value]
+        return found
+
+    def include_defs(self, file_name, ftype, keys=None, state=None):
+        # Key/values of a file, reading the files of its include directives
+        # (see include_files) in place of the directive, as if their lines
+        # were there, and then its drop-in directory FILE.d/ if it exists.
+        # Every file is read with the same file type, and at most once.
+        # keys: only the lines of these keys (all the key/values if None);
+        # then the included files which do not define any of them are not
+        # read (see include_snapshot)
+        # Yields [SECTION, KEY, FILE, LINE, VALUE] in that order, with
+        # section '' for RAW files (and None before the first INI section)
+        # Usage: for sec, key, name, num, value in include_defs(FILE, FTYPE)
+        if state is None:
+            state = {'section': None if ftype == 'ini' else '',
+                     'seen': set()}
+        real = os.path.realpath(file_name)
+        if real in state['seen'] or not os.path.isfile(real):
+            return
+        included = bool(state['seen'])
+        state['seen'].add(real)
+
+        dropin = file_name + '.d'
+        isep = self.separators[ftype]
+        if included and keys is not None and not os.path.isdir(dropin):
+            snap = self.include_snapshot(file_name)
+            if snap.ftype == ftype and not snap.includes and \
+                    not [1 for secvals in snap.keyvals.values()
+                         for key in keys if key in secvals]:
+                # The keys before the first INI section are not in the
+                # snapshot, they belong to the section of the directive
+                from itertools import islice
+                head = snap.sections[0][1] if snap.sections else None
+                heads = [cline(line, isep)
+                         for line in islice(self.read_lines(file_name), head)]
+                if ftype != 'ini' or not [1 for rec in heads
+                                          if rec.kind == KEYVAL and
+                                          rec.key in keys]:
+                    # Nothing to find there: only the section it ends in
+                    if ftype == 'ini' and snap.sections:
+                        state['section'] = snap.sections[-1][0]
+                    return
+
+        prefixes = tuple(keys or ['']) + ('[', 'i', 'I', '!')
+        for num, line in enumerate(self.read_lines(file_name), 1):
+            if not line.lstrip().startswith(prefixes):
+                continue
+            rec = cline(line, isep)
+            if rec.kind == SECTION and ftype == 'ini':
+                state['section'] = rec.key
+                continue
+            paths = include_paths(rec)
+            if paths is not None:
+                for name in include_files(file_name, paths):
+                    for item in self.include_defs(name, ftype, keys, state):
+                        yield item
+            elif rec.kind == KEYVAL and state['section'] is not None and \
+                    (keys is None or rec.key in keys):
+                yield [state['section'], rec.key, file_name, num, rec.value]
+
+        if os.path.isdir(dropin):
+            for name in include_files(file_name, [dropin]):
+                for item in self.include_defs(name, ftype, keys, state):
+                    yield item
+
+    def include_snapshot(self, file_name):
+        # Snapshot of a file (see snapshot), kept by file identity so that
+        # files included many times (shared drop-ins) are only parsed once
+        # Usage: include_snapshot(FILE_NAME)
+        identity = tuple(file_identity(file_name))
+        snap = include_snapshots.get(identity)
+        if snap is None:
+            if len(include_snapshots) >= INCLUDE_CACHE:
+                include_snapshots.clear()
+            snap = include_snapshots[identity] = self.snapshot(file_name)
+        return snap
+
+    def effective_snapshot(self, file_name):
+        # Snapshot of the key/values of a file with the files it includes,
+        # as find_keys sees them (see include_defs and INCLUDE_PRECEDENCE),
+        # to compare effective configurations. The include directives
+        # themselves are left out.
+        # Usage: effective_snapshot(FILE_NAME)
+        from collections import OrderedDict
+        if not os.path.isfile(file_name):
+            sys.exit('ERROR: can not read ' + file_name)
+        main = self.include_snapshot(file_name)
+        first = INCLUDE_PRECEDENCE[main.ftype] == 'first'
+        keyvals = OrderedDict()
+        for sec, key, name, num, value in self.include_defs(file_name,
+                                                            main.ftype):
+            secvals = keyvals.setdefault(sec, {})
+            if not first or key not in secvals:
+                secvals[key] = value
+        return csnapshot(main.ftype, main.indent, main.lpad, main.rpad,
+                         main.sections, keyvals)
+
+    def sample_lines(self, file_name=None):
+        # First SAMPLE_LINES lines of the file (config_file by default), to
+        # guess its format
+        # Usage: sample_lines()
+        sample = []
+        for line in self.read_lines(file_name or self.config_file):
+            sample.append(line)
+            if len(sample) >= SAMPLE_LINES:
+                break
+        return sample
+
+    @timed('stream')
+    def process_stream(self):
+        # Same as process(), but for big RAW files: the lines are read,
+        # changed and written one by one, so the memory used does not depend
+        # on the size of the file. The format, indentation and separator are
+        # guessed on the first SAMPLE_LINES lines only (see stream_lines).
+        # INI files are processed as usual.
+        # Returns None instead of the content of the file
+        # Usage: process_stream()
+        kwargs = self.kwargs
+
+        sample = self.sample_lines()
+        whole = len(sample) < SAMPLE_LINES
+        sample = cdoc(sample)
+        self.iftype = self.guess_conf_type(sample)
+
+        if self.iftype == 'ini' or self.bulk_delete() or kwargs['diff']:
+            print_me = self.vprt(2, '   WARNING: INI files (and deleting '
+                                 'many keys, or --diff) are not streamed')
+            if print_me:
+                print print_me
+            del self.iftype
+            kwargs['stream'] = False
+            return self.process()
+
+        # The changes, in the same order as process() applies them. With
+        # kwargs['batch'], the extra config is read and applied in batches
+        # of that many key/values, one pass over the file for each batch,
+        # so that only one batch is in memory (see merge_batches)
+        import itertools
+        ops = []
+        if kwargs['key']:
+            if kwargs.get('delete'):
+                ops.append(['delete', kwargs['key'], None])
+            else:
+                ops.append(['insert', kwargs['key'], kwargs['value']])
+        size = kwargs.get('batch')
+        if size:
+            extra = self.extra_stream(kwargs['extra_conf'])
+        else:
+            extra = iter(self.extra2skv())
+        batch = [['insert', key, value]
+                 for section, key, value in itertools.islice(extra, size)]
+        ops.extend(batch)
+
+        state = {'changed': False, 'whole': whole}
+        source, temps = self.config_file, []
+        batches, merged = 0, 0
+        try:
+            while True:
+                # One pass over the lines for each group of independent
+                # changes
+                lines = self.read_lines(source)
+                for group in self.stream_groups(self.stream_lines(
+                        sample, ops, state)):
+                    lines = self.stream_edit(lines, group, state)
+                merged += len(batch)
+                batches += 1
+                batch = [['insert', key, value] for section, key, value
+                         in itertools.islice(extra, size)] if size else []
+                if not batch:
+                    break
+                ops = batch
+
+                # The next batch reads what this one wrote
+                fd, source = temp_file(*os.path.split(
+                    os.path.realpath(self.config_file)))
+                temps.append(source)
+                with os.fdopen(fd, 'w') as output:
+                    output.writelines(line + '\n' for line in lines)
+                if len(temps) > 1:
+                    os.remove(temps.pop(0))
+                if kwargs.get('interactive'):
+                    print >> sys.stderr, 'Batch ' + str(batches) + ': ' + \
+                        str(merged) + ' key/values merged into ' + \
+                        self.config_file
+
+            if not kwargs['test']:
+                write_atomic(self.config_file,
+                             (line + '\n' for line in lines),
+                             lambda: state['changed'])
+                if state['changed']:
+                    print_me = self.vprt(3, '   Printed output to file ' +
+                                         self.config_file)
+                else:
+                    print_me = self.vprt(3, '   Nothing changed in file ' +
+                                         self.config_file)
+                if print_me:
+                    print print_me
+            else:
+                self.vprt(2, " ")
+                for line in lines:
+                    print line
+        finally:
+            for temp in temps:
+                os.remove(temp)
+        if size and kwargs.get('interactive') and merged:
+            print >> sys.stderr, 'Batch ' + str(batches) + ': ' + \
+                str(merged) + ' key/values merged into ' + self.config_file
+
+        self.changed = state['changed']
+        return None
+
+    @timed('section')
+    def process_section(self):
+        # Same as process(), but for changing one key of a big INI file: the
+        # file is memory mapped, the section is found with byte searches and
+        # only its lines are read and tokenized. The rest of the file is
+        # copied unchanged (process() also strips the blanks at the end of
+        # its lines), and a missing newline at the end is added as in
+        # process(). The format, indentation and separator are guessed
+        # on the first SAMPLE_LINES lines and on the section.
+        # Other files or changes (extra config) are processed as usual.
+        # Returns None instead of the content of the file (or the diff)
+        # Usage: process_section()
+        kwargs = self.kwargs
+        section = kwargs['section']
+
+        sample = self.sample_lines()
+        self.iftype = self.guess_conf_type(cdoc(sample))
+        if self.iftype != 'ini' or not section or not kwargs['key'] or \
+                kwargs['extra_conf'] or self.bulk_delete() or \
+                not os.path.getsize(self.config_file):
+            print_me = self.vprt(2, '   WARNING: processing the whole file')
+            if print_me:
+                print print_me
+            del self.iftype
+            kwargs['mmap'] = False
+            return self.process()
+
+        import mmap
+        with open(self.config_file, 'rb') as infile:
+            fmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            bounds = section_bounds(fmap, section)
+            if bounds is None:
+                # Duplicated section: let process() show the error
+                fmap.close()
+                del self.iftype
+                kwargs['mmap'] = False
+                return self.process()
+            start, end = bounds
+
+            text = fmap[start:end]
+            old_lines = [line.rstrip() for line in text.split('\n')]
+            if not text or text.endswith('\n'):
+                old_lines.pop()
+            del text
+            doc = cdoc(old_lines)
+            doc.structure(True).split(self.separators['ini'])
+
+            if kwargs.get('delete'):
+                self.delete_doc(doc, section, kwargs['key'])
+            else:
+                # Guess like on the whole file when it fits in the sample
+                if len(sample) < SAMPLE_LINES:
+                    guess = cdoc(sample)
+                else:
+                    guess = cdoc(sample + old_lines)
+                indent, sep = None, None
+                if not kwargs['indent'] or kwargs['indent'] == 'a':
+                    indent = self.guess_indent(guess)
+                if not kwargs['sep']:
+                    sep = self.guess_separator(guess)
+                self.insert_doc(doc, section, kwargs['key'], kwargs['value'],
+                                indent, sep)
+
+            new_lines = doc.lines()
+            self.changed = new_lines != old_lines
+
+            def chunks():
+                for chunk in file_range(fmap, 0, start):
+                    yield chunk
+                if start and fmap[start-1] != '\n':
+                    yield '\n'
+                for line in new_lines:
+                    yield line + '\n'
+                for chunk in file_range(fmap, end, fmap.size()):
+                    yield chunk
+                # Like process(), which ends every line with a newline
+                if end < fmap.size() and fmap[fmap.size()-1] != '\n':
+                    yield '\n'
+
+            if kwargs['diff']:
+                # Lines of the file before the section, and the context
+                # lines around it
+                offset = sum(chunk.count('\n')
+                             for chunk in file_range(fmap, 0, start))
+                before, after = file_lines(fmap, start, end, 3)
+                return doc.diff(self.config_file, offset,
+                                before=before, after=after)
+            elif kwargs['test']:
+                self.vprt(2, " ")
+                for chunk in chunks():
+                    sys.stdout.write(chunk)
+            elif self.changed:
+                print_me = self.vprt(3, '   Printing output to file ' +
+                                     self.config_file)
+                write_atomic(self.config_file, chunks())
+                if print_me:
+                    print print_me
+            else:
+                print_me = self.vprt(3, '   Nothing changed in file ' +
+                                     self.config_file)
+                if print_me:
+                    print print_me
+        finally:
+            fmap.close()
+
+        return None
+
+    def stream_lines(self, sample, ops, state):
+        # New lines of the inserts of a list of ['insert'|'delete', KEY,
+        # VALUE], with the indentation and separator that process() would
+        # guess for each of them: the deletes and the changes of existing
+        # keys are also made on the first lines of the file (sample, a cdoc
+        # which is kept for the next batch), and they are guessed again on
+        # it when it changed. The new keys are only added to it while it is
+        # the whole file (state['whole']), up to SAMPLE_LINES lines.
+        # Returns a list of ['insert'|'delete', KEY, NEW_LINE, SEPARATOR]
+        # Usage: stream_lines(CDOC, OPERATIONS, {'whole': True})
+        kwargs = self.kwargs
+        sec = self.target_section(sample, None)
+        lines = []
+        version, indent, sep = None, None, None
+        for op, key, value in ops:
+            here = self.key_candidates(sec, key.strip())
+            if op == 'delete':
+                if here:
+                    self.delete_doc(sample, None, key)
+                lines.append([op, key, None, None])
+                continue
+
+            if version != sample.version:
+                if kwargs['indent'] and kwargs['indent'] != 'a':
+                    indent = kwargs['indent']
+                else:
+                    indent = self.guess_indent(sample)
+                if kwargs['sep']:
+                    sep = kwargs['sep']
+                else:
+                    sep = self.guess_separator(sample)
+                version = sample.version
+            if here or state['whole']:
+                self.insert_doc(sample, None, key, value, indent, sep)
+                state['whole'] = state['whole'] and len(sample) < SAMPLE_LINES
+            lines.append([op, key, indent + key + sep + value, sep])
+        return lines
+
+    def stream_groups(self, ops):
+        # Split a list of ['insert'|'delete', KEY, VALUE] in groups which can
+        # be applied in the same pass: no key of a group is a prefix of
+        # another one (the same key can only be inserted more than once)
+        # Usage: for group in stream_groups(OPERATIONS)
+        group, kinds, kstrs = [], {}, []
+        for op in ops:
+            kstr = op[1].strip()
+            clash = kinds.get(kstr, op[0]) != op[0] or \
+                any(kstr[:i] in kinds for i in xrange(len(kstr)))
+            idx = bisect.bisect_left(kstrs, kstr)
+            if idx < len(kstrs) and kstrs[idx] == kstr:
+                idx += 1
+            if idx < len(kstrs) and kstrs[idx].startswith(kstr):
+                clash = True
+
+            if clash:
+                yield group
+                group, kinds, kstrs = [], {}, []
+            if kstr not in kinds:
+                kinds[kstr] = op[0]
+                bisect.insort(kstrs, kstr)
+            group.append(op)
+        if group:
+            yield group
+
+    def stream_edit(self, lines, ops, state):
+        # Apply a group of changes (see stream_groups and stream_lines) to a
+        # stream of lines of a RAW file, with the same rules as insert_doc()
+        # and delete_doc()
+        # The trailing blank lines are only counted, so that missing keys
+        # can still be added after the last non blank line.
+        # Usage: for line in stream_edit(LINES, OPERATIONS, {})
+        from collections import OrderedDict
+        inserts = OrderedDict()
+        seps = {}
+        deletes = set()
+        for op, key, new_line, sep in ops:
+            if op == 'delete':
+                deletes.add(key.strip())
+            else:
+                inserts[key.strip()] = new_line
+                seps.setdefault(key.strip(), sep)
+        lengths = sorted(set(len(kstr) for kstr in inserts.keys() +
+                             list(deletes)))
+        matched = set()
+        blanks = 0
+
+        for line in lines:
+            lstr = line.strip()
+            out = line
+            found = False
+            for n in lengths:
+                if n > len(lstr):
+                    break
+                kstr = lstr[:n]
+                # The key is uncommented => delete or set it
+                if kstr in deletes:
+                    found, out = True, None
+                elif kstr in inserts:
+                    found = True
+                    if kstr not in matched:
+                        out = inserts[kstr]
+                        matched.add(kstr)
+                    else:
+                        out = '# ' + line
+                if found:
+                    break
+
+            # The key is commented out => set it
+            if not found and inserts and lstr.startswith('#'):
+                cstr = lstr.strip('#').strip()
+                for n in lengths:
+                    kstr = cstr[:n]
+                    if kstr in inserts and kstr not in matched and \
+                            cstr.startswith((kstr + ' ', kstr + seps[kstr])):
+                        out = inserts[kstr]
+                        matched.add(kstr)
+                        break
+
+            if out != line:
+                state['changed'] = True
+            if out is None:
+                continue
+            if out == '':
+                blanks += 1
+                continue
+            for i in xrange(blanks):
+                yield ''
+            blanks = 0
+            yield out
+
+        # Append the missing keys after the last non blank line
+        for kstr in inserts:
+            if kstr not in matched:
+                state['changed'] = True
+                yield inserts[kstr]
+        for i in xrange(blanks):
+            yield ''
+
+
+class csession(object):
+    # Many reads and changes of one file, which is read and parsed only once
+    # and written only once, on commit() (and only if it changed).
+    # As a context manager it commits at the end of the "with" block, or
+    # rolls back the changes if there was an exception.
+    # Usage: with csession(CONFIG_FILE) as conf:
+    #            conf.set(SECTION, KEY, VALUE)
+    # The keyword arguments are the same as for cskv (indent, sep, ...)
+
+    def __init__(self, config_file, **kwargs):
+        kwargs['config_file'] = config_file
+        for opt in ['stream', 'mmap', 'cache_dir', 'lazy']:
+            kwargs.pop(opt, None)
+        self.cfile = cskv(**kwargs)
+        self.identity = file_identity(self.cfile.config_file)
+        self.changed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def section(self, section):
+        # Section object of a key (the whole file for RAW files), or None
+        return self.cfile.target_section(self.cfile.doc, section,
+                                         create=False)
+
+    def records(self, section, key):
+        # Uncommented lines defining a key, in file order
+        sec = self.section(section)
+        if sec is None:
+            return []
+        return [rec for rec in sec.in_order(sec.keys.get(key.strip(), []))
+                if rec.kind == KEYVAL]
+
+    def get(self, section, key, default=None):
+        # Value of a key (the last one if it is defined many times)
+        # Usage: get(SECTION, KEY, DEFAULT)
+        recs = self.records(section, key)
+        if not recs:
+            return default
+        return recs[-1].value or ''
+
+    def has(self, section, key):
+        # Is the key defined (and not commented out)?
+        # Usage: has(SECTION, KEY)
+        return bool(self.records(section, key))
+
+    def set(self, section, key, value=''):
+        # Set a key, with the same rules as cskv.insert()
+        # Usage: set(SECTION, KEY, VALUE)
+        self.cfile.insert_doc(self.cfile.doc, section, key, value)
+
+    def delete(self, section, key):
+        # Delete the lines defining a key, like cskv.delete()
+        # Usage: delete(SECTION, KEY)
+        self.cfile.delete_doc(self.cfile.doc, section, key)
+
+    def merge(self, skvs):
+        # Set many keys at once, see cskv.merge
+        # Usage: merge([[SECTION, KEY, VALUE], ..])
+        self.cfile.merge(self.cfile.doc, skvs)
+
+    def delete_many(self, section=None, keys=None, globs=None, regexes=None,
+                    all_sections=False):
+        # Delete many keys and patterns at once, see cskv.delete_many
+        # Returns the number of deleted lines
+        # Usage: delete_many(SECTION, KEYS, GLOBS, REGEXES, ALL_SECTIONS)
+        return self.cfile.delete_many(self.cfile.doc, section, keys, globs,
+                                      regexes, all_sections)
+
+    def sections(self):
+        # Names of the sections of INI files ([] for RAW files)
+        if self.cfile.iftype != 'ini':
+            return []
+        return self.cfile.get_ini_sections(self.cfile.doc)
+
+    def items(self, section=None):
+        # List of [key, value] of a section (of the file for RAW files), in
+        # file order (the last value wins for keys defined many times)
+        # Usage: items(SECTION)
+        sec = self.section(section)
+        if sec is None:
+            return []
+        from collections import OrderedDict
+        keyvals = OrderedDict()
+        for rec in sec.lines:
+            if rec.kind == KEYVAL:
+                keyvals[rec.key] = rec.value or ''
+        return keyvals.items()
+
+    def lines(self):
+        # Current content of the file, as a list of lines
+        return self.cfile.doc.lines()
+
+    def commit(self):
+        # Write the file (only if it changed). Returns True if it was
+        # written. It exits if somebody else changed the file meanwhile.
+        # Usage: commit()
+        cfile = self.cfile
+        content = cfile.doc.lines()
+        if content == cfile.icontent:
+            return False
+        if file_identity(cfile.config_file) != self.identity:
+            sys.exit('ERROR: ' + cfile.config_file + ' changed since it '
+                     'was opened, not writing it')
+        with cfile.phase('write'):
+            write_atomic(cfile.config_file,
+                         ''.join(line + '\n' for line in content))
+        cfile.icontent = content
+        self.identity = file_identity(cfile.config_file)
+        self.changed = True
+        return True
+
+    def rollback(self):
+        # Forget the changes since the last commit
+        # Usage: rollback()
+        self.cfile.load(self.cfile.icontent)
+
+
+class cfuture(object):
+    # Result of a call of casync, which is only known later
+    # Usage: future.result(TIMEOUT), future.done(),
+    #        future.add_done_callback(FUNCTION_OF_THE_FUTURE)
+
+    def __init__(self):
+        import threading
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        # Has the call finished?
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        # Wait for the result of the call (raising its exception, if any)
+        # The errors of cskv (sys.exit) are raised as RuntimeError
+        if not self.event.wait(timeout):
+            raise RuntimeError('the call did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        # Call callback(future) when the call finishes (at once if it has
+        # already finished). It runs in the thread of the call.
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, value=None, error=None):
+        # Set the result of the call and run the callbacks
+        with self.lock:
+            self.value, self.error = value, error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class casync(object):
+    # Non blocking version of csession, to use cskv from event loops and
+    # agents: every call runs in a bounded pool of threads and returns a
+    # cfuture at once. The calls for the same file run one after the other
+    # (in the order they were made), the calls for different files run at
+    # the same time.
+    # Usage: editor = casync(4)
+    #        editor.set(FILE, SECTION, KEY, VALUE)
+    #        editor.commit(FILE).add_done_callback(FUNCTION)
+    #        editor.close()
+    # Python 2 has no asyncio: the futures can be waited for (result), or
+    # used to wake up the event loop with a callback.
+
+    def __init__(self, workers=4, **kwargs):
+        # The keyword arguments are the same as for csession
+        import threading
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(workers)
+        self.guard = threading.Lock()
+        # Notified when there are no calls left
+        self.idle = threading.Condition(self.guard)
+        self.queues = {}
+        self.sessions = {}
+        self.kwargs = kwargs
+
+    def submit(self, file_name, function, *args):
+        # Run function(*args) in the pool, after the calls already made
+        # for the same file. Returns a cfuture
+        # Usage: submit(FILE, FUNCTION, ARGUMENTS..)
+        return self.submit_all([file_name], function, *args)
+
+    def submit_all(self, file_names, function, *args):
+        # Same as submit(), for a call using several files: it runs after
+        # the calls already made for any of them, and the next calls of
+        # all of them wait for it
+        # Usage: submit_all([FILE, OTHER_FILE], FUNCTION, ARGUMENTS..)
+        paths = sorted(set(os.path.realpath(name) for name in file_names))
+        future = cfuture()
+        # [future, function, arguments, files, files where it is not next]
+        call = [future, function, args, paths, 0]
+        with self.guard:
+            for path in paths:
+                queue = self.queues.setdefault(path, [])
+                queue.append(call)
+                if len(queue) > 1:
+                    call[4] += 1
+            if not call[4]:
+                self.pool.apply_async(self.run, (call,))
+        return future
+
+    def run(self, call):
+        # Run a call, and then start the next calls of its files which are
+        # not waiting for other files
+        future, function, args, paths, waiting = call
+        try:
+            future.finish(function(*args))
+        except SystemExit as e:
+            future.finish(error=RuntimeError(error_text(e)))
+        except Exception as e:
+            future.finish(error=e)
+        with self.guard:
+            for path in paths:
+                queue = self.queues[path]
+                queue.pop(0)
+                if queue:
+                    queue[0][4] -= 1
+                    if not queue[0][4]:
+                        self.pool.apply_async(self.run, (queue[0],))
+                else:
+                    del self.queues[path]
+            if not self.queues:
+                self.idle.notify_all()
+
+    def session(self, file_name):
+        # Session (csession) of a file, opened the first time it is used
+        # Only called from the calls of that file
+        path = os.path.realpath(file_name)
+        if path not in self.sessions:
+            self.sessions[path] = csession(path, **dict(self.kwargs))
+        return self.sessions[path]
+
+    def open(self, file_name):
+        # Read and parse a file (the other calls also do it if needed)
+        return self.submit(file_name, self.session, file_name)
+
+    def get(self, file_name, section, key, default=None):
+        # See csession.get
+        return self.submit(file_name, lambda: self.session(file_name).get(
+            section, key, default))
+
+    def set(self, file_name, section, key, value=''):
+        # See csession.set
+        return self.submit(file_name, lambda: self.session(file_name).set(
+            section, key, value))
+
+    def delete(self, file_name, section, key):
+        # See csession.delete
+        return self.submit(file_name, lambda: self.session(
+            file_name).delete(section, key))
+
+    def commit(self, file_name):
+        # Write the changes of a file, see csession.commit
+        return self.submit(file_name, lambda: self.session(
+            file_name).commit())
+
+    def rollback(self, file_name):
+        # Forget the changes of a file, see csession.rollback
+        return self.submit(file_name, lambda: self.session(
+            file_name).rollback())
+
+    def compare(self, file_name, other):
+        # Differences between a file (as it is on disk) and another one,
+        # see cskv.diff_confs. It waits for the calls of both files.
+        def diffs():
+            cfile = cskv(config_file=file_name, compare=other, lazy=True)
+            return list(cfile.diff_confs(cfile.snapshot(),
+                                         cfile.snapshot(other)))
+        return self.submit_all([file_name, other], diffs)
+
+    def close(self):
+        # Wait for all the calls, and stop the threads
+        # (the next call of a file is only given to the pool when the
+        # previous one finishes, so the pool can not be closed before)
+        with self.guard:
+            while self.queues:
+                self.idle.wait()
+        self.pool.close()
+        self.pool.join()
+
+
+def get(config_file, section=None, key=None, **kwargs):
+    # Value of a key of a config file (None if it is missing), or the
+    # dictionary {KEY: VALUE} of the keys found for a list of keys, reading
+    # the file only until the end of the section (see cskv.get_values)
+    # Usage: get(CONFIG_FILE, SECTION, KEY) or get(CONFIG_FILE, SECTION, KEYS)
+    kwargs.update({'config_file': config_file, 'get': []})
+    if isinstance(key, basestring):
+        return cskv(**kwargs).get_values(section, [key]).get(key.strip())
+    return cskv(**kwargs).get_values(section, key)
+
+
+def where(config_file, section=None, key=None, **kwargs):
+    # File and line [FILE, LINE] where a key is defined (None if it is
+    # missing), following the include directives with includes=True (see
+    # cskv.find_keys)
+    # Usage: where(CONFIG_FILE, SECTION, KEY, includes=True)
+    kwargs.update({'config_file': config_file, 'where': []})
+    found = cskv(**kwargs).find_keys(section, [key]).get(key.strip())
+    return found and found[:2]
+
+
+def section_hashes(config_file, **kwargs):
+    # Content hash of each section of a config file (see section_hash),
+    # taken from the cache directory if kwargs['cache_dir'] is given
+    # Usage: section_hashes(CONFIG_FILE)['SECTION']
+    kwargs.update({'config_file': config_file, 'lazy': True})
+    return dict(cskv(**kwargs).snapshot().hashes)
+
+
+def analyze(config_file, **kwargs):
+    # Format of a config file (canalysis), without changing anything
+    # Usage: analyze(CONFIG_FILE).sep
+    kwargs['config_file'] = config_file
+    return cskv(**kwargs).analysis
+
+
+def write_atomic(file_name, chunks, commit=None):
+    # Write a string (or an iterable of strings) into a file atomically:
+    # first into a temporary file in the same directory, which is synced
+    # and renamed to the file name, keeping its permissions and owner.
+    # Files with hard links, or whose owner could not be kept, are
+    # written in place as before.
+    # When the chunks are generated while writing, commit() tells at the
+    # end whether the file has to be replaced at all.
+    # Usage: write_atomic(FILE_NAME, STRING, COMMIT_FUNCTION)
+    if isinstance(chunks, basestring):
+        chunks = [chunks]
+
+    # Write the target of symbolic links, and not the link itself
+    file_name = os.path.realpath(file_name)
+    dir_name, base_name = os.path.split(file_name)
+    try:
+        fstat = os.stat(file_name)
+    except OSError:
+        fstat = None
+
+    in_place = False
+    if fstat:
+        same_owner = fstat.st_uid == os.geteuid() and \
+            fstat.st_gid in [os.getegid()] + os.getgroups()
+        in_place = fstat.st_nlink > 1 or \
+            (os.geteuid() != 0 and not same_owner)
+
+    if in_place:
+        # The chunks may still be read from the file itself
+        chunks = list(chunks)
+        if commit and not commit():
+            return
+        with open(file_name, 'w') as output:
+            output.writelines(chunks)
+        return
+
+    fd, tmp_name = temp_file(dir_name, base_name)
+    try:
+        with os.fdopen(fd, 'w') as output:
+            output.writelines(chunks)
+            keep = not commit or commit()
+            if keep:
+                output.flush()
+                os.fsync(output.fileno())
+
+        if not keep:
+            os.remove(tmp_name)
+            return
+
+        if fstat:
+            os.chmod(tmp_name, stat.S_IMODE(fstat.st_mode))
+            tmp_stat = os.stat(tmp_name)
+            if (tmp_stat.st_uid, tmp_stat.st_gid) != \
+                    (fstat.st_uid, fstat.st_gid):
+                os.chown(tmp_name, fstat.st_uid, fstat.st_gid)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+
+        os.rename(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    # Also make the rename itself durable
+    try:
+        dir_fd = os.open(dir_name, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+def temp_file(dir_name, base_name):
+    # Create a new hidden file (only readable by us) next to a file, like
+    # tempfile.mkstemp but without importing it (and random) at start up
+    # Usage: fd, tmp_name = temp_file(DIRECTORY, FILE_NAME)
+    while True:
+        tmp_name = os.path.join(dir_name, '.' + base_name + '.' +
+                                os.urandom(6).encode('hex') + '.cskv')
+        try:
+            return os.open(tmp_name, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                           0o600), tmp_name
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+
+def file_identity(file_name):
+    # Real path, inode, size and modification time (ns) of a file
+    # Python 2 only has the modification time as a float
+    # Usage: file_identity(FILE_NAME)
+    file_name = os.path.realpath(file_name)
+    fstat = os.stat(file_name)
+    return [file_name, fstat.st_ino, fstat.st_size,
+            int(fstat.st_mtime * 1e9)]
+
+
+def file_hash(file_name):
+    # SHA1 of the content of a file, read in chunks
+    # Usage: file_hash(FILE_NAME)
+    import hashlib
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def section_bounds(fmap, section):
+    # Byte range [start, end) of an INI section in a memory mapped file,
+    # from its header to the next one. A missing section is an empty range
+    # at the end of the file. Returns None if it is found more than once.
+    # Usage: section_bounds(MMAP, SECTION)
+    header = '[' + section + ']'
+    starts = []
+    if fmap[:len(header)] == header:
+        starts.append(0)
+    pos = fmap.find('\n' + header)
+    while pos >= 0:
+        starts.append(pos + 1)
+        pos = fmap.find('\n' + header, pos + 1)
+
+    size = fmap.size()
+    if not starts:
+        return size, size
+    if len(starts) > 1:
+        return None
+
+    # The next line starting with "[" and with a "]" after it
+    start = starts[0]
+    pos = fmap.find('\n[', start)
+    while pos >= 0:
+        eol = fmap.find('\n', pos + 1)
+        if eol < 0:
+            eol = size
+        if fmap.find(']', pos + 2, eol) >= 0:
+            return start, pos + 1
+        pos = fmap.find('\n[', pos + 1)
+    return start, size
+
+
+def file_range(fmap, start, end):
+    # Chunks of a byte range of a memory mapped file
+    # Usage: for chunk in file_range(MMAP, START, END)
+    for pos in xrange(start, end, CHUNK_SIZE):
+        yield fmap[pos:min(pos + CHUNK_SIZE, end)]
+
+
+def file_lines(fmap, start, end, count):
+    # The last "count" lines of a memory mapped file before the position
+    # "start", and the first "count" lines from the position "end" (both
+    # at the start of a line)
+    # Usage: before, after = file_lines(MMAP, START, END, 3)
+    before = []
+    if start:
+        pos = start - 1
+        for i in xrange(count):
+            pos = fmap.rfind('\n', 0, pos)
+            if pos < 0:
+                break
+        before = fmap[pos+1:start-1].split('\n')
+    pos = end
+    for i in xrange(count):
+        pos = fmap.find('\n', pos) + 1
+        if not pos:
+            pos = fmap.size()
+            break
+    after = fmap[end:pos].split('\n')
+    if after[-1] == '':
+        after.pop()
+    return [line.rstrip() for line in before], \
+        [line.rstrip() for line in after]
+
+
+def find_files(paths, pattern='*', recursive=False):
+    # Expand a list of paths into config files: wildcards are expanded and
+    # directories are searched (also subdirectories if recursive) for files
+    # matching the glob pattern
+    # Usage: find_files(LIST_OF_PATHS, GLOB_PATTERN, RECURSIVE)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            import fnmatch
+            if recursive:
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(fnmatch.filter(names, pattern)):
+                        files.append(os.path.join(root, name))
+            else:
+                for name in sorted(fnmatch.filter(os.listdir(path), pattern)):
+                    if os.path.isfile(os.path.join(path, name)):
+                        files.append(os.path.join(path, name))
+        elif any(char in path for char in '*?['):
+            import glob
+            files.extend(sorted(glob.glob(path)))
+        else:
+            files.append(path)
+    return files
+
+
+def process_file(opts):
+    # Run cskv(**opts).process() on one file, without exiting on errors
+    # Returns a dictionary with the result:
+    #   {'config_file': FILE, 'ok': True/False, 'changed': True/False,
+    #    'error': MESSAGE, 'output': LINES (only for compare, get and
+    #    diff),
+    #    'stats': PHASES (only with the stats option, see cstats.dump)}
+    # Usage: process_file(OPTIONS_DICTIONARY)
+    result = {'config_file': opts['config_file'], 'ok': True,
+              'changed': False, 'error': None, 'output': None}
+    try:
+        cfile = cskv(**opts)
+        output = cfile.process()
+        result['changed'] = cfile.changed
+        if cfile.stats:
+            result['stats'] = cfile.stats.dump()
+        if opts.get('compare') or opts.get('get') is not None or \
+                opts.get('where') is not None or opts.get('diff'):
+            result['output'] = output
+        if getattr(cfile, 'missing', None):
+            result['ok'] = False
+            result['error'] = 'missing key(s): ' + ', '.join(cfile.missing)
+    except (SystemExit, Exception) as e:
+        result['ok'] = False
+        result['error'] = error_text(e)
+    return result
+
+
+def error_text(error):
+    # Message of an exception, or of a sys.exit() of cskv
+    # Usage: error_text(EXCEPTION)
+    if not isinstance(error, SystemExit):
+        return type(error).__name__ + ': ' + str(error)
+    elif isinstance(error.code, basestring):
+        return error.code
+    elif error.code is None:
+        return 'error (details with --verbosity 1)'
+    return 'exited with code ' + str(error.code)
+
+
+def process_files(files, opts, jobs=1):
+    # Apply the same options (change, delete, extra, compare) to many files
+    # using a pool of "jobs" processes
+    # Returns a generator of process_file() results, in the order of files
+    # Usage: process_files(LIST_OF_FILES, OPTIONS_DICTIONARY, JOBS)
+    all_opts = [dict(opts, config_file=config_file) for config_file in files]
+    return map_files(process_file, all_opts, jobs)
+
+
+def map_files(worker, all_opts, jobs=1):
+    # Results of worker(opts) for each dictionary of options (one for each
+    # file), in order, using a pool of "jobs" processes
+    # Usage: for result in map_files(process_file, LIST_OF_OPTIONS, JOBS)
+    if jobs > 1 and len(all_opts) > 1:
+        # Only needed (and imported) when running in parallel
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        chunksize = max(1, len(all_opts) // (jobs * 4))
+        try:
+            for result in pool.imap(worker, all_opts, chunksize):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for file_opts in all_opts:
+            yield worker(file_opts)
+
+
+def read_manifest(file_name):
+    # Desired state of many files: the keys to set or delete in each
+    # section of each file, in INI format:
+    #     [/etc/ssh/sshd_config]
+    #     UseDNS = no
+    #     -PermitRootLogin
+    #     [/etc/samba/smb.conf:global]
+    #     passdb backend = tdbsam
+    # ("-KEY" deletes the key, and ":SECTION" is only for INI files), or in
+    # JSON format (null deletes the key, "" is the section of RAW files):
+    #     {"/etc/ssh/sshd_config": {"": {"UseDNS": "no",
+    #                                    "PermitRootLogin": null}},
+    #      "/etc/samba/smb.conf": {"global": {"passdb backend": "tdbsam"}}}
+    # Returns the operations grouped by file, in the order of the manifest:
+    #   [[FILE, [['set'|'delete', SECTION, KEY, VALUE], ..]], ..]
+    # Usage: read_manifest(MANIFEST_FILE)
+    from collections import OrderedDict
+    try:
+        with open(file_name) as infile:
+            text = infile.read()
+    except IOError as e:
+        sys.exit('ERROR: can not read the manifest ' + file_name + ': ' +
+                 str(e))
+
+    plan = OrderedDict()
+    if text.lstrip().startswith('{'):
+        import json
+        try:
+            files = json.loads(text, object_pairs_hook=OrderedDict)
+        except ValueError as e:
+            sys.exit('ERROR: wrong JSON manifest ' + file_name + ': ' +
+                     str(e))
+        for config_file, sections in files.items():
+            ops = plan.setdefault(os.path.abspath(config_file), [])
+            if not isinstance(sections, dict) or \
+                    not all(isinstance(keys, dict)
+                            for keys in sections.values()):
+                sys.exit('ERROR: manifest ' + file_name + ': the value of "' +
+                         config_file + '" has to be {SECTION: {KEY: VALUE}}')
+            for section, keys in sections.items():
+                section = section.encode('utf-8') or None
+                for key, value in keys.items():
+                    key = key.encode('utf-8')
+                    if value is None:
+                        ops.append(['delete', section, key, None])
+                        continue
+                    if isinstance(value, unicode):
+                        value = value.encode('utf-8')
+                    elif not isinstance(value, str):
+                        value = json.dumps(value)
+                    ops.append(['set', section, key, value])
+        return plan.items()
+
+    ops = None
+    for num, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith(('#', ';')):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            config_file, colon, section = line[1:-1].partition(':')
+            section = section.strip() or None
+            ops = plan.setdefault(os.path.abspath(config_file.strip()), [])
+        elif ops is None:
+            sys.exit('ERROR: manifest ' + file_name + ' line ' + str(num) +
+                     ': key before the first [FILE]')
+        elif line.startswith('-'):
+            ops.append(['delete', section, line[1:].strip(), None])
+        else:
+            key, equal, value = line.partition('=')
+            ops.append(['set', section, key.strip(), value.strip()])
+    return plan.items()
+
+
+def manifest_runs(ops):
+    # Group the consecutive operations of a file (see read_manifest) which
+    # can be applied at once: sets (cskv.merge), and deletes of the same
+    # section (cskv.delete_many)
+    # Returns [['set'|'delete', SECTION, [[SECTION, KEY, VALUE], ..]], ..]
+    # Usage: for op, section, skvs in manifest_runs(OPERATIONS)
+    runs = []
+    for op, section, key, value in ops:
+        if runs and runs[-1][0] == op and \
+                (op == 'set' or runs[-1][1] == section):
+            runs[-1][2].append([section, key, value])
+        else:
+            runs.append([op, section, [[section, key, value]]])
+    return runs
+
+
+def apply_file(opts):
+    # Apply the operations of a manifest (opts['ops'], see read_manifest) to
+    # one file, which is read and parsed once and written once (only if it
+    # changed, and not with the diff or test options)
+    # Returns a dictionary like process_file (the output is the diff)
+    # Usage: apply_file(OPTIONS_DICTIONARY)
+    result = {'config_file': opts['config_file'], 'ok': True,
+              'changed': False, 'error': None, 'output': None}
+    kwargs = dict(opts)
+    ops = kwargs.pop('ops')
+    try:
+        session = csession(**kwargs)
+        for op, section, skvs in manifest_runs(ops):
+            if op == 'set':
+                session.merge(skvs)
+            else:
+                session.delete_many(section, [key for sec, key, val in skvs])
+        if opts.get('diff'):
+            result['output'] = session.cfile.doc.diff(opts['config_file'])
+            result['changed'] = bool(result['output'])
+        elif opts.get('test'):
+            result['output'] = session.lines()
+            result['changed'] = result['output'] != session.cfile.icontent
+        else:
+            result['changed'] = session.commit()
+    except (SystemExit, Exception) as e:
+        result['ok'] = False
+        result['error'] = error_text(e)
+    return result
+
+
+def apply_manifest(manifest, jobs=1, **kwargs):
+    # Apply a manifest (see read_manifest) to all its files, with a pool of
+    # "jobs" processes. The keyword arguments are the same as for cskv
+    # (indent, sep, diff, test...)
+    # Returns a generator of apply_file() results, in the order of files
+    # Usage: for result in apply_manifest(MANIFEST_FILE, 4)
+    all_opts = [dict(kwargs, config_file=config_file, ops=ops)
+                for config_file, ops in read_manifest(manifest)]
+    return map_files(apply_file, all_opts, jobs)
+
+
+# Snapshots of the included files, by file identity (see
+# cskv.include_snapshot)
+include_snapshots = {}
+
+
+# Snapshot of the baseline of drift(), in each process of the pool
+drift_baseline = []
+
+
+def drift_init(baseline):
+    # Keep the baseline (csnapshot.dump) for drift_file
+    drift_baseline[:] = [csnapshot(**baseline)]
+
+
+def drift_file(opts):
+    # Differences of one file with the baseline of drift (see drift_init)
+    # Returns {'config_file': FILE, 'error': MESSAGE or None,
+    #          'diffs': [[SECTION, KEY, CHANGE, VALUE], ..]}
+    # Usage: drift_file(OPTIONS_DICTIONARY)
+    result = {'config_file': opts['config_file'], 'error': None,
+              'diffs': []}
+    try:
+        cfile = cskv(**dict(opts, lazy=True))
+        for diff in cfile.diff_confs(drift_baseline[0], cfile.snapshot()):
+            result['diffs'].append([diff['section'], diff['key'],
+                                    diff['change'], diff['b']])
+    except (SystemExit, Exception) as e:
+        result['error'] = error_text(e)
+    return result
+
+
+def drift(baseline, files, jobs=1, **kwargs):
+    # Compare many files (e.g. the copies of a config file in many hosts)
+    # with one baseline file, which is parsed only once, with a pool of
+    # "jobs" processes. The other options are the same as for cskv (like
+    # cache_dir)
+    # Returns {'baseline': FILE, 'files': NUMBER, 'drifted': NUMBER,
+    #          'failed': [[FILE, ERROR], ..],
+    #          'keys': [{'section': S, 'key': K, 'baseline': VALUE,
+    #                    'hosts': NUMBER OF FILES WITH ANOTHER VALUE,
+    #                    'divergences': [{'change': C, 'value': V,
+    #                                     'files': [FILE, ..]}, ..]}, ..]}
+    # where the change is "added", "removed" or "changed" (see diff_confs)
+    # Usage: drift(BASELINE_FILE, LIST_OF_FILES, JOBS)
+    if not os.path.isfile(baseline):
+        sys.exit('ERROR: the baseline ' + baseline + ' is not a file')
+    kwargs.update({'config_file': baseline, 'lazy': True})
+    base = cskv(**kwargs).snapshot()
+    baseline = os.path.abspath(baseline)
+    files = [name for name in files if os.path.abspath(name) != baseline]
+    all_opts = [dict(kwargs, config_file=name, compare=baseline)
+                for name in files]
+
+    if jobs > 1 and len(files) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, drift_init, (base.dump(),))
+        chunksize = max(1, len(files) // (jobs * 4))
+        try:
+            results = pool.map(drift_file, all_opts, chunksize)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        drift_init(base.dump())
+        results = [drift_file(file_opts) for file_opts in all_opts]
+
+    report = {'baseline': baseline, 'files': len(files), 'drifted': 0,
+              'failed': [], 'keys': []}
+    keys = {}
+    for result in results:
+        if result['error']:
+            report['failed'].append([result['config_file'],
+                                     result['error']])
+            continue
+        if result['diffs']:
+            report['drifted'] += 1
+        for section, key, change, value in result['diffs']:
+            if (section, key) not in keys:
+                keys[(section, key)] = {
+                    'section': section, 'key': key, 'hosts': 0,
+                    'baseline': base.keyvals.get(section, {}).get(key),
+                    'divergences': {}}
+            entry = keys[(section, key)]
+            entry['hosts'] += 1
+            entry['divergences'].setdefault((change, value), []).append(
+                result['config_file'])
+
+    for entry in sorted(keys.values(), key=lambda entry: (
+            -entry['hosts'], entry['section'], entry['key'])):
+        entry['divergences'] = [
+            {'change': change, 'value': value, 'files': names}
+            for (change, value), names in sorted(
+                entry['divergences'].items(),
+                key=lambda item: (-len(item[1]), item[0]))]
+        report['keys'].append(entry)
+    return report
+
+
+def drift_lines(report):
+    # Text report of drift(), as a list of lines
+    # Usage: for line in drift_lines(REPORT)
+    lines = ['Drift against ' + report['baseline'] + ': ' +
+             str(report['drifted']) + ' of ' + str(report['files']) +
+             ' files differ, ' + str(len(report['failed'])) + ' failed']
+    for entry in report['keys']:
+        name = entry['key']
+        if entry['section']:
+            name = '[' + entry['section'] + '] ' + name
+        if entry['baseline'] is None:
+            base = 'not in baseline'
+        else:
+            base = 'baseline: "' + entry['baseline'] + '"'
+        lines.append('  ' + name + ' (' + base + '): ' +
+                     str(entry['hosts']) + ' files')
+        for div in entry['divergences']:
+            if div['change'] == 'removed':
+                what = 'removed'
+            else:
+                what = div['change'] + ' to "' + str(div['value']) + '"'
+            lines.append('      ' + what + ': ' + str(len(div['files'])) +
+                         ' files')
+            for name in div['files']:
+                lines.append('          ' + name)
+    for name, error in report['failed']:
+        lines.append('FAILED    ' + name + ': ' + error)
+    return lines
+
+
+def utf8(data):
+    # JSON strings are unicode in Python 2, but files are handled as bytes
+    # Usage: utf8(JSON_DATA)
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    elif isinstance(data, list):
+        return [utf8(item) for item in data]
+    elif isinstance(data, dict):
+        return dict((utf8(key), utf8(value)) for key, value in data.items())
+    return data
+
+
+class cserver(object):
+    # Daemon on a local Unix socket, keeping the tokenized files in memory
+    # between requests. A file is only read again when its identity (see
+    # file_identity) changed. Requests and responses are lines of JSON:
+    #   {"op": "set", "file": F, "section": S, "key": K, "value": V}
+    #   {"op": "delete", "file": F, "section": S, "key": K}
+    #   {"op": "get", "file": F, "section": S, "key": K}
+    #   {"op": "merge", "file": F, "extra": [LINES]}
+    #   {"op": "compare", "file": F, "compare": F2}
+    #   {"op": "cli", "argv": [ARGUMENTS], "cwd": DIR, "extra": [LINES]}
+    # Relative paths are relative to "cwd" (of the client), which every
+    # request can give (the directory of the daemon by default).
+    # Each response has "ok" (true/false) and "error", plus "changed",
+    # "found"/"value", "diffs" or "code"/"stdout"/"stderr" (for "cli").
+    # Each connection is read by its own thread, so that an idle client
+    # does not block the others, but requests are handled one at a time.
+    # Usage: cserver(SOCKET_PATH).serve()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        # Real path of a file => [identity, lines, tokenized document]
+        self.docs = {}
+        # cskv objects created for the current request
+        self.used = []
+
+    def cskv(self, **opts):
+        # A cskv object which reuses the document of the file if it did
+        # not change since the last request
+        cfile = cskv(lazy=True, **opts)
+        name = os.path.realpath(cfile.config_file)
+        # The document is changed in place: it is kept again only if the
+        # request succeeds
+        warm = self.docs.pop(name, None)
+        if warm and os.path.isfile(name) and warm[0] == file_identity(name):
+            cfile.load(warm[1], warm[2])
+        self.used.append(cfile)
+        return cfile
+
+    def keep(self):
+        # Keep the documents of the last request, if they are the same as
+        # the files (they were written, or they did not change)
+        for cfile in self.used:
+            kwargs = cfile.kwargs
+            if 'doc' not in cfile.__dict__ or kwargs.get('stream') or \
+                    kwargs.get('mmap') or \
+                    ((kwargs['test'] or kwargs['diff']) and
+                     getattr(cfile, 'changed', False)):
+                continue
+            name = os.path.realpath(cfile.config_file)
+            if os.path.isfile(name):
+                self.docs[name] = [file_identity(name), cfile.doc.lines(),
+                                   cfile.doc]
+        self.used = []
+
+    def request(self, request):
+        # Handle one request, returns the response
+        # Usage: request(REQUEST_DICTIONARY)
+        self.used = []
+        response = {'ok': True, 'error': None}
+        try:
+            op = request.get('op')
+            missing = [field for field in SERVER_FIELDS.get(op, [])
+                       if request.get(field) is None]
+            if missing:
+                sys.exit('ERROR: the "' + op + '" request needs "' +
+                         '", "'.join(SERVER_FIELDS[op]) + '" (missing "' +
+                         '", "'.join(missing) + '")')
+            cwd = request.get('cwd') or ''
+            if op == 'cli':
+                response.update(self.cli(request))
+            elif op in ('set', 'delete', 'get', 'merge', 'compare'):
+                opts = {'config_file': os.path.join(cwd, request['file']),
+                        'section': request.get('section'),
+                        'key': request.get('key'),
+                        'value': request.get('value')}
+                if op == 'delete':
+                    opts['delete'] = True
+                elif op == 'merge':
+                    opts['extra_conf'] = request.get('extra') or []
+                elif op == 'compare':
+                    opts['compare'] = os.path.join(cwd, request['compare'])
+                    opts['key'] = None
+                cfile = self.cskv(**opts)
+
+                if op == 'get':
+                    keyvals = cfile.get_keyvals(cfile.doc, opts['section'])
+                    kstr = opts['key'].strip()
+                    response['found'] = kstr in keyvals
+                    response['value'] = keyvals.get(kstr)
+                elif op == 'compare':
+                    response['diffs'] = list(cfile.diff_confs())
+                else:
+                    cfile.process()
+                    response['changed'] = cfile.changed
+            else:
+                response.update({'ok': False,
+                                 'error': 'unknown op: ' + str(op)})
+            if response['ok']:
+                self.keep()
+        except SystemExit as e:
+            response['ok'] = False
+            if isinstance(e.code, basestring):
+                response['error'] = e.code
+            else:
+                response['error'] = 'error (details with --verbosity 1)'
+        except Exception as e:
+            response['ok'] = False
+            response['error'] = type(e).__name__ + ': ' + str(e)
+        self.used = []
+        return response
+
+    def cli(self, request):
+        # Run the command line tool as if it was called from "cwd"
+        # Returns {"code": EXIT_CODE, "stdout": TEXT, "stderr": TEXT}
+        from StringIO import StringIO
+        stdout, stderr = sys.stdout, sys.stderr
+        out, err = StringIO(), StringIO()
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.get('cwd') or cwd)
+            sys.stdout, sys.stderr = out, err
+            code = main(request['argv'], request.get('extra') or [],
+                        self.cskv)
+        except SystemExit as e:
+            code = e.code
+            if isinstance(code, basestring):
+                err.write(code + '\n')
+                code = 1
+            elif code is None:
+                code = 0
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(cwd)
+        if code:
+            # Do not keep documents of failed commands
+            self.used = []
+        return {'code': code, 'stdout': out.getvalue(),
+                'stderr': err.getvalue()}
+
+    def serve(self):
+        # Listen on the socket until killed (SIGTERM or Ctrl+C)
+        import socket
+        import signal
+        import json
+
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                sys.exit('ERROR: a daemon is already listening on ' +
+                         self.path)
+            except socket.error:
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the owner of the daemon can send it requests
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        import threading
+        # The requests change the documents, the working directory and
+        # stdout (see cli): one at a time
+        lock = threading.Lock()
+
+        def handle(conn):
+            # Requests of one connection, until it is closed (or idle for
+            # 60 seconds)
+            conn.settimeout(60)
+            try:
+                rfile = conn.makefile('rb')
+                for line in iter(rfile.readline, ''):
+                    if not line.strip():
+                        continue
+                    try:
+                        request = utf8(json.loads(line))
+                    except ValueError as e:
+                        response = {'ok': False,
+                                    'error': 'invalid JSON: ' + str(e)}
+                    else:
+                        with lock:
+                            response = self.request(request)
+                    conn.sendall(json.dumps(response) + '\n')
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+        try:
+            while True:
+                conn, addr = sock.accept()
+                thread = threading.Thread(target=handle, args=[conn])
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        return 0
+
+
+def client(path, argv):
+    # Run the command line tool in a daemon (see cserver), with the same
+    # arguments, output and exit code
+    # Usage: sys.exit(client(SOCKET_PATH, LIST_OF_ARGUMENTS))
+    import socket
+    import json
+    request = {'op': 'cli', 'argv': argv, 'cwd': os.getcwd(),
+               'extra': extra_config(argv, sys.stdin)}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+        line = sock.makefile('rb').readline()
+    except socket.error as e:
+        sys.exit('ERROR: no daemon on ' + path + ': ' + str(e))
+    finally:
+        sock.close()
+
+    response = utf8(json.loads(line))
+    if not response['ok']:
+        sys.exit('ERROR: ' + response['error'])
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['code']
+
+
+def quick_args(argv):
+    # Options of the common calls (one file, section, key, value, indent,
+    # separator, delete, test and get), parsed without building the
+    # argparse parser. Returns None for anything else (other options,
+    # several files, values starting with "-", help...), which needs
+    # cli_parser()
+    # Usage: opts = quick_args(LIST_OF_ARGUMENTS)
+    opts = dict(CLI_DEFAULTS)
+    config_file = None
+    idx = 0
+    while idx < len(argv):
+        arg = argv[idx]
+        idx += 1
+        if arg in CLI_FLAGS:
+            opts[CLI_FLAGS[arg]] = True
+        elif arg in CLI_VALUES:
+            if idx == len(argv) or argv[idx].startswith('-'):
+                return None
+            opts[CLI_VALUES[arg]] = argv[idx]
+            idx += 1
+        elif arg in CLI_LISTS:
+            values = []
+            while idx < len(argv) and not argv[idx].startswith('-'):
+                values.append(argv[idx])
+                idx += 1
+            opts[CLI_LISTS[arg]] = values
+        elif arg.startswith('-') or config_file is not None:
+            return None
+        else:
+            config_file = arg
+    if config_file is None:
+        return None
+    opts['config_file'] = [config_file]
+    return opts
+
+
+def cli_parser():
+    # Parser of the command line arguments
+    # Usage: cli_parser().parse_args(LIST_OF_ARGUMENTS)
     import argparse
     from argparse import RawTextHelpFormatter
 
@@ -592,12 +3913,36 @@ if __name__ == "__main__":
          cksv /etc/samba/smb.conf -s global -k "passdb backend" -v tdbsam
       - Change value in a raw config file.
          cksv /etc/ssh/sshd_config -k PasswordAuthentication -v no
+      - Show what would change, without writing (exit code 4 if it would):
+         cskv /etc/ssh/sshd_config -k PasswordAuthentication -v no --diff
       - Merge the content of some file into our config:
          cskv /etc/samba/smb.conf -e extra_conf.ini
       - Delete line containing key/starting with "PermitRootLogin":
          cskv /etc/ssh/sshd_config -k "PermitRootLogin" --delete
+      - Print a value (exit code 3 if it is missing):
+         cskv /etc/samba/smb.conf -s global -k "passdb backend" --get
+      - Effective value of a key, and where it is defined, with includes:
+         cskv /etc/ssh/sshd_config -k PasswordAuthentication --get --includes
+         cskv /etc/ssh/sshd_config -k PasswordAuthentication --where \\
+             --includes
+      - Delete many (deprecated) keys of all the sections at once:
+         cskv /etc/app.ini --delete-keys old1 old2 --delete-glob "legacy_*" \\
+             --all-sections
       - Compare two config files:
          cskv /etc/samba/smb.conf --compare /root/old_smb.conf
+      - Compare the copies of a file in many hosts with a baseline:
+         cskv /srv/hosts/ -r --glob smb.conf --drift golden_smb.conf -j 8
+      - Apply the keys of a manifest to all its files:
+         cskv --apply desired_state.ini -j 4
+      - Change a value in many files, with 4 processes:
+         cskv /srv/images/ -r --glob sshd_config -k UseDNS -v no -j 4
+      - Change a value in a huge environment file, with constant memory:
+         cskv /srv/app/generated.env -k LOG_LEVEL -v debug --stream
+      - Change a value in one section of a huge INI file:
+         cskv /srv/export.ini -s db -k timeout -v 30 --mmap
+      - Run a daemon, and send it the arguments of cskv:
+         cskv --serve /run/cskv.sock
+         cskv --client /run/cskv.sock /etc/ssh/sshd_config -k UseDNS -v no
     '''
 
     description_text = '''
@@ -611,7 +3956,7 @@ if __name__ == "__main__":
                       formatter_class=RawTextHelpFormatter
                       )
 
-    parser.add_argument('config_file', type=str, nargs='+',
+    parser.add_argument('config_file', type=str, nargs='*',
                         help='Configuration file name or path to it'
                         )
 
@@ -637,6 +3982,30 @@ if __name__ == "__main__":
                         help='Compare the config file with this one.\n'
                         )
 
+    parser.add_argument('--apply', type=str, metavar='MANIFEST',
+                        help='Set and delete the keys listed by a manifest\n'
+                        '(INI or JSON) in many files: each file is read\n'
+                        'and written once, and only if it changed. INI:\n'
+                        '  [FILE] or [FILE:SECTION]\n'
+                        '  KEY = VALUE\n'
+                        '  -KEY_TO_DELETE\n'
+                        'JSON: {FILE: {SECTION: {KEY: VALUE or null}}}\n'
+                        )
+
+    parser.add_argument('--drift', type=str, metavar='BASELINE',
+                        help='Compare all the given files (or the files\n'
+                        'found in directories, see -r and --glob) with\n'
+                        'this baseline, with -j processes, and print how\n'
+                        'many files differ in each key, and which ones.\n'
+                        )
+
+    parser.add_argument('--format', type=str, default='text',
+                        choices=['text', 'json'],
+                        help='Output format of --compare. "json" prints one\n'
+                        'object per difference: section, key, change\n'
+                        '(added, removed, changed), a and b values.\n'
+                        )
+
     parser.add_argument('--sep', type=str,
                         help='Separator between key and value'
                         )
@@ -645,16 +4014,133 @@ if __name__ == "__main__":
                         help='Delete line(s) defining a key (in section)'
                         )
 
+    parser.add_argument('--delete-keys', type=str, nargs='+', metavar='KEY',
+                        help='Delete the lines of all these keys (in one\n'
+                        'pass, like -d for each key)\n'
+                        )
+
+    parser.add_argument('--delete-glob', type=str, nargs='+',
+                        metavar='PATTERN',
+                        help='Delete the lines whose key matches one of\n'
+                        'these glob patterns (e.g. "old_*")\n'
+                        )
+
+    parser.add_argument('--delete-regex', type=str, nargs='+',
+                        metavar='REGEX',
+                        help='Delete the lines whose key contains a match\n'
+                        'of one of these regular expressions\n'
+                        )
+
+    parser.add_argument('--all-sections', action='store_true',
+                        help='Delete the keys (--delete-keys, --delete-glob,\n'
+                        '--delete-regex) in all the sections of INI files\n'
+                        )
+
     parser.add_argument('-t', '--test', action='store_true',
                         help='Print output to stdout instead of the file'
                         )
 
+    parser.add_argument('--diff', action='store_true',
+                        help='Print a unified diff of the changes instead\n'
+                        'of writing them (dry run). Exit code 4 if the\n'
+                        'file would change.\n'
+                        )
+
     parser.add_argument('-e', '--extra', nargs='*',
                         type=str, default='-',
                         help='Use this option to parse extra values.\n'
                              'Works with pipes and/or files'
                         )
 
+    parser.add_argument('--batch', type=int, metavar='N',
+                        help='Read the extra config (-e) while merging it,\n'
+                        'in batches of N key/values, and print the\n'
+                        'progress (to stderr). The memory does not grow\n'
+                        'with the size of the extra config. With --stream\n'
+                        'each batch is one pass over the file.\n'
+                        )
+
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Search config files also in subdirectories\n'
+                        'of the given directories'
+                        )
+
+    parser.add_argument('--glob', type=str, default='*',
+                        help='Pattern of the file names to search in the\n'
+                        'given directories. Def. "*" (all files)'
+                        )
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes for handling many files'
+                        )
+
+    parser.add_argument('--serve', type=str, metavar='SOCKET',
+                        help='Run as a daemon on this Unix socket (it has\n'
+                        'to be the only argument)\n'
+                        )
+
+    parser.add_argument('--client', type=str, metavar='SOCKET',
+                        help='Send the rest of the arguments to a daemon\n'
+                        '(it has to be the first argument)\n'
+                        )
+
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory to keep the analysis of the files\n'
+                        'between runs (used by --compare while the files\n'
+                        'do not change)\n'
+                        )
+
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='Size limit of the cache directory in MB.\n'
+                        'Def. 64\n'
+                        )
+
+    parser.add_argument('--mmap', action='store_true',
+                        help='Change one key of a big INI file reading only\n'
+                        'its section (the rest is copied unchanged).\n'
+                        )
+
+    parser.add_argument('--stream', action='store_true',
+                        help='Read, change and write RAW files line by line,\n'
+                        'with constant memory (for very big files). The\n'
+                        'format is guessed on the first lines only.\n'
+                        )
+
+    parser.add_argument('--get', type=str, nargs='*', metavar='KEY',
+                        help='Print the value of the key (-k) or of the\n'
+                        'given keys (as KEY<tab>VALUE), without changing\n'
+                        'the file. Only the file until the end of the\n'
+                        'section is read. Exit code 3 if a key is missing.\n'
+                        )
+
+    parser.add_argument('--where', type=str, nargs='*', metavar='KEY',
+                        help='Print the file and line (FILE:LINE) where the\n'
+                        'key (-k) or the given keys are defined, like\n'
+                        '--get. Exit code 3 if a key is missing.\n'
+                        )
+
+    parser.add_argument('--includes', action='store_true',
+                        help='Follow the include directives (Include,\n'
+                        'include =, !include, !includedir) and FILE.d/\n'
+                        'directories for --get, --where and --compare.\n'
+                        'The included files are read where the directive\n'
+                        'is (FILE.d/ at the end of FILE). The first value\n'
+                        'of a key wins in space separated files (sshd),\n'
+                        'the last one in the rest (samba, MySQL).\n'
+                        )
+
+    parser.add_argument('--stats', action='store_true',
+                        help='Print (to stderr) the time and calls of each\n'
+                        'phase: read, detect, guess, lookup, edit, render,\n'
+                        'write... (added up for many files)\n'
+                        )
+
+    parser.add_argument('--profile', action='store_true',
+                        help='Print (to stderr) the profile of the run\n'
+                        '(cProfile) and its peak memory. With -j, only of\n'
+                        'the main process.\n'
+                        )
+
     parser.add_argument('--verbosity', type=int, default=0,
                         choices=[0, 1, 2, 3],
                         help='Verbosity level:\n'
@@ -675,57 +4161,202 @@ if __name__ == "__main__":
                         '      variable2=value2)\n'
                         )
 
-    args = parser.parse_args()
-
-    opts = {}
-    for arg in vars(args):
-        opts.update({arg: getattr(args, arg)})
-
-    opts = {'interactive': True}
-    for arg in vars(args):
-        opts.update({arg: getattr(args, arg)})
-
-    opts.update({'config_file': opts['config_file'][0]})
+    return parser
 
-    if opts['compare']:
-        opts.update({'compare': opts['compare']})
 
+def extra_config(argv, stdin):
     # Parse extra config lines from pipeline or a file (or both)
-    def extra_config(argv):
-        parg_idx = False
-        for i, arg in enumerate(sys.argv):
-            if arg == '-e' or arg == '--extra':
-                parg_idx = i
-                break
-
-        extra_lines = []
-        if parg_idx:
-            if len(sys.argv) > parg_idx + 1:
-                if not sys.argv[parg_idx + 1].startswith('-'):
-                    # print 'We have a file'
-                    if os.path.isfile(sys.argv[parg_idx+1]):
-                        for line in open(sys.argv[parg_idx+1], 'r'):
-                            if len(line.strip()) > 0:
-                                extra_lines.append(line.strip())
-                else:
-                    for line in sys.stdin:
+    # Usage: extra_config(LIST_OF_ARGUMENTS, sys.stdin)
+    return list(extra_lines(argv, stdin))
+
+
+def extra_lines(argv, stdin):
+    # Same as extra_config, but the lines are read one by one, when needed
+    # Usage: for line in extra_lines(LIST_OF_ARGUMENTS, sys.stdin)
+    parg_idx = None
+    for i, arg in enumerate(argv):
+        if arg == '-e' or arg == '--extra':
+            parg_idx = i
+            break
+
+    if parg_idx is not None:
+        if len(argv) > parg_idx + 1:
+            if not argv[parg_idx + 1].startswith('-'):
+                # print 'We have a file'
+                if os.path.isfile(argv[parg_idx+1]):
+                    for line in open(argv[parg_idx+1], 'r'):
                         if len(line.strip()) > 0:
-                            extra_lines.append(line.strip())
-
+                            yield line.strip()
             else:
-                # print 'We are getting extra options from file/pipeline'
-                for line in sys.stdin:
+                for line in stdin:
                     if len(line.strip()) > 0:
-                        extra_lines.append(line.strip())
-        return extra_lines
+                        yield line.strip()
 
-    extra_config = extra_config(sys.argv)
+        else:
+            # print 'We are getting extra options from file/pipeline'
+            for line in stdin:
+                if len(line.strip()) > 0:
+                    yield line.strip()
+
+
+def main(argv=None, extra=None, factory=None):
+    # The command line tool. The extra config lines are read from the
+    # files/pipeline given with -e, unless they are given, and factory
+    # creates the cskv objects (see cserver). Returns the exit code.
+    # Usage: sys.exit(main(sys.argv[1:]))
+    if argv is None:
+        argv = sys.argv[1:]
+    if factory is None:
+        factory = cskv
+
+    # Daemon and client modes, before building the whole parser
+    if len(argv) == 2 and argv[0] == '--serve':
+        return cserver(argv[1]).serve()
+    if len(argv) > 2 and argv[0] == '--client':
+        return client(argv[1], argv[2:])
+
+    # The common calls do not need the whole parser
+    opts = quick_args(argv)
+    if opts is None:
+        parser = cli_parser()
+        opts = dict(vars(parser.parse_args(argv)))
+        if opts['apply'] and opts['config_file']:
+            parser.error('the files are given by the manifest of --apply')
+        elif not opts['apply'] and not opts['config_file']:
+            parser.error('too few arguments')
+    opts.update({'interactive': True})
+
+    paths = opts['config_file']
+    config_files = find_files(paths, opts['glob'], opts['recursive'])
+    opts.update({'config_file': config_files[0] if config_files else None})
+
+    single = config_files == paths and len(config_files) == 1
+    if extra is None and opts['batch'] and single:
+        # Read while it is merged (see cskv.merge_batches)
+        extra = extra_lines(argv, sys.stdin)
+    elif extra is None:
+        extra = extra_config(argv, sys.stdin)
+
+    opts.update({'extra_conf': extra})
+    opts.update({'cache_size': opts['cache_size'] << 20})
+
+    if opts.get('drift'):
+        return run_drift(config_files, opts)
+    if opts.get('apply'):
+        return run_apply(opts)
+
+    if not opts['profile']:
+        return run_files(config_files, opts, single, factory)
+
+    # Only needed (and imported) when profiling
+    import cProfile
+    import pstats
+    import resource
+    profiler = cProfile.Profile()
+    code = profiler.runcall(run_files, config_files, opts, single, factory)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+        'cumulative').print_stats(30)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print >> sys.stderr, 'Peak memory: %.1f MB' % (peak / 1024.0)
+    return code
+
+
+def run_drift(config_files, opts):
+    # Print the drift of the files of the command line tool (see drift)
+    # Returns the exit code: 1 if some file failed
+    # Usage: run_drift(LIST_OF_FILES, OPTIONS_DICTIONARY)
+    kwargs = dict((opt, opts[opt]) for opt in ['verbosity', 'ftype',
+                                               'cache_dir', 'cache_size'])
+    report = drift(opts['drift'], config_files, opts['jobs'], **kwargs)
+    if opts['format'] == 'json':
+        import json
+        print json.dumps(report, sort_keys=True)
+    else:
+        for line in drift_lines(report):
+            print line
+    if report['failed']:
+        return 1
+    return 0
+
+
+def run_apply(opts):
+    # Apply the manifest of the command line tool (see apply_manifest),
+    # and print a summary
+    # Returns the exit code (see run_summary)
+    # Usage: run_apply(OPTIONS_DICTIONARY)
+    kwargs = dict((opt, opts[opt]) for opt in ['verbosity', 'ftype',
+                                               'indent', 'sep', 'diff',
+                                               'test'])
+    return run_summary(apply_manifest(opts['apply'], opts['jobs'],
+                                      **kwargs), opts)
+
+
+def run_files(config_files, opts, single, factory=cskv):
+    # Process the files of the command line tool: a single file directly,
+    # many files with the same change and a summary (see main)
+    # Returns the exit code
+    # Usage: run_files(LIST_OF_FILES, OPTIONS_DICTIONARY, SINGLE, cskv)
+    if single:
+        cfile = factory(**opts)
+
+        output = cfile.process()
+        if opts['compare'] or opts.get('get') is not None or \
+                opts.get('where') is not None or opts.get('diff'):
+            for line in output:
+                print line
+        if cfile.stats:
+            for line in cfile.stats.report():
+                print >> sys.stderr, line
+        if getattr(cfile, 'missing', None):
+            return EXIT_MISSING
+        if opts.get('diff') and cfile.changed:
+            return EXIT_CHANGED
+        return 0
+
+    # Many files: the same change for all of them, and a summary
+    if not config_files:
+        print '0 files processed, 0 changed, 0 failed'
+        return 1
+    return run_summary(process_files(config_files, opts, opts['jobs']),
+                       opts)
+
+
+def run_summary(results, opts):
+    # Print the results of many files (see process_file) and a summary
+    # Returns the exit code: 1 if some file failed, 4 (EXIT_CHANGED) if
+    # some file would change with the diff option
+    # Usage: run_summary(RESULTS, OPTIONS_DICTIONARY)
+    processed, failed, changed = 0, 0, 0
+    stats = cstats() if opts.get('stats') else None
+    for result in results:
+        processed += 1
+        if result['output']:
+            for line in result['output']:
+                print line
+        if stats and result.get('stats'):
+            stats.update(result['stats'])
+        if not result['ok']:
+            failed += 1
+            print 'FAILED    ' + result['config_file'] + ': ' + \
+                result['error']
+        elif result['changed']:
+            changed += 1
+            print 'CHANGED   ' + result['config_file']
+        else:
+            print 'UNCHANGED ' + result['config_file']
 
-    opts.update({'extra_conf': extra_config})
+    print str(processed) + ' files processed, ' + \
+        str(changed) + ' changed, ' + str(failed) + ' failed'
+    if stats:
+        for line in stats.report():
+            print >> sys.stderr, line
+    if failed:
+        return 1
+    if opts.get('diff') and changed:
+        return EXIT_CHANGED
+    return 0
 
-    cfile = cskv(**opts)
 
-    output = cfile.process()
-    if opts['compare']:
-        for line in output:
-            print line
+if __name__ == "__main__":
+    # The program is being called from command line
+    sys.exit(main())
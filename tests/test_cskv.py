@@ -3,6 +3,7 @@
 import os
 import sys
 import shutil
+import time
 import re
 
 # For interactive functionality
@@ -82,6 +83,23 @@ else:
     print 'INFO: function "content" for returning content: OK'
 
 
+# cdoc (tokenized document)
+
+from cskv import cdoc, SECTION, KEYVAL, COMMENT, BLANK
+
+doc = cdoc(content)
+kinds = [rec.kind for rec in doc.records]
+
+if doc.lines() != content:
+    print 'ERROR: tokenized document does not render back the same lines'
+    sys.exit(1)
+elif kinds[0] != SECTION or BLANK not in kinds or COMMENT not in kinds:
+    print 'ERROR: lines were not classified properly:', kinds
+    sys.exit(1)
+else:
+    print 'INFO: class "cdoc" for tokenizing content: OK'
+
+
 # guess_conf_type
 
 for ftype in fprops:
@@ -142,6 +160,29 @@ for ftype in fprops:
         print ftype + '): OK'
 
 
+# analyze (memoized file format)
+
+from cskv import analyze
+
+ianalysis = analyze(fprops['ini'][0])
+if ianalysis.ftype != 'ini' or ianalysis.sep != ' = ' or \
+        ianalysis.indent != '  ':
+    print 'ERROR: function "analyze" failed for INI format'
+    sys.exit(1)
+
+opts['config_file'] = fprops['ini'][0]
+cfile = cskv(**opts)
+before = cfile.analysis
+if cfile.analysis is not before:
+    print 'ERROR: the analysis of the file was not memoized'
+    sys.exit(1)
+cfile.insert('section1', 'memoized', 'no')
+if cfile.analysis is before:
+    print 'ERROR: the analysis of the file was not invalidated after insert'
+    sys.exit(1)
+print 'INFO: function "analyze" for guessing the file format: OK'
+
+
 # section_range
 
 opts['config_file'] = fprops['ini'][0]
@@ -185,6 +226,26 @@ else:
     sys.exit(1)
 
 
+# Check that the key index follows the changes in the document
+cfile.insert('sectionA', 'newindexed', 'value')
+cfile.insert('sectionA', 'variableA', 'changed')
+found_new = cfile.doc.find('sectionA', 'newindexed')
+found_chg = cfile.doc.find('sectionA', 'variableA')
+if len(found_new) == 1 and found_chg[0].value == 'changed' and \
+        not cfile.doc.find('section1', 'newindexed'):
+    print 'INFO: section/key index after "insert": OK'
+else:
+    print 'ERROR: section/key index not updated after insert'
+    sys.exit(1)
+
+cfile.delete('sectionA', 'newindexed')
+if cfile.doc.find('sectionA', 'newindexed'):
+    print 'ERROR: section/key index not updated after delete'
+    sys.exit(1)
+else:
+    print 'INFO: section/key index after "delete": OK'
+
+
 # Check RAWE format
 opts['config_file'] = fprops['rawe'][0]
 cfile = cskv(**opts)
@@ -338,6 +399,28 @@ else:
     sys.exit(1)
 
 
+# merge (extra config in one batch)
+
+extra_c += [['section1', 'variable1', 'merged1'],
+            ['section1', 'variable2', 'merged2'],
+            ['section1', 'variable1', 'merged3'],
+            ['sectionA', 'deleteme', 'merged4']]
+
+cfile = cskv(**opts)
+for section, key, value in extra_c:
+    cfile.insert_doc(cfile.doc, section, key, value)
+one_by_one = cfile.doc.lines()
+
+cfile = cskv(**opts)
+batch = cfile.merge(cfile.doc, extra_c).lines()
+
+if batch == one_by_one:
+    print 'INFO: function "merge" (batch of extra_config): OK'
+else:
+    print 'ERROR: function "merge" differs from inserting one by one'
+    sys.exit(1)
+
+
 # process
 
 opts.pop('extra_conf', None)
@@ -377,6 +460,139 @@ for ftype in fprops:
         print 'as written file: OK'
 
 
+# process (change aware and atomic writes)
+
+opts['config_file'] = fprops['ini'][0]
+os.chmod(opts['config_file'], 0o640)
+inode = os.stat(opts['config_file']).st_ino
+cfile = cskv(**opts)
+cfile.process()
+if cfile.changed or os.stat(opts['config_file']).st_ino != inode:
+    print 'ERROR: process rewrote a file without changes'
+    sys.exit(1)
+
+opts['value'] = 'atomicvalue'
+cfile = cskv(**opts)
+cfile.process()
+fstat = os.stat(opts['config_file'])
+if not cfile.changed or fstat.st_ino == inode or \
+        fstat.st_mode & 0o777 != 0o640 or \
+        'atomicvalue' not in open(opts['config_file']).read():
+    print 'ERROR: process did not replace the file keeping permissions'
+    sys.exit(1)
+else:
+    print 'INFO: function "process" only writes changed files: OK'
+opts['value'] = 'newvalue1'
+cfile = cskv(**opts)
+cfile.process()
+
+
+# process (streaming RAW files)
+
+for ftype in ['rawe', 'rawc', 'raws']:
+    orig_file = fprops[ftype][0].replace('results', 'orig')
+    results = []
+    for stream in [False, True]:
+        sopts = {'config_file': fprops[ftype][0] + '.stream' + str(stream),
+                 'key': 'variable1', 'value': 'streamvalue',
+                 'extra_conf': ['variable2' + fprops[ftype][1] + 'extra',
+                                'newvariable' + fprops[ftype][1] + 'new'],
+                 'stream': stream}
+        shutil.copy(orig_file, sopts['config_file'])
+        cfile = cskv(**sopts)
+        cfile.process()
+        results.append([open(sopts['config_file']).read(), cfile.changed])
+
+    if results[0] != results[1] or not results[1][1] or \
+            'icontent' in cfile.__dict__:
+        print 'ERROR: streaming a', ftype, 'file gave a different result'
+        sys.exit(1)
+    else:
+        print 'INFO: option "stream" for', ftype, 'files: OK'
+
+# Deleting from a file without any key/value needs no guess
+blank_file = os.path.join(results_dir, 'blank.conf')
+with open(blank_file, 'w') as blank:
+    blank.write('\n\n\n')
+cfile = cskv(config_file=blank_file, key='variable1', delete=True,
+             stream=True)
+cfile.process()
+if cfile.changed or open(blank_file).read() != '\n\n\n':
+    print 'ERROR: streaming a delete on a blank file changed it'
+    sys.exit(1)
+else:
+    print 'INFO: option "stream" deleting on a blank file: OK'
+
+# The separator of the new keys is guessed after the delete, as process()
+# does (it changes from " = " to "=")
+results = []
+for stream in [False, True]:
+    guess_file = os.path.join(results_dir, 'guess' + str(stream) + '.rawe')
+    with open(guess_file, 'w') as guess:
+        guess.write('old = 1\nold = 2\nold = 3\nkeep=1\nkept=2\n')
+    cskv(config_file=guess_file, key='old', delete=True,
+         extra_conf=['new=3'], stream=stream).process()
+    results.append(open(guess_file).read())
+if results[0] != results[1] or results[1] != 'keep=1\nkept=2\nnew=3\n':
+    print 'ERROR: streaming guessed the separator before the delete'
+    sys.exit(1)
+else:
+    print 'INFO: option "stream" guessing after a delete: OK'
+
+
+# process (only one section of INI files)
+
+for section in ['section1', 'newsection']:
+    results = []
+    for use_mmap in [False, True]:
+        sopts = {'config_file': fprops['ini'][0] + '.mmap' + str(use_mmap),
+                 'section': section, 'key': 'variable2',
+                 'value': 'mmapvalue', 'mmap': use_mmap}
+        shutil.copy(fprops['ini'][0].replace('results', 'orig'),
+                    sopts['config_file'])
+        cfile = cskv(**sopts)
+        cfile.process()
+        results.append([open(sopts['config_file']).read(), cfile.changed])
+
+    if results[0] != results[1] or not results[1][1] or \
+            'icontent' in cfile.__dict__:
+        print 'ERROR: changing only [' + section + '] gave a different result'
+        sys.exit(1)
+    else:
+        print 'INFO: option "mmap" for [' + section + ']: OK'
+
+# A missing newline at the end of the file is added like process() does
+results = []
+for use_mmap in [False, True]:
+    mmap_file = fprops['ini'][0] + '.mmap_eol' + str(use_mmap)
+    with open(fprops['ini'][0].replace('results', 'orig')) as orig:
+        text = orig.read().rstrip('\n')
+    with open(mmap_file, 'w') as output:
+        output.write(text)
+    cskv(config_file=mmap_file, section='section1', key='variable2',
+         value='mmapvalue', mmap=use_mmap).process()
+    results.append(open(mmap_file).read())
+if results[0] != results[1] or not results[1].endswith('\n'):
+    print 'ERROR: changing only a section without a final newline failed'
+    sys.exit(1)
+else:
+    print 'INFO: option "mmap" without a final newline: OK'
+
+# The info messages of the writes are printed
+mmap_file = fprops['ini'][0] + '.mmap_info'
+shutil.copy(fprops['ini'][0].replace('results', 'orig'), mmap_file)
+cmd = ['python', cskv_cmd, mmap_file, '-s', 'section1', '-k', 'variable2',
+       '-v', 'mmapvalue', '--mmap', '--verbosity', '3']
+outs = [subprocess.check_output(cmd) for i in range(2)]
+if 'Printing output to file ' + mmap_file not in outs[0] or \
+        'Nothing changed in file ' + mmap_file not in outs[1]:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO: option "mmap" info messages: OK'
+
+
 # compare
 
 # I am using the opts['key'] and opts['value'] just for filtering the output
@@ -401,6 +617,86 @@ for ftype in fprops:
     else:
         print 'INFO: function "compare" for ', opts['config_file'], ': OK'
 
+    diffs = list(cfile.diff_confs())
+    changed = [diff for diff in diffs if diff['key'] == opts['key']]
+    if len(changed) != 1 or changed[0]['change'] != 'changed' or \
+            changed[0]['a'] != opts['value']:
+        print 'ERROR: diff_confs failed on', opts['config_file'], diffs
+        sys.exit(1)
+    else:
+        print 'INFO: function "diff_confs" for ', opts['config_file'], ': OK'
+
+
+# compare (with a cache directory)
+
+cache_dir = os.path.join(results_dir, 'cache')
+opts['config_file'] = fprops['ini'][0]
+opts['compare'] = fprops['ini'][0].replace('results', 'orig')
+expected = cskv(**opts).process()
+copts = dict(opts, cache_dir=cache_dir)
+runs = [cskv(**copts).process() for i in range(2)]
+entries = os.listdir(cache_dir)
+
+with open(opts['config_file'], 'a') as config:
+    config.write('cachedkey = cachedvalue\n')
+copts['cache_size'] = 1
+changed = cskv(**copts).process()
+
+if runs != [expected, expected] or len(entries) != 2 or \
+        not [line for line in changed if 'cachedvalue' in line] or \
+        os.listdir(cache_dir):
+    print 'ERROR: compare with a cache directory failed'
+    sys.exit(1)
+else:
+    print 'INFO: option "cache_dir" for compare: OK'
+
+# Filling a cache keeps it under its size limit
+import cskv as cskv_module
+fill_dir = os.path.join(results_dir, 'cache_fill')
+fill = cskv_module.ccache(fill_dir)
+snap = cskv(config_file=fprops['ini'][0], lazy=True).snapshot()
+fill.put(fprops['ini'][0], snap)
+entry_size = os.path.getsize(os.path.join(fill_dir, os.listdir(fill_dir)[0]))
+fill = cskv_module.ccache(fill_dir, entry_size * 10)
+for i in range(50):
+    fill.put(fprops['ini'][0], snap, ['fill', i])
+sizes = [os.path.getsize(os.path.join(fill_dir, name))
+         for name in os.listdir(fill_dir)]
+if sum(sizes) > entry_size * 10 or len(sizes) < 5:
+    print 'ERROR: the cache directory grew over its size limit'
+    sys.exit(1)
+else:
+    print 'INFO: size limit of the cache directory: OK'
+
+# The padding of a file without key/values is unknown
+blank_snap = cskv(config_file=blank_file, lazy=True).snapshot()
+if [blank_snap.indent, blank_snap.lpad, blank_snap.rpad] != [None] * 3 or \
+        [snap.indent, snap.lpad, snap.rpad] != [2, 1, 1]:
+    print 'ERROR: wrong padding in the snapshots'
+    sys.exit(1)
+
+# Truncated or foreign entries are cache misses
+import marshal
+identity = fill.identity(fprops['ini'][0])
+file_hash = cskv_module.file_hash(fprops['ini'][0])
+found = []
+for snapshot in [None, 'snapshot', {}, {'hash': file_hash},
+                 {'hash': file_hash, 'keyvals': 5},
+                 {'hash': file_hash, 'other': 1}]:
+    data = {'version': cskv_module.CACHE_VERSION, 'identity': identity}
+    if snapshot is not None:
+        data['snapshot'] = snapshot
+    with open(fill.entry(identity), 'wb') as entry:
+        marshal.dump(data, entry)
+    found.append(fill.get(fprops['ini'][0]))
+if found != [None] * 6:
+    print 'ERROR: broken cache entries were used'
+    sys.exit(1)
+else:
+    print 'INFO: broken entries of the cache directory: OK'
+
+opts.pop('compare', None)
+
 
 # ######################################
 # Testing interactive (shell) interface
@@ -477,3 +773,855 @@ for ftype in ['ini', 'rawe', 'rawc', 'raws']:
         if not skip_test:
             print 'INFO:  ' + comment + ' (ftype=' + ftype.upper() + '):',
             print test_value(ftype, sec, key, value, extra_opt, extra_val)
+
+
+# Same change on many files (directory, recursive, in parallel)
+
+multi_dir = os.path.join(results_dir, 'multi')
+os.makedirs(os.path.join(multi_dir, 'subdir'))
+for ftype in ['rawe', 'rawc']:
+    shutil.copy(os.path.join(orig_dir, 'testfile.' + ftype), multi_dir)
+    shutil.copy(os.path.join(orig_dir, 'testfile.' + ftype),
+                os.path.join(multi_dir, 'subdir'))
+
+cmd = ['python', cskv_cmd, multi_dir, '-r', '--glob', 'testfile.raw*',
+       '-k', 'multifile', '-v', 'multivalue', '-j', '2']
+out = subprocess.check_output(cmd)
+
+fail_test = '4 files processed, 4 changed, 0 failed' not in out
+for root, dirs, names in os.walk(multi_dir):
+    for name in names:
+        if 'multivalue' not in open(os.path.join(root, name)).read():
+            fail_test = True
+
+if fail_test:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Same key/val on many files (-r, -j 2): OK'
+
+cmd = ['python', cskv_cmd, multi_dir, os.path.join(results_dir, 'missing'),
+       '-k', 'multifile', '-v', 'multivalue']
+if subprocess.call(cmd, stdout=open(os.devnull, 'w')) == 0:
+    print 'ERROR: failures on many files should give a non zero exit code'
+    sys.exit(1)
+else:
+    print 'INFO:  Exit code with a failing file among many: OK'
+
+
+# Daemon (--serve) and client (--client)
+
+sock_path = os.path.join(results_dir, 'cskv.sock')
+daemon = subprocess.Popen(['python', cskv_cmd, '--serve', sock_path])
+for i in range(100):
+    if os.path.exists(sock_path):
+        break
+    time.sleep(0.05)
+
+# An idle client does not block the others
+import socket
+idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+idle.connect(sock_path)
+
+daemon_file = os.path.join(results_dir, 'testfile.rawc')
+cmd = ['python', cskv_cmd, '--client', sock_path, daemon_file,
+       '-k', 'daemonkey', '-v', 'daemonvalue']
+start = time.time()
+code_set = subprocess.call(cmd)
+waited = time.time() - start
+cmd_ini = ['python', cskv_cmd, '--client', sock_path, fprops['ini'][0],
+           '-k', 'daemonkey', '-v', 'daemonvalue']
+code_ini = subprocess.call(cmd_ini, stdout=open(os.devnull, 'w'))
+idle.close()
+daemon.terminate()
+daemon.wait()
+
+if code_set != 0 or code_ini != 1 or os.path.exists(sock_path) or \
+        waited > 30 or \
+        'daemonvalue' not in open(daemon_file).read():
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Changes through a daemon (--serve, --client): OK'
+
+# Requests without the needed fields
+from cskv import cserver
+server = cserver(sock_path)
+responses = [server.request({'op': 'get', 'file': daemon_file}),
+             server.request({'op': 'set', 'key': 'k'}),
+             server.request({'op': 'get', 'file': daemon_file,
+                             'key': 'daemonkey'})]
+if [response['ok'] for response in responses] != [False, False, True] or \
+        'missing "key"' not in responses[0]['error'] or \
+        'missing "file", "value"' not in responses[1]['error'] or \
+        responses[2]['value'] != 'daemonvalue':
+    print 'ERROR: the daemon did not check the fields of the requests'
+    print responses
+    sys.exit(1)
+else:
+    print 'INFO:  Fields of the daemon requests: OK'
+
+# Relative paths of the requests are relative to their "cwd"
+relative = os.path.basename(daemon_file)
+responses = [server.request({'op': 'set', 'file': relative,
+                             'cwd': results_dir, 'key': 'cwdkey',
+                             'value': 'cwdvalue'}),
+             server.request({'op': 'compare', 'file': relative,
+                             'compare': os.path.join('..', 'orig', relative),
+                             'cwd': results_dir})]
+if not responses[0]['ok'] or not responses[1]['ok'] or \
+        'cwdvalue' not in open(daemon_file).read() or \
+        'cwdkey' not in [diff['key'] for diff in responses[1]['diffs']]:
+    print 'ERROR: the daemon did not use the "cwd" of the requests'
+    print responses
+    sys.exit(1)
+else:
+    print 'INFO:  Relative paths of the daemon requests: OK'
+
+
+# Start up: common calls without argparse nor the heavy modules
+
+from cskv import quick_args, cli_parser
+
+quick_argvs = [['file.ini', '-s', 'sec', '-k', 'key', '-v', 'value'],
+               ['-k', 'key', '--value', '', 'file', '-t', '--sep', ':'],
+               ['file', '-k', 'key', '-d', '-i', '    ', '--test'],
+               ['file', '-s', 'sec', '--get', 'key1', 'key2'],
+               ['file', '--get', '-k', 'key'],
+               ['file', '-k', 'key', '-v', 'value', '--diff'],
+               ['file', '--where', 'key1', 'key2', '--includes']]
+for argv in quick_argvs:
+    if quick_args(argv) != vars(cli_parser().parse_args(argv)):
+        print 'ERROR: quick_args gives other options than the parser for:'
+        print argv
+        sys.exit(1)
+for argv in [['file', '-k', 'key', '-j', '2'], ['file', 'other', '-d'],
+             ['file', '-v', '-1'], ['file', '--key=key'], ['-h'], []]:
+    if quick_args(argv) is not None:
+        print 'ERROR: quick_args should leave to the parser:'
+        print argv
+        sys.exit(1)
+print 'INFO:  Options of the common calls without the parser: OK'
+
+startup_file = os.path.join(results_dir, 'testfile.rawe')
+code = ('import sys; sys.path.insert(0, %r); import cskv; '
+        'cskv.main([%r, "-k", "startkey", "-v", "startvalue", "-t"]); '
+        'sys.stderr.write(" ".join(sys.modules))' % (cskv_dir, startup_file))
+proc = subprocess.Popen(['python', '-c', code], stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+out, modules = proc.communicate()
+heavy = set(modules.split()) & set(['argparse', 'json', 'tempfile', 'random',
+                                    'hashlib', 'mmap', 'collections', 'glob',
+                                    'fnmatch', 'socket', 'multiprocessing'])
+if 'startvalue' not in out or heavy:
+    print 'ERROR: modules imported by a common call: ' + ' '.join(heavy)
+    sys.exit(1)
+else:
+    print 'INFO:  Import budget of a common call: OK'
+
+
+def min_time(cmd, runs=5):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.call(cmd, stdout=open(os.devnull, 'w'))
+        times.append(time.time() - start)
+    return min(times)
+
+
+# Budget over the start up of python itself (generous, for slow machines)
+python_time = min_time(['python', '-c', 'pass'])
+cskv_time = min_time(['python', os.path.join(cskv_dir, 'bin', 'cskv'),
+                      startup_file, '-k', 'startkey', '-v', 'startvalue',
+                      '-t'])
+if cskv_time - python_time > 0.25:
+    print 'ERROR: slow start up: %.3f s (python: %.3f s)' % (cskv_time,
+                                                            python_time)
+    sys.exit(1)
+else:
+    print 'INFO:  Start up time of a common call: OK'
+
+
+# Synthetic files of the benchmarks
+
+sys.path.insert(0, os.path.join(cskv_dir, 'benchmarks'))
+import generate
+
+for ftype in ['ini', 'rawe', 'rawc', 'raws']:
+    bench_file = os.path.join(results_dir, 'bench.' + ftype)
+    generate.write_lines(bench_file, generate.config_lines(
+        ftype, 3, 20, comments=0.2, indent='  ', duplicates=0.1, seed=1))
+    first = open(bench_file).read()
+    generate.write_lines(bench_file, generate.config_lines(
+        ftype, 3, 20, comments=0.2, indent='  ', duplicates=0.1, seed=1))
+    if open(bench_file).read() != first or \
+            cskv(config_file=bench_file).iftype != ftype:
+        print 'ERROR: wrong or not reproducible generated file: ' + ftype
+        sys.exit(1)
+print 'INFO:  Generated files of the benchmarks: OK'
+
+
+# Time of the phases (--stats) and profile (--profile)
+
+stats_file = os.path.join(results_dir, 'testfile.rawc')
+opts = {'config_file': stats_file, 'key': 'statskey', 'value': 'statsvalue',
+        'stats': True}
+stats_cskv = cskv(**opts)
+stats_cskv.process()
+phases = dict((name, calls) for name, seconds, calls
+              in stats_cskv.stats.dump())
+if [phases.get(name) for name in ['read', 'detect', 'edit', 'render',
+                                  'write']] != [1, 1, 3, 1, 1] or \
+        cskv(config_file=stats_file).stats is not None:
+    print 'ERROR: wrong phases of the stats: ' + str(phases)
+    sys.exit(1)
+else:
+    print 'INFO:  Phases of the stats attribute: OK'
+
+cmd = ['python', cskv_cmd, multi_dir, '-r', '-k', 'statskey', '-v', 'x',
+       '--stats', '--profile']
+proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+out, err = proc.communicate()
+if proc.returncode != 0 or not re.search(r'^read +4 ', err, re.M) or \
+        'cumulative' not in err or 'Peak memory' not in err:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Stats and profile of many files (--stats, --profile): OK'
+
+
+# Sessions: many changes, one read and one write
+
+from cskv import csession
+
+session_file = os.path.join(results_dir, 'session.ini')
+single_file = os.path.join(results_dir, 'single.ini')
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), session_file)
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), single_file)
+changes = [['section1', 'sesskey', 'sessvalue'],
+           ['sectionA', 'variable1', 'sessvalue'],
+           ['newsection', 'sesskey', 'sessvalue']]
+with csession(session_file) as conf:
+    for section, key, value in changes:
+        conf.set(section, key, value)
+    conf.delete('section1', 'variable2')
+    got = [conf.get('sectionA', 'variable1'),
+           conf.has('section1', 'variable2'),
+           conf.get('section1', 'nokey', 'default'), conf.sections()]
+for section, key, value in changes:
+    cskv(config_file=single_file, section=section, key=key,
+         value=value).process()
+cskv(config_file=single_file, section='section1', key='variable2',
+     delete=True).process()
+
+fail_test = open(session_file).read() != open(single_file).read() or \
+    got != ['sessvalue', False, 'default',
+            ['section1', 'sectionA', 'section a', 'newsection']]
+
+before = open(session_file).read()
+try:
+    with csession(session_file) as conf:
+        conf.set('section1', 'rollbackkey', 'x')
+        raise ValueError('rollback')
+except ValueError:
+    pass
+fail_test = fail_test or open(session_file).read() != before
+with csession(session_file) as conf:
+    conf.set('section1', 'sesskey', 'sessvalue')
+fail_test = fail_test or conf.changed
+
+if fail_test:
+    print 'ERROR: wrong changes, rollback or commit of a session'
+    sys.exit(1)
+else:
+    print 'INFO:  Many changes in a session: OK'
+
+
+# Read only queries (--get)
+
+from cskv import get
+
+fail_test = False
+for ftype in ['ini', 'rawe', 'rawc', 'raws']:
+    get_file = os.path.join(orig_dir, 'testfile.' + ftype)
+    get_cskv = cskv(config_file=get_file)
+    sections = [None]
+    if ftype == 'ini':
+        sections = get_cskv.get_ini_sections(get_cskv.icontent)
+    for section in sections:
+        keyvals = get_cskv.get_keyvals(get_cskv.icontent, section)
+        if get(get_file, section, list(keyvals) + ['nokey']) != keyvals:
+            fail_test = True
+if fail_test:
+    print 'ERROR: --get gives other values than get_keyvals'
+    sys.exit(1)
+
+get_file = os.path.join(results_dir, 'get.ini')
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), get_file)
+mtime = os.stat(get_file).st_mtime
+cmd = ['python', cskv_cmd, get_file, '-s', 'sectionA', '-k', 'variableA',
+       '--get']
+out_one = subprocess.check_output(cmd)
+cmd_many = ['python', cskv_cmd, get_file, '-s', 'sectionA', '--get',
+            'variableB', 'nokey', 'variable1']
+proc = subprocess.Popen(cmd_many, stdout=subprocess.PIPE)
+out_many = proc.communicate()[0]
+if out_one != 'valueA\n' or proc.returncode != 3 or \
+        out_many != 'variableB\tvalueB\nvariable1\tvalue1\n' or \
+        os.stat(get_file).st_mtime != mtime:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd_many)
+    sys.exit(1)
+else:
+    print 'INFO:  Read only queries (--get): OK'
+
+
+# Deleting many keys and patterns at once
+
+bulk_file = os.path.join(results_dir, 'bulk.ini')
+single_file = os.path.join(results_dir, 'single_delete.ini')
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), bulk_file)
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), single_file)
+bulk_keys = ['variable1', 'deleteme', 'varfixed']
+for section in ['section1', 'sectionA', 'section a']:
+    for key in bulk_keys:
+        cskv(config_file=single_file, section=section, key=key,
+             delete=True).process()
+cmd = ['python', cskv_cmd, bulk_file, '--delete-keys'] + bulk_keys + \
+    ['--all-sections']
+proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+err = proc.communicate()[1]
+fail_test = proc.returncode != 0 or 'Deleted 5 line(s)' not in err or \
+    open(bulk_file).read() != open(single_file).read()
+
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), bulk_file)
+with csession(bulk_file) as conf:
+    deleted = conf.delete_many('sectionA', globs=['variable?'],
+                               regexes=['^delete.*_int$'])
+    left = [key for key, value in conf.items('sectionA')]
+fail_test = fail_test or deleted != 4 or left != ['deleteme'] or \
+    not conf.has('section1', 'variable1')
+
+if fail_test:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Deleting many keys and patterns (--delete-keys...): OK'
+
+
+# Guessing the format on the first lines only, unless it is not clear
+
+from cskv import SAMPLE_LINES
+
+sniff_file = os.path.join(results_dir, 'sniff.conf')
+with open(sniff_file, 'w') as output:
+    for i in range(SAMPLE_LINES):
+        output.write('  key%06d = value\n' % i)
+    for i in range(3 * SAMPLE_LINES):
+        output.write('key%06d: value\n' % (SAMPLE_LINES + i))
+analysis = analyze(sniff_file)
+fail_test = [analysis.ftype, analysis.indent, analysis.confidence(),
+             analysis.sampled] != ['rawe', '  ', 1.0, True]
+
+# Half "=" and half ":" on the first lines: the whole file decides
+with open(sniff_file, 'w') as output:
+    for i in range(SAMPLE_LINES):
+        output.write('key%06d%s value\n' % (i, '=:'[i % 2]))
+    for i in range(SAMPLE_LINES):
+        output.write('key%06d: value\n' % (SAMPLE_LINES + i))
+analysis = analyze(sniff_file)
+fail_test = fail_test or analysis.ftype != 'rawc' or \
+    abs(analysis.confidence() - 0.5) > 0.01
+
+if fail_test:
+    print 'ERROR: wrong guess of the format on the first lines'
+    sys.exit(1)
+else:
+    print 'INFO:  Guessing the format on the first lines: OK'
+
+# Merging into a big file with mixed padding (comments and a few other
+# separators) keeps the batch, and gives the same as one by one
+with open(sniff_file, 'w') as output:
+    for sec in range(4):
+        output.write('[section%d]\n' % sec)
+        for i in range(SAMPLE_LINES):
+            if i % 10 == 0:
+                output.write('# Comment about key%06d\n' % i)
+            output.write('key%06d%s0\n' % (i, [' = ', '='][i % 7 == 0]))
+extra_s = [['section%d' % (i % 4), 'key%06d' % (i * 3), str(i)]
+           for i in range(SAMPLE_LINES)]
+extra_s += [['section%d' % (i % 4), 'newkey%06d' % i, str(i)]
+            for i in range(SAMPLE_LINES // 2)]
+cfile = cskv(config_file=sniff_file)
+plans = []
+merge_plan = cfile.merge_plan
+cfile.merge_plan = lambda doc, groups: plans.append(
+    merge_plan(doc, groups)) or plans[-1]
+batch = cfile.merge(cfile.doc, extra_s).lines()
+cfile = cskv(config_file=sniff_file)
+for section, key, value in extra_s:
+    cfile.insert_doc(cfile.doc, section, key, value)
+
+if None in plans or batch != cfile.doc.lines():
+    print 'ERROR: merging into a big file with mixed padding did not',
+    print 'take the batch path'
+    sys.exit(1)
+else:
+    print 'INFO:  Batch merge into a big file with mixed padding: OK'
+
+
+# Drift of many files against a baseline (--drift)
+
+from cskv import drift, find_files
+
+fleet_dir = os.path.join(results_dir, 'fleet')
+golden = open(os.path.join(orig_dir, 'testfile.ini')).read()
+for i in range(6):
+    os.makedirs(os.path.join(fleet_dir, 'host%d' % i))
+    text = golden
+    if i % 2:
+        text = text.replace('valueA', 'drifted')
+    if i == 4:
+        text = text.replace('  variableB = valueB\n', '')
+    open(os.path.join(fleet_dir, 'host%d' % i, 'smb.ini'), 'w').write(text)
+fleet_files = find_files([fleet_dir], 'smb.ini', True)
+report = drift(os.path.join(orig_dir, 'testfile.ini'), fleet_files, jobs=2)
+summary = [[entry['key'], entry['hosts'],
+            [[div['change'], div['value'], len(div['files'])]
+             for div in entry['divergences']]] for entry in report['keys']]
+fail_test = [report['files'], report['drifted'], report['failed']] != \
+    [6, 4, []] or summary != [['variableA', 3, [['changed', 'drifted', 3]]],
+                              ['variableB', 1, [['removed', None, 1]]]]
+
+cmd = ['python', cskv_cmd, fleet_dir, '-r', '--glob', 'smb.ini', '--drift',
+       os.path.join(orig_dir, 'testfile.ini')]
+out = subprocess.check_output(cmd)
+if fail_test or '4 of 6 files differ, 0 failed' not in out:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Drift of many files against a baseline (--drift): OK'
+
+
+# Content hashes of the sections
+
+from cskv import section_hashes
+
+hash_file = os.path.join(results_dir, 'hashes.ini')
+with open(hash_file, 'w') as output:
+    output.write('# Same content, other order, blanks and comments\n'
+                 '[section1]\n'
+                 'variable2=value2\n'
+                 '# variable1 = old\n'
+                 '    varfixed   =   valfixed\n'
+                 'variable1 = value1\n'
+                 'interactive = original\n'
+                 'variable_ns = value_ns\n\n'
+                 '[sectionA]\n'
+                 'variable1 = changed\n')
+hashes_a = section_hashes(os.path.join(orig_dir, 'testfile.ini'))
+hashes_b = section_hashes(hash_file)
+hash_cskv = cskv(config_file=hash_file,
+                 compare=os.path.join(orig_dir, 'testfile.ini'))
+diffs_lines = list(hash_cskv.diff_confs())
+diffs_snaps = list(hash_cskv.diff_confs(
+    hash_cskv.snapshot(), hash_cskv.snapshot(hash_cskv.kwargs['compare'])))
+if hashes_a['section1'] != hashes_b['section1'] or \
+        hashes_a['sectionA'] == hashes_b['sectionA'] or \
+        hash_cskv.section_hashes() != hashes_b or \
+        diffs_lines != diffs_snaps or \
+        set(diff['section'] for diff in diffs_snaps) != \
+        set(['sectionA', 'section a']):
+    print 'ERROR: wrong content hashes of the sections'
+    sys.exit(1)
+else:
+    print 'INFO:  Content hashes of the sections: OK'
+
+
+# Non blocking calls (casync)
+
+from cskv import casync, csession
+
+async_files = []
+for idx in range(2):
+    async_files.append(os.path.join(results_dir, 'async%d.ini' % idx))
+    shutil.copy(os.path.join(orig_dir, 'testfile.ini'), async_files[-1])
+sync_file = os.path.join(results_dir, 'async_sync.ini')
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), sync_file)
+
+editor = casync(4)
+order = []
+futures = []
+for idx in range(20):
+    for async_file in async_files:
+        future = editor.set(async_file, 'sectionA', 'async_key', str(idx))
+        future.add_done_callback(
+            lambda future, idx=idx, name=async_file:
+            order.append([name, idx]))
+        futures.append(future)
+reads = [editor.get(async_file, 'sectionA', 'async_key')
+         for async_file in async_files]
+commits = [editor.commit(async_file) for async_file in async_files]
+missing = editor.get(os.path.join(results_dir, 'async_missing.ini'),
+                     'sectionA', 'key')
+# After the commits of both files, and before the next change of any
+compares = editor.compare(async_files[0], async_files[1])
+editor.set(async_files[1], 'sectionA', 'async_key', 'later')
+later = editor.commit(async_files[1])
+editor.close()
+
+with csession(sync_file) as session:
+    for idx in range(20):
+        session.set('sectionA', 'async_key', str(idx))
+try:
+    missing.result()
+    missing_error = None
+except (RuntimeError, IOError, OSError) as e:
+    missing_error = e
+if [future.result() for future in reads] != ['19', '19'] or \
+        [future.result() for future in commits] != [True, True] or \
+        not all(future.done() for future in futures) or \
+        [idx for name, idx in order if name == async_files[1]] != \
+        range(20) or \
+        open(async_files[0]).read() != open(sync_file).read() or \
+        compares.result() != [] or later.result() is not True or \
+        csession(async_files[1]).get('sectionA', 'async_key') != 'later' \
+        or missing_error is None:
+    print 'ERROR: wrong results of the non blocking calls (casync)'
+    sys.exit(1)
+else:
+    print 'INFO:  Non blocking calls (casync): OK'
+
+
+# Dry run with a unified diff (--diff)
+
+
+def apply_diff(lines, diff):
+    # Apply a unified diff (without fuzz) to a list of lines
+    new, pos = [], 0
+    for line in diff[2:]:
+        if line.startswith('@@'):
+            start = int(line.split()[1][1:].split(',')[0])
+            if ',0' in line.split()[1]:
+                start += 1
+            new.extend(lines[pos:start-1])
+            pos = start - 1
+        elif line[0] in ' -':
+            if lines[pos] != line[1:]:
+                return None
+            pos += 1
+            if line[0] == ' ':
+                new.append(line[1:])
+        else:
+            new.append(line[1:])
+    return new + lines[pos:]
+
+
+fail_test = False
+for ftype in ['ini', 'rawe', 'rawc', 'raws']:
+    diff_file = os.path.join(orig_dir, 'testfile.' + ftype)
+    section = 'sectionA' if ftype == 'ini' else None
+    sep = {'ini': ' = ', 'rawe': ' = ', 'rawc': ': ', 'raws': ' '}[ftype]
+    extra = ['variable2' + sep + 'diff2', 'newkey' + sep + 'v']
+    if ftype == 'ini':
+        extra = ['[section1]', extra[0], '[section_new]', extra[1]]
+    for opts in [{'key': 'variable1', 'value': 'diff1'},
+                 {'key': 'variableA', 'delete': True},
+                 {'key': 'newkey', 'value': 'new', 'extra_conf': extra}]:
+        diff_cskv = cskv(config_file=diff_file, section=section, diff=True,
+                         **opts)
+        diff = diff_cskv.process()
+        new_lines = diff_cskv.doc.lines()
+        if apply_diff(diff_cskv.icontent, diff) != new_lines or \
+                diff_cskv.changed != (new_lines != diff_cskv.icontent):
+            fail_test = True
+if fail_test:
+    print 'ERROR: the diff does not give the changed file'
+    sys.exit(1)
+
+# The diff is applied by "patch" (without fuzz) as the real write: also
+# with changes at the end of a section, whose context is in the next one
+patch_file = os.path.join(results_dir, 'patch.ini')
+real_file = os.path.join(results_dir, 'real.ini')
+for opts in [{'section': 'section1', 'key': 'newkey', 'value': 'new'},
+             {'section': 'sectionA', 'key': 'newkey', 'value': 'new',
+              'mmap': True},
+             {'section': 'sectionA', 'key': 'deleteme_int', 'delete': True},
+             {'section': 'section a', 'key': 'variable b', 'value': 'c'},
+             {'extra_conf': ['[section1]', 'newkey = 1', '[section a]',
+                             'newkey = 2', '[section_new]', 'newkey = 3']}]:
+    for name in [patch_file, real_file]:
+        shutil.copy(os.path.join(orig_dir, 'testfile.ini'), name)
+    diff = cskv(config_file=patch_file, diff=True, **dict(opts)).process()
+    cskv(config_file=real_file, **dict(opts)).process()
+    proc = subprocess.Popen(['patch', '--fuzz=0', '-s', patch_file],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.communicate('\n'.join(diff) + '\n')
+    if proc.returncode or \
+            open(patch_file).read() != open(real_file).read():
+        print 'ERROR: "patch" does not apply the diff as the real write'
+        print '\n'.join(diff)
+        sys.exit(1)
+
+diff_file = os.path.join(results_dir, 'diff.ini')
+shutil.copy(os.path.join(orig_dir, 'testfile.ini'), diff_file)
+mtime = os.stat(diff_file).st_mtime
+outputs = []
+for args in [['-v', 'changed'], ['-v', 'changed', '--mmap'],
+             ['-v', 'value1']]:
+    cmd = ['python', cskv_cmd, diff_file, '-s', 'sectionA', '-k',
+           'variable1', '--diff'] + args
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    outputs.append([proc.communicate()[0], proc.returncode])
+if outputs[0][1] != 4 or outputs[0] != outputs[1] or \
+        outputs[2] != ['', 0] or \
+        '-  variable1 = value1\n+  variable1 = changed\n' not in \
+        outputs[0][0] or os.stat(diff_file).st_mtime != mtime:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Dry run with a unified diff (--diff): OK'
+
+
+# Extra config streamed and merged in batches (--batch)
+
+fail_test = False
+for ftype in ['ini', 'rawe', 'rawc', 'raws']:
+    batch_file = os.path.join(results_dir, 'batch.' + ftype)
+    generate.write_lines(batch_file, generate.config_lines(
+        ftype, 3, 20, comments=0.2, indent='  ', duplicates=0.1, seed=2))
+    extra = list(generate.extra_lines(ftype, 3, 20, 50, seed=2))
+    merged = cskv(config_file=batch_file, extra_conf=extra,
+                  diff=True).process()
+    for size in [1, 7, 1000]:
+        batched = cskv(config_file=batch_file, extra_conf=iter(extra),
+                       batch=size, diff=True).process()
+        if batched != merged or not merged:
+            fail_test = True
+if fail_test:
+    print 'ERROR: merging in batches gives other changes than at once'
+    sys.exit(1)
+
+# Without extra config, like merge()
+batch_file = os.path.join(results_dir, 'batch_none.rawe')
+shutil.copy(os.path.join(orig_dir, 'testfile.rawe'), batch_file)
+for stream in [False, True]:
+    cskv(config_file=batch_file, key='variable1', value='none',
+         batch=10, stream=stream).process()
+    if cskv(config_file=batch_file).get_keyvals(open(
+            batch_file).read().splitlines(), None)['variable1'] != 'none':
+        fail_test = True
+if fail_test:
+    print 'ERROR: merging in batches without extra config failed'
+    sys.exit(1)
+
+# Streamed files: one pass over the file for each batch, which is only read
+# from the extra config when the previous one was written
+for ftype in ['rawe', 'rawc', 'raws']:
+    results = []
+    for stream in [False, True]:
+        batch_file = os.path.join(results_dir, 'batch_stream' +
+                                  str(stream) + '.' + ftype)
+        generate.write_lines(batch_file, generate.config_lines(
+            ftype, 3, 20, comments=0.2, duplicates=0.1, seed=3))
+        extra = generate.extra_lines(ftype, 3, 20, 2500, seed=3)
+        consumed = []
+
+        def extra_lines():
+            for line in extra:
+                consumed.append(line)
+                yield line
+
+        cfile = cskv(config_file=batch_file, extra_conf=extra_lines(),
+                     batch=1000, stream=stream)
+        passes = []
+        read_lines = cfile.read_lines
+
+        def counted_lines(file_name):
+            passes.append(len(consumed))
+            return read_lines(file_name)
+
+        cfile.read_lines = counted_lines
+        cfile.process()
+        results.append(open(batch_file).read())
+    if results[0] != results[1] or passes != [0, 1000, 2000, 2500] or \
+            [name for name in os.listdir(results_dir)
+             if name.endswith('.cskv')]:
+        print 'ERROR: streaming', ftype, 'files in batches failed'
+        sys.exit(1)
+
+batch_file = os.path.join(results_dir, 'batch_cli.rawe')
+shutil.copy(os.path.join(orig_dir, 'testfile.rawe'), batch_file)
+cmd = ['python', cskv_cmd, batch_file, '--batch', '2', '-e']
+proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+out, err = proc.communicate('variable1 = batch1\nnewkey1 = new1\n'
+                            'variable2 = batch2\n')
+keyvals = cskv(config_file=batch_file).get_keyvals(
+    open(batch_file).read().splitlines(), None)
+if proc.returncode or err.count('key/values merged into') != 2 or \
+        'Batch 2: 3 key/values' not in err or \
+        [keyvals.get(key) for key in ['variable1', 'newkey1', 'variable2']] \
+        != ['batch1', 'new1', 'batch2']:
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Extra config merged in batches (--batch): OK'
+
+
+# Desired state of many files in a manifest (--apply)
+
+from cskv import apply_manifest, read_manifest
+
+apply_dir = os.path.join(results_dir, 'apply')
+os.mkdir(apply_dir)
+for ftype in ['ini', 'rawe', 'rawc']:
+    for prefix in ['apply', 'json', 'one']:
+        shutil.copy(os.path.join(orig_dir, 'testfile.' + ftype),
+                    os.path.join(apply_dir, prefix + '.' + ftype))
+manifest_ini = os.path.join(apply_dir, 'manifest.ini')
+with open(manifest_ini, 'w') as output:
+    output.write('# Desired state\n'
+                 '[' + os.path.join(apply_dir, 'apply.ini') + ':sectionA]\n'
+                 'variable1 = applied\n'
+                 '-variableB\n'
+                 'newkey = new\n'
+                 '[' + os.path.join(apply_dir, 'apply.rawe') + ']\n'
+                 'variable1 = applied\n'
+                 '-variable2\n'
+                 '[' + os.path.join(apply_dir, 'apply.rawc') + ']\n'
+                 'varfixed = valfixed\n'
+                 '[' + os.path.join(apply_dir, 'apply.ini') + ':section1]\n'
+                 'variable2 = applied2\n')
+manifest_json = os.path.join(apply_dir, 'manifest.json')
+with open(manifest_json, 'w') as output:
+    output.write('{"%s": {"sectionA": {"variable1": "applied",\n'
+                 '                     "variableB": null, "newkey": "new"},\n'
+                 '       "section1": {"variable2": "applied2"}},\n'
+                 ' "%s": {"": {"variable1": "applied", "variable2": null}},\n'
+                 ' "%s": {"": {"varfixed": "valfixed"}}}\n' % tuple(
+                     os.path.join(apply_dir, 'json.' + ftype)
+                     for ftype in ['ini', 'rawe', 'rawc']))
+
+plan = read_manifest(manifest_ini)
+for config_file, ops in plan:
+    with csession(config_file.replace('apply.', 'one.')) as session:
+        for op, section, key, value in ops:
+            if op == 'set':
+                session.set(section, key, value)
+            else:
+                session.delete(section, key)
+results = list(apply_manifest(manifest_ini))
+json_results = list(apply_manifest(manifest_json, 2))
+cmd = ['python', cskv_cmd, '--apply', manifest_ini, '--diff']
+proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+out = proc.communicate()[0]
+if [[result['ok'], result['changed']] for result in results] != \
+        [[True, True], [True, True], [True, False]] or \
+        [result['changed'] for result in json_results] != \
+        [True, True, False] or \
+        len(plan) != 3 or len(plan[0][1]) != 4 or \
+        any(open(os.path.join(apply_dir, prefix + '.' + ftype)).read() !=
+            open(os.path.join(apply_dir, 'one.' + ftype)).read()
+            for prefix in ['apply', 'json'] for ftype in ['ini', 'rawe']) or \
+        proc.returncode != 0 or \
+        not out.endswith('3 files processed, 0 changed, 0 failed\n'):
+    print 'ERROR: the following command failed:'
+    print ' '.join(cmd)
+    sys.exit(1)
+else:
+    print 'INFO:  Desired state of many files (--apply): OK'
+
+
+# Include directives and drop-in directories (--includes)
+
+import cskv as cskv_module
+from cskv import where
+
+inc_dir = os.path.join(results_dir, 'includes')
+os.makedirs(os.path.join(inc_dir, 'sshd_config.d'))
+os.makedirs(os.path.join(inc_dir, 'smb.conf.d'))
+inc_files = {'sshd_config': 'Include sshd_config.d/*.conf\n'
+                            'PasswordAuthentication yes\n'
+                            'Port 22\n'
+                            '# PermitRootLogin yes\n',
+             'sshd_config.d/10-first.conf': 'PasswordAuthentication no\n'
+                                            'Port 2222\n',
+             'sshd_config.d/20-second.conf': 'PasswordAuthentication yes\n'
+                                             'Include ../shared.conf\n'
+                                             'X11Forwarding yes\n',
+             'shared.conf': 'PermitRootLogin no\n',
+             'other_sshd': 'Include shared.conf\n'
+                           'Port 22\n',
+             'smb.conf': '[global]\n'
+                         'workgroup = W\n'
+                         'log level = 0\n'
+                         'include = shares.conf\n',
+             'shares.conf': 'workgroup = X\n'
+                            '[data]\n'
+                            'path = /srv\n',
+             'smb.conf.d/log.conf': '[global]\n'
+                                    'log level = 1\n'}
+for name, text in inc_files.items():
+    with open(os.path.join(inc_dir, name), 'w') as output:
+        output.write(text)
+sshd_file = os.path.join(inc_dir, 'sshd_config')
+sshd_keys = ['Port', 'PasswordAuthentication', 'PermitRootLogin', 'Nope']
+
+cskv_module.include_snapshots.clear()
+values = get(sshd_file, None, sshd_keys, includes=True)
+parsed = len(cskv_module.include_snapshots)
+cskv_module.include_snapshots.clear()
+first = get(sshd_file, None, ['Port', 'PasswordAuthentication'],
+            includes=True)
+parsed_first = len(cskv_module.include_snapshots)
+cskv_module.include_snapshots.clear()
+own = get(sshd_file, None, ['Port'], includes=True)
+parsed_own = len(cskv_module.include_snapshots)
+
+# The first value wins for sshd (the drop-ins before the main file ones),
+# and the files after the last key found are not read
+if values != {'Port': '2222', 'PasswordAuthentication': 'no',
+              'PermitRootLogin': 'no'} or \
+        get(sshd_file, None, sshd_keys) != \
+        {'Port': '22', 'PasswordAuthentication': 'yes'} or \
+        parsed != 3 or parsed_first != 1 or parsed_own != 1 or \
+        first != {'Port': '2222', 'PasswordAuthentication': 'no'} or \
+        own != {'Port': '2222'} or \
+        where(sshd_file, None, 'PermitRootLogin', includes=True) != \
+        [os.path.join(inc_dir, 'sshd_config.d', '..', 'shared.conf'), 1] or \
+        where(sshd_file, None, 'PermitRootLogin') is not None or \
+        get(os.path.join(inc_dir, 'smb.conf'), 'global',
+            ['workgroup', 'log level'], includes=True) != \
+        {'workgroup': 'X', 'log level': '1'} or \
+        where(os.path.join(inc_dir, 'smb.conf'), 'data', 'path',
+              includes=True) != [os.path.join(inc_dir, 'shares.conf'), 3]:
+    print 'ERROR: wrong values or places of keys with includes'
+    sys.exit(1)
+
+cmd = ['python', cskv_cmd, sshd_file, '--compare',
+       os.path.join(inc_dir, 'other_sshd'), '--includes']
+out = subprocess.check_output(cmd)
+cmd_where = ['python', cskv_cmd, sshd_file, '--where', 'Port',
+             'X11Forwarding', '--includes']
+out_where = subprocess.check_output(cmd_where)
+if [line.split() for line in out.splitlines()[1:]] != [
+        ['PasswordAuthentication', 'no'], ['Port', '2222', '22'],
+        ['X11Forwarding', 'yes']] or \
+        out_where != 'Port\t' + os.path.join(
+            inc_dir, 'sshd_config.d', '10-first.conf') + ':2\n' + \
+        'X11Forwarding\t' + \
+        os.path.join(inc_dir, 'sshd_config.d', '20-second.conf') + ':3\n':
+    print 'ERROR: the following commands failed:'
+    print ' '.join(cmd)
+    print ' '.join(cmd_where)
+    sys.exit(1)
+else:
+    print 'INFO:  Include directives and drop-in directories: OK'